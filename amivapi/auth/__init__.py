@@ -21,7 +21,13 @@ from amivapi.auth.link_methods import (
     add_permitted_methods_after_update,
     add_permitted_methods_for_home
 )
-from amivapi.auth.sessions import process_login, sessiondomain
+from amivapi.auth.sessions import (
+    invalidate_cached_sessions,
+    invalidate_cached_user_sessions,
+    process_login,
+    sessiondomain
+)
+from amivapi.cache import TimestampWriter, TTLCache
 from amivapi.utils import register_domain
 
 
@@ -34,6 +40,16 @@ def init_app(app):
     register_domain(app, sessiondomain)
     app.on_insert_sessions += process_login
 
+    # Session cache, see `amivapi/cache.py`
+    app.config['session_cache'] = TTLCache(
+        maxsize=app.config['SESSION_CACHE_SIZE'],
+        ttl=app.config['SESSION_CACHE_TTL'])
+    app.config['session_timestamps'] = TimestampWriter(
+        app, 'sessions', interval=app.config['SESSION_REFRESH_INTERVAL'])
+    app.on_inserted_sessions += invalidate_cached_sessions
+    app.on_deleted_item_sessions += invalidate_cached_sessions
+    app.on_deleted_item_users += invalidate_cached_user_sessions
+
     # on_pre_METHOD, triggered right after auth by Eve
     for method in ['GET', 'POST', 'PATCH', 'DELETE']:
         event = getattr(app, 'on_pre_' + method)
@@ -13,7 +13,9 @@ from datetime import datetime as dt
 
 from flask import abort, current_app, g
 
+from amivapi import metrics
 from amivapi.auth.auth import AdminOnlyAuth
+from amivapi.cache import TimestampWriter, TTLCache
 from amivapi.utils import register_domain
 
 try:
@@ -28,18 +30,19 @@ def authorize_apikeys(resource):
 
     Also update 'updated' timestamp everytime a key is accessed
     """
-    apikeys = current_app.data.driver.db['apikeys']
-    apikey = apikeys.find_one({'token': g.get('current_token')},
-                              {'permissions': 1})
+    apikey = _find_apikey(g.get('current_token'))
 
     if apikey:
         # Get permission for resource if they exist
         permission = apikey['permissions'].get(resource)
 
         # Update timestamp (remove microseconds to match mongo precision)
+        # The database is updated in the background, see `cache.py`
         new_time = dt.utcnow().replace(microsecond=0)
-        apikeys.update_one({'_id': apikey['_id']},
-                           {'$set': {'_updated': new_time}})
+        current_app.config['apikey_timestamps'].touch(apikey['_id'], new_time)
+
+        # Counted once the response is sent, see `count_apikey_request`
+        g.current_apikey = apikey['name']
 
         if permission == 'read':
             g.resource_admin_readonly = True
@@ -50,6 +53,56 @@ def authorize_apikeys(resource):
                        "permissions.")
 
 
+def count_apikey_request(resource, request, payload):
+    """Count the request for the requested resource (not the home endpoint).
+
+    `authorize_apikeys` runs for every resource on the home endpoint, so the
+    requests are counted once per request instead.
+    """
+    apikey = g.get('current_apikey')
+    if apikey is not None and resource is not None:
+        metrics.increment('apikey_requests', apikey=apikey, resource=resource)
+
+
+def _find_apikey(token):
+    """Get the API key for a token, use the cache if possible.
+
+    Tokens without API key (e.g. session tokens) are cached as well.
+    The returned key must not be modified.
+    """
+    if not token:
+        return None
+
+    cache = current_app.config['apikey_cache']
+    apikey = cache.get(token, False)
+
+    if apikey is False:
+        apikey = current_app.data.driver.db['apikeys'].find_one(
+            {'token': token}, {'name': 1, 'permissions': 1})
+        cache.set(token, apikey)
+
+    return apikey
+
+
+def invalidate_cached_apikeys(items):
+    """Remove new or deleted API keys from the cache."""
+    if not isinstance(items, list):
+        items = [items]
+
+    for item in items:
+        current_app.config['apikey_cache'].pop(item['token'])
+
+
+def invalidate_updated_apikey(updates, original):
+    """Remove a modified API key from the cache."""
+    current_app.config['apikey_cache'].pop(original['token'])
+
+
+def forget_deleted_apikey(item):
+    """Do not update the timestamp of a deleted API key."""
+    current_app.config['apikey_timestamps'].forget(item['_id'])
+
+
 description = ("""
 API keys can be used to give permissions to other applications.
 
@@ -95,6 +148,10 @@ apikeydomain = {
 
         'authentication': AdminOnlyAuth,
 
+        'mongo_indexes': {
+            'token': ([('token', 1)], {'background': True}),
+        },
+
         'schema': {
             'name': {
                 'description': 'A unique name to identify the key.',
@@ -143,4 +200,18 @@ def init_apikeys(app):
     """Register API Key resource and add auth hook."""
     register_domain(app, apikeydomain)
     app.after_auth += authorize_apikeys
+    for method in ('GET', 'POST', 'PATCH', 'PUT', 'DELETE'):
+        event = getattr(app, 'on_post_%s' % method)
+        event += count_apikey_request
     app.on_insert_apikeys += generate_tokens
+
+    # Cache, see `amivapi/cache.py`
+    app.config['apikey_cache'] = TTLCache(
+        maxsize=app.config['APIKEY_CACHE_SIZE'],
+        ttl=app.config['APIKEY_CACHE_TTL'])
+    app.config['apikey_timestamps'] = TimestampWriter(
+        app, 'apikeys', interval=app.config['APIKEY_REFRESH_INTERVAL'])
+    app.on_inserted_apikeys += invalidate_cached_apikeys
+    app.on_updated_apikeys += invalidate_updated_apikey
+    app.on_deleted_item_apikeys += invalidate_cached_apikeys
+    app.on_deleted_item_apikeys += forget_deleted_apikey
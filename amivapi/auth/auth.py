@@ -201,6 +201,26 @@ def only_amiv_token_auth(func):
 
 # Function to log in the user with a specific token
 
+def _find_session(token):
+    """Get the session for a token, use the session cache if possible.
+
+    Tokens without session are cached as well, since e.g. API keys are sent
+    as tokens, too.
+
+    Returns:
+        dict: A copy of the session, None if there is no session for the token
+    """
+    cache = current_app.config['session_cache']
+    session = cache.get(token, False)
+
+    if session is False:
+        session = current_app.data.driver.db['sessions'].find_one(
+            {'token': token})
+        cache.set(token, session)
+
+    # Copy to make sure that changes to the session do not end up in the cache
+    return dict(session) if session else None
+
 
 def authenticate_token(token):
     """Authenticate user and set g.current_token, g.current_session and
@@ -215,16 +235,14 @@ def authenticate_token(token):
         g.current_token = token
 
         # Get session
-        sessions = current_app.data.driver.db['sessions']
-        session = sessions.find_one({'token': token})
+        session = _find_session(token)
 
         if session:
             # Update timestamp (remove microseconds to match mongo precision)
+            # The database is updated in the background, see `cache.py`
             new_time = dt.utcnow().replace(microsecond=0)
-            sessions.update_one({'_id': session['_id']},
-                                {'$set': {
-                                    '_updated': new_time
-                                }})
+            current_app.config['session_timestamps'].touch(session['_id'],
+                                                           new_time)
             session['_updated'] = new_time
 
             # Save user_id and session with updated timestamp in g
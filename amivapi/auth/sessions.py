@@ -7,13 +7,12 @@
 import datetime
 import re
 
-from amivapi import ldap
+from amivapi import ldap, passwords
 from amivapi.auth import AmivTokenAuth
-from amivapi.cron import periodic
-from amivapi.utils import admin_permissions, get_id
+from amivapi.cron import periodic, schedulable, schedule_task
+from amivapi.utils import get_id
 from bson import ObjectId
 from bson.errors import InvalidId
-from eve.methods.patch import patch_internal
 from eve.utils import debug_error_message
 from flask import abort
 from flask import current_app as app
@@ -103,6 +102,13 @@ sessiondomain = {
         # Allow GET requests with token, i.e. GET /sessions/<token>
         'additional_lookup': {'field': 'token', 'url': 'string'},
 
+        'mongo_indexes': {
+            'token': ([('token', 1)], {'background': True}),
+            'user': ([('user', 1)], {'background': True}),
+            # Used to delete expired sessions
+            '_updated': ([('_updated', 1)], {'background': True}),
+        },
+
         'schema': {
             'username': {
                 'description': '`_id`, `nethz` or `email` of a user.',
@@ -134,7 +140,9 @@ sessiondomain = {
                     'resource': 'users',
                     'field': '_id',
                     'embeddable': True,
-                    'cascade_delete': True
+                    'cascade_delete': True,
+                    # Never keep sessions of deleted users
+                    'cascade_sync': True,
                 },
                 'readonly': True,
 
@@ -250,6 +258,9 @@ def verify_password(user, plaintext):
     It is possible that the password is None, e.g. if the user is authenticated
     via LDAP. In this case default to "not verified".
 
+    The new hash is computed together with the verification, but stored
+    later by `amivapi cron` to keep the login fast.
+
     Args:
         user (dict): the user in question.
         plaintext (string): password to check
@@ -258,21 +269,49 @@ def verify_password(user, plaintext):
         bool: True if password matches. False if it doesn't or if there is no
             password set and/or provided.
     """
-    password_context = app.config['PASSWORD_CONTEXT']
-
     if (plaintext is None) or (user['password'] is None):
         return False
 
-    is_valid = password_context.verify(plaintext, user['password'])
+    is_valid, new_hash = passwords.verify_password(plaintext,
+                                                   user['password'])
 
-    if is_valid and password_context.needs_update(user['password']):
-        # update password - hook will handle hashing
-        update = {'password': plaintext}
-        with admin_permissions():
-            patch_internal("users", payload=update, _id=user['_id'])
+    if is_valid and new_hash is not None:
+        # Repeated logins replace the pending task instead of adding more
+        schedule_task(datetime.datetime.utcnow(), update_password_hash,
+                      user['_id'], user['password'], new_hash,
+                      key='rehash-%s' % user['_id'])
     return is_valid
 
 
+@schedulable
+def update_password_hash(user_id, old_hash, new_hash):
+    """Store an upgraded hash, unless the password has changed meanwhile."""
+    app.data.driver.db['users'].update_one(
+        {'_id': user_id, 'password': old_hash},
+        {'$set': {'password': new_hash}})
+
+
+def invalidate_cached_sessions(items):
+    """Remove sessions from the session cache (and pending timestamps).
+
+    New tokens may have been cached as invalid before, deleted sessions must
+    not be found in the cache anymore.
+    """
+    if not isinstance(items, list):
+        items = [items]
+
+    for item in items:
+        app.config['session_cache'].pop(item['token'])
+        app.config['session_timestamps'].forget(item['_id'])
+
+
+def invalidate_cached_user_sessions(item):
+    """Remove all cached sessions of a deleted user."""
+    app.config['session_cache'].discard_if(
+        lambda token, session: (session is not None and
+                                session['user'] == item['_id']))
+
+
 # Regular task to clean up expired sessions
 @periodic(datetime.timedelta(days=1))
 def delete_expired_sessions():
@@ -285,5 +324,9 @@ def delete_expired_sessions():
     >>> with app.app_context():
     >>>     delete_expired_sessions()
     """
+    # Write pending timestamps first, recently used sessions must not expire
+    app.config['session_timestamps'].flush()
+
     deadline = datetime.datetime.utcnow() - app.config['SESSION_TIMEOUT']
     app.data.driver.db['sessions'].delete_many({'_updated': {'$lt': deadline}})
+    app.config['session_cache'].clear()
@@ -10,20 +10,41 @@ entries get resolved/deleted.
 
 from flask import current_app
 
-from amivapi.utils import mail_from_template
+from amivapi.utils import (
+    find_user,
+    find_users,
+    get_id,
+    mail_from_template,
+    mail_many,
+    render_mail,
+)
 from datetime import datetime
 
 from amivapi.cron import schedulable, schedule_task
 
 
-def _get_email_and_name(item):
-    """Retrieve the user email for a blacklist entry."""
-    id_field = current_app.config['ID_FIELD']
-    lookup = {id_field: item['user']}
-    user = current_app.data.find_one('users', None, **lookup)
+def _get_email_and_name(item, users=None):
+    """Retrieve the user email for a blacklist entry.
+
+    Optionally, the users can be provided if they have been fetched already.
+    """
+    if users is None:
+        user = find_user(item['user'])
+    else:
+        user = users[get_id(item['user'])]
     return user['email'], user['firstname']
 
 
+def _schedule_removed_mail(item):
+    """Schedule the mail for the end time, replaces previous schedules.
+
+    Only id and end time are needed to check that the mail is still valid.
+    """
+    schedule_task(item['end_time'], send_removed_mail,
+                  {'_id': item['_id'], 'end_time': item['end_time']},
+                  key='blacklist-removed-%s' % item['_id'])
+
+
 @schedulable
 def send_removed_mail(item):
     """Send scheduled email when a blacklist entry times out."""
@@ -33,7 +54,8 @@ def send_removed_mail(item):
         return  # Entry was deleted, no mail to send anymore
     if _item.get('end_time') is None:
         return  # Entry was patched to last indefinitely, so no mail to send.
-    if _item['end_time'].replace(tzinfo=None) != item['end_time']:
+    if (_item['end_time'].replace(tzinfo=None) !=
+            item['end_time'].replace(tzinfo=None)):
         return  # Entry was edited, so this is outdated.
 
     email, name = _get_email_and_name(_item)
@@ -48,8 +70,10 @@ def send_removed_mail(item):
 
 def notify_new_blacklist(items):
     """Send an email to a user who has a new blacklist entry."""
+    users = find_users(item['user'] for item in items)
+    mails = []
     for item in items:
-        email, name = _get_email_and_name(item)
+        email, name = _get_email_and_name(item, users)
         fields = {
             'reason': item['reason'],
             'reply_to': current_app.config['BLACKLIST_REPLY_TO'],
@@ -59,16 +83,18 @@ def notify_new_blacklist(items):
         if item['price']:
             fields['price'] = item['price']/100  # convert Rappen to CHF
 
-        mail_from_template(
+        mails.append(render_mail(
             to=email,
             subject='You have been blacklisted!',
             template_name='blacklist_added',
             template_args=fields,
-            reply_to=current_app.config['BLACKLIST_REPLY_TO'])
+            reply_to=current_app.config['BLACKLIST_REPLY_TO']))
 
         # If the end time is already known, schedule removal mail
         if item['end_time'] and item['end_time'] > datetime.utcnow():
-            schedule_task(item['end_time'], send_removed_mail, item)
+            _schedule_removed_mail(item)
+
+    mail_many(mails)
 
 
 def notify_patch_blacklist(new, old):
@@ -85,7 +111,7 @@ def notify_patch_blacklist(new, old):
     if new['end_time'] <= datetime.utcnow():
         send_removed_mail(item)
     elif new['end_time'] != old['end_time']:
-        schedule_task(new['end_time'], send_removed_mail, item)
+        _schedule_removed_mail(item)
 
 
 def notify_delete_blacklist(item):
@@ -25,6 +25,10 @@ from amivapi import (
     blacklist,
     joboffers,
     ldap,
+    loader,
+    mailer,
+    metrics,
+    passwords,
     studydocs,
     users,
     utils
@@ -95,6 +99,12 @@ def create_app(config_file=None, **kwargs):
     # Set up error logging with sentry
     init_sentry(app)
 
+    # Metrics are used by all modules, create them first
+    metrics.init_app(app)
+    loader.init_app(app)
+    mailer.init_app(app)
+    passwords.init_app(app)
+
     # Create LDAP connector
     ldap.init_app(app)
 
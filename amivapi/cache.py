@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""In-process caches and write-behind helpers.
+
+Some data is needed on (almost) every request, e.g. the session belonging to a
+token. Looking it up in the database every single time is wasteful, so we keep
+recently used entries in memory for a short time.
+
+1. TTLCache
+
+A bounded dictionary whose entries expire after a fixed time:
+
+cache = TTLCache(maxsize=1000, ttl=timedelta(minutes=1))
+cache.set('key', 'value')
+cache.get('key')  # 'value', for at most one minute
+
+If the cache is full, the least recently used entry is evicted. A `ttl` of
+`None` (or zero) disables the cache, i.e. nothing is ever stored.
+
+
+2. TimestampWriter
+
+Coalesces updates of the `_updated` field of documents which are "touched"
+very often (sessions, API keys). A document is queued for an update at most
+once per interval, and all queued updates are written in a single bulk
+operation by a background thread:
+
+writer = TimestampWriter(app, 'sessions', interval=timedelta(minutes=1))
+writer.touch(session_id, datetime.utcnow())
+
+Notes:
+Everything in here is per process. Entries cached by one process are not
+invalidated by changes made in another process (e.g. `amivapi cron`), which
+is why all cache entries expire after a short time.
+"""
+
+import atexit
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic, sleep
+from weakref import WeakSet
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+def _seconds(duration):
+    """Convert timedelta (or number) to seconds, `None` counts as 0."""
+    if duration is None:
+        return 0
+    try:
+        return duration.total_seconds()
+    except AttributeError:
+        return duration
+
+
+class TTLCache(object):
+    """Bounded, thread-safe cache with expiring entries."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = _seconds(ttl)
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        """A cache without ttl or size does not store anything."""
+        return self.ttl > 0 and self.maxsize > 0
+
+    def get(self, key, default=None):
+        """Return the cached value or `default` if missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires <= monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def set(self, key, value):
+        """Store a value, evict the least recently used entry if full."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value (even if expired)."""
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def discard_if(self, predicate):
+        """Remove all entries for which `predicate(key, value)` is True."""
+        with self._lock:
+            for key in [key for key, (_, value) in self._data.items()
+                        if predicate(key, value)]:
+                del self._data[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TimestampWriter(object):
+    """Write-behind buffer for `_updated` timestamps of a collection.
+
+    The background thread is only started when an update is queued and stops
+    again once there is nothing left to write, so apps which never touch
+    anything (e.g. the cron or CLI commands) do not keep any thread alive.
+    """
+
+    def __init__(self, app, collection, interval):
+        self.app = app
+        self.collection = collection
+        self.interval = _seconds(interval)
+
+        self._pending = {}  # _id -> time
+        self._last_touched = TTLCache(maxsize=100000, ttl=self.interval)
+        self._lock = Lock()
+        self._thread = None
+        _writers.add(self)
+
+    def touch(self, _id, time):
+        """Mark the document as updated at `time`.
+
+        Returns:
+            bool: True if an update was queued, False if the document was
+                already touched within the interval.
+        """
+        if self.interval <= 0:
+            # No coalescing, write immediately
+            self._write({_id: time})
+            return True
+
+        if _id in self._last_touched:
+            return False
+        self._last_touched.set(_id, time)
+
+        with self._lock:
+            self._pending[_id] = time
+            if self._thread is None:
+                self._start()
+        return True
+
+    def forget(self, _id):
+        """Drop a queued update, e.g. because the document was deleted."""
+        self._last_touched.pop(_id)
+        with self._lock:
+            self._pending.pop(_id, None)
+
+    def flush(self):
+        """Write all queued updates with a single bulk operation."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if pending:
+            self._write(pending)
+
+    def _write(self, updates):
+        operations = [UpdateOne({'_id': _id}, {'$set': {'_updated': time}})
+                      for _id, time in updates.items()]
+        try:
+            with self.app.app_context():
+                (self.app.data.driver.db[self.collection]
+                 .bulk_write(operations, ordered=False))
+        except PyMongoError as error:
+            # Timestamps are not critical, log and move on
+            self.app.logger.error("Could not update timestamps in '%s': %s"
+                                  % (self.collection, error))
+
+    def _start(self):
+        """Start the background flusher."""
+        self._thread = Thread(target=self._run, daemon=True,
+                              name='%s-timestamps' % self.collection)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+            with self._lock:
+                if not self._pending:
+                    # Idle, a new thread is started by the next `touch`
+                    self._thread = None
+                    return
+
+
+# Do not lose queued timestamps on shutdown
+_writers = WeakSet()
+
+
+@atexit.register
+def _flush_all_writers():
+    for writer in list(_writers):
+        writer.flush()
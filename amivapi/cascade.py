@@ -9,13 +9,40 @@ This adds an option 'cascade_delete' to data_relations in the schema. If it is
 set to true, then deleting the referenced object will also delete the
 referencing object. If false, the reference will be set to NULL, when the
 referenced object is deleted.
+
+The references between resources are collected once in `init_app`, so a
+deletion only needs to look at the resources which can actually reference
+the deleted item.
+
+All referencing items of a resource are handled with a few bulk operations
+instead of one Eve request per item:
+
+- References are removed with a single `bulk_write` per field. The update
+  hooks (`on_updated`) are run for every item afterwards.
+- Items are deleted with a single `delete_many` per field. The delete hooks
+  (`on_delete_item` and `on_deleted_item`) are run for every item, so mails,
+  counters and further cascades work as before. Resources with soft delete,
+  versioning or media are still deleted item by item with Eve.
+
+Background cascades:
+With `CASCADE_ASYNC = True`, a DELETE request only removes the item itself.
+The referencing items are handled later by `amivapi cron` in chunks of
+`CASCADE_CHUNK_SIZE`, so deleting e.g. a user with hundreds of signups does
+not run into timeouts. Relations with the option 'cascade_sync' (e.g. the
+sessions of a user) are still handled during the request.
+
+Pending cascades are stored in the `cascade_jobs` collection together with
+their progress and can be listed with `amivapi cascades`.
 """
 
+from datetime import datetime, timedelta
+
+from eve.methods.common import resolve_document_etag
 from eve.methods.delete import deleteitem_internal
-from eve.methods.patch import patch_internal
-from flask import current_app
-from werkzeug.exceptions import NotFound
+from flask import current_app, g, has_request_context
+from pymongo import ASCENDING, UpdateOne
 
+from amivapi.cron import periodic, update_scheduled_task
 from amivapi.utils import admin_permissions
 
 
@@ -25,32 +52,25 @@ def cascade_delete(resource, item):
     Hook to delete all objects, which have the 'cascade_delete' option set
     in the data_relation and relate to the object, which was just deleted.
     """
-    domain = current_app.config['DOMAIN']
-    deleted_id = item[domain[resource]['id_field']]
+    config = current_app.config
+    relations = config['cascade_relations'].get(resource)
+    if not relations:
+        return
 
-    for res, res_domain in domain.items():
-        # Filter schema of `res` to get all fields containing references
-        # to the resource of the deleted item
-        relations = ((field, field_def['data_relation'])
-                     for field, field_def in res_domain['schema'].items()
-                     if 'data_relation' in field_def and
-                     field_def['data_relation'].get('resource') == resource)
-        for field, data_relation in relations:
-            # All items in `res` with reference to the deleted item
-            lookup = {field: deleted_id}
-            with admin_permissions():
-                try:
-                    if data_relation.get('cascade_delete'):
-                        # Delete the item as well
-                        deleteitem_internal(res, concurrency_check=False,
-                                            **lookup)
-                    else:
-                        # Don't delete, only remove reference
-                        patch_internal(res, payload={field: None},
-                                       concurrency_check=False,
-                                       **lookup)
-                except NotFound:
-                    pass
+    deleted_id = item[config['DOMAIN'][resource]['id_field']]
+
+    if (config['CASCADE_ASYNC'] and has_request_context() and
+            not g.get('cascade_job')):
+        # Only sync relations now, the job takes care of the rest
+        if any(not _is_sync(*relation) for relation in relations):
+            _enqueue(resource, deleted_id)
+        relations = [relation for relation in relations
+                     if _is_sync(*relation)]
+
+    for res, field, cascade in relations:
+        # All items in `res` with reference to the deleted item
+        _cascade_items(res, field, cascade,
+                       list(_collection(res).find({field: deleted_id})))
 
 
 def cascade_delete_collection(resource, items):
@@ -59,7 +79,212 @@ def cascade_delete_collection(resource, items):
         cascade_delete(resource, item)
 
 
+def _cascade_items(resource, field, cascade, items):
+    if not items:
+        return
+
+    with admin_permissions():
+        if cascade:
+            # Delete the items as well
+            _delete_items(resource, items)
+        else:
+            # Don't delete, only remove reference
+            _remove_references(resource, field, items)
+
+
+def _is_sync(resource, field, cascade):
+    schema = current_app.config['DOMAIN'][resource]['schema']
+    return schema[field]['data_relation'].get('cascade_sync', False)
+
+
+def _collection(resource):
+    source = current_app.config['DOMAIN'][resource]['datasource']['source']
+    return current_app.data.driver.db[source]
+
+
+def _remove_references(resource, field, items):
+    """Set the field to None with a single `bulk_write`, then run hooks."""
+    config = current_app.config
+    id_field = config['DOMAIN'][resource]['id_field']
+    now = datetime.utcnow().replace(microsecond=0)
+
+    updated = []
+    for original in items:
+        changes = {field: None, config['LAST_UPDATED']: now}
+
+        # Same etag as computed by `patch_internal`
+        document = dict(original, **changes)
+        document.pop(config['ETAG'], None)
+        resolve_document_etag(document, resource)
+        changes[config['ETAG']] = document[config['ETAG']]
+
+        updated.append((changes, original))
+
+    # Only items which still reference the deleted item
+    _collection(resource).bulk_write([
+        UpdateOne({id_field: original[id_field],
+                   field: original[field]}, {'$set': changes})
+        for changes, original in updated
+    ], ordered=False)
+
+    for changes, original in updated:
+        current_app.on_updated(resource, changes, original)
+        getattr(current_app, 'on_updated_%s' % resource)(changes, original)
+
+
+def _delete_items(resource, items):
+    """Delete all items with a single `delete_many`, hooks run per item."""
+    resource_def = current_app.config['DOMAIN'][resource]
+    id_field = resource_def['id_field']
+
+    if (resource_def['soft_delete'] or resource_def['versioning'] or
+            resource_def['_media']):
+        # Eve has to take care of these
+        for item in items:
+            deleteitem_internal(resource, concurrency_check=False,
+                                original=item, **{id_field: item[id_field]})
+        return
+
+    for item in items:
+        current_app.on_delete_item(resource, item)
+        getattr(current_app, 'on_delete_item_%s' % resource)(item)
+
+    _collection(resource).delete_many(
+        {id_field: {'$in': [item[id_field] for item in items]}})
+
+    # Also cascades further, since `cascade_delete` is an `on_deleted_item`
+    # hook itself
+    for item in items:
+        current_app.on_deleted_item(resource, item)
+        getattr(current_app, 'on_deleted_item_%s' % resource)(item)
+
+
+# Background cascades
+
+
+def _enqueue(resource, deleted_id):
+    """Create a job for the references to a deleted item."""
+    current_app.data.driver.db['cascade_jobs'].insert_one({
+        'resource': resource,
+        'item': deleted_id,
+        '_created': datetime.utcnow(),
+        'total': None,  # Counted when the job starts
+        'processed': 0,
+        'error': None,
+    })
+    # Run the jobs as soon as possible instead of waiting for the next period.
+    # If the jobs are being processed right now, the new job is only picked
+    # up by the next regular run (at most a period later), since finishing
+    # the running task reschedules it.
+    update_scheduled_task(datetime.utcnow(), process_cascade_jobs)
+
+
+@periodic(timedelta(minutes=1))
+def process_cascade_jobs():
+    """Process all pending cascades chunk by chunk. Needs an app context.
+
+    Progress is stored after every chunk. The job is removed when no
+    references are left, an interrupted job continues where it stopped.
+    If a job fails, the error is stored and logged, and the next job is
+    processed. The failed job is tried again by the next run.
+
+    Every chunk runs in its own request context, since hooks like the
+    signup mails need one to build urls (like the `ldap_sync` command).
+
+    Returns:
+        int: Number of completed jobs
+    """
+    collection = current_app.data.driver.db['cascade_jobs']
+    completed = 0
+
+    for job in list(collection.find().sort('_created', ASCENDING)):
+        try:
+            while _process_chunk(job):
+                pass
+        except Exception as error:
+            current_app.logger.exception(
+                "Cascade of deleted %s '%s' failed"
+                % (job['resource'], job['item']))
+            collection.update_one({'_id': job['_id']},
+                                  {'$set': {'error': repr(error)}})
+            continue
+        collection.delete_one({'_id': job['_id']})
+        completed += 1
+
+    return completed
+
+
+def _process_chunk(job):
+    """Handle the next `CASCADE_CHUNK_SIZE` references of a job.
+
+    Returns:
+        int: Number of handled items, 0 if the job is complete.
+    """
+    relations = [relation for relation in
+                 current_app.config['cascade_relations'][job['resource']]
+                 if not _is_sync(*relation)]
+    lookup = {'_id': job['_id']}
+
+    app = current_app._get_current_object()
+    with app.app_context(), app.test_request_context():
+        # Cascade everything right away, don't create new jobs
+        g.cascade_job = True
+        return _cascade_chunk(job, relations, lookup)
+
+
+def _cascade_chunk(job, relations, lookup):
+    if job['total'] is None:
+        job['total'] = sum(_collection(res).count_documents(
+            {field: job['item']}) for res, field, _ in relations)
+        current_app.data.driver.db['cascade_jobs'].update_one(
+            lookup, {'$set': {'total': job['total']}})
+
+    for res, field, cascade in relations:
+        items = list(_collection(res).find({field: job['item']}).limit(
+            current_app.config['CASCADE_CHUNK_SIZE']))
+        if items:
+            _cascade_items(res, field, cascade, items)
+            job['processed'] += len(items)
+            current_app.data.driver.db['cascade_jobs'].update_one(
+                lookup, {'$inc': {'processed': len(items)},
+                         '$set': {'_updated': datetime.utcnow()}})
+            return len(items)
+
+    return 0
+
+
+def pending_cascades():
+    """List all pending cascades, oldest first. Needs an app context."""
+    return list(current_app.data.driver.db['cascade_jobs'].find().sort(
+        '_created', ASCENDING))
+
+
+def _reverse_relations(domain):
+    """Find all references between resources.
+
+    References which are neither deleted nor nullable are left alone.
+
+    Returns:
+        dict: For every referenced resource a list of
+            (referencing resource, field, cascade_delete)
+    """
+    relations = {}
+    for res, res_domain in domain.items():
+        for field, field_def in res_domain['schema'].items():
+            data_relation = field_def.get('data_relation')
+            if not data_relation or 'resource' not in data_relation:
+                continue
+            cascade = bool(data_relation.get('cascade_delete'))
+            if not cascade and not field_def.get('nullable'):
+                continue  # Reference can't be removed, keep it
+            relations.setdefault(data_relation['resource'], []).append(
+                (res, field, cascade))
+    return relations
+
+
 def init_app(app):
-    """Add hooks to app."""
+    """Collect references and add hooks to app."""
+    app.config['cascade_relations'] = _reverse_relations(app.config['DOMAIN'])
+
     app.on_deleted_item += cascade_delete
     app.on_deleted += cascade_delete_collection
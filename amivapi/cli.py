@@ -12,9 +12,13 @@ from time import sleep
 from click import argument, echo, group, option, Path, Choice, ClickException
 
 from amivapi.bootstrap import create_app
-from amivapi.cron import run_scheduled_tasks
+from amivapi.cascade import pending_cascades, process_cascade_jobs
+from amivapi.cron import run_scheduled_tasks, task_run_stats, wait_for_tasks
+from amivapi.events.counters import recount_signups
 from amivapi import ldap
-from amivapi.groups.mailing_lists import updated_group
+from amivapi.groups.mailing_lists import update_files, update_queued_files
+from amivapi.indexes import ensure_indexes as ensure_mongo_indexes
+from amivapi.mailer import send_queued_mails
 
 try:
     import bjoern
@@ -41,7 +45,7 @@ def recreate_mailing_lists(config):
 
     2. Create new mailing list files.
 
-    For every group, we call the update_group function for this
+    The content of all lists is computed with a single database query.
     """
     app = create_app(config_file=config)
     directory = app.config.get('MAILING_LIST_DIR')
@@ -57,11 +61,91 @@ def recreate_mailing_lists(config):
             if filename.startswith(prefix):
                 remove(join(directory, filename))
 
-    # Create new files
+    # Create new files, the content of all files must be written again
     with app.app_context():
-        groups = app.data.driver.db['groups'].find({})
-        for g in groups:
-            updated_group(g, g)  # Use group as update and original
+        app.data.driver.db['mailing_lists'].delete_many({})
+        written = update_files()
+
+    echo("Created %i mailing list files." % written)
+
+
+@cli.command()
+@config_option
+@option("--check", is_flag=True,
+        help="Only report, do not create missing indexes.")
+def ensure_indexes(config, check):
+    """Create and verify MongoDB indexes.
+
+    Creates all missing indexes (unless --check is used) and reports indexes
+    which are missing, have not been used according to `$indexStats` or are
+    not declared by the API.
+
+    Useful together with `MONGO_INDEXES_ON_STARTUP = False`, which prevents
+    the API from building indexes when it starts.
+    """
+    app = create_app(config_file=config)
+
+    with app.app_context():
+        report = ensure_mongo_indexes(app, create=not check)
+
+    for collection, result in report.items():
+        for name in result['created']:
+            echo("%s: created index '%s'." % (collection, name))
+        for name in result['missing']:
+            echo("%s: index '%s' is missing!" % (collection, name))
+        for name, since in sorted(result['unused'].items()):
+            echo("%s: index '%s' has not been used since %s."
+                 % (collection, name, since))
+        for name in result['undeclared']:
+            echo("%s: index '%s' is not declared by the API."
+                 % (collection, name))
+
+    if any(result['missing'] for result in report.values()):
+        raise ClickException("Some indexes are missing.")
+
+
+@cli.command()
+@config_option
+def repair_signup_counts(config):
+    """Recompute the signup counters of all events.
+
+    The counters are updated whenever signups change, this is only needed
+    if they are out of sync, e.g. for events created by older versions.
+    """
+    app = create_app(config_file=config)
+
+    with app.app_context():
+        modified = recount_signups()
+
+    echo("Repaired signup counts of %i events." % modified)
+
+
+@cli.command()
+@config_option
+@option("--process", is_flag=True,
+        help="Process all pending cascades now.")
+def cascades(config, process):
+    """List pending cascades of deleted items (see `CASCADE_ASYNC`)."""
+    app = create_app(config_file=config)
+
+    with app.app_context():
+        if process:
+            completed = process_cascade_jobs()
+            echo("Completed %i cascades." % completed)
+        jobs = pending_cascades()
+
+    if not jobs:
+        echo("No pending cascades.")
+        return
+
+    echo("%-12s %-24s %-19s %11s  %s" % (
+        'Resource', 'Deleted item', 'Created', 'Progress', 'Error'))
+    for job in jobs:
+        total = '?' if job['total'] is None else job['total']
+        echo("%-12s %-24s %-19s %11s  %s" % (
+            job['resource'], job['item'],
+            job['_created'].isoformat(timespec='seconds'),
+            '%s/%s' % (job['processed'], total), job['error'] or ''))
 
 
 def run_cron(app):
@@ -69,26 +153,45 @@ def run_cron(app):
     echo("Executing scheduled tasks...")
     with app.app_context():
         run_scheduled_tasks()
+        send_queued_mails()
 
 
 @cli.command()
 @config_option
 @option("--continuous", is_flag=True,
         help="If set, continue running in a loop.")
-def cron(config, continuous):
+@option("--flush-mailing-lists", is_flag=True,
+        help="Only update the mailing lists of all queued groups now.")
+@option("--stats", is_flag=True,
+        help="Only show run times of all tasks and exit.")
+def cron(config, continuous, flush_mailing_lists, stats):
     """Run scheduled tasks.
 
-    Use --continuous to keep running and execute tasks periodically.
+    Use --continuous to keep running and execute tasks when they are due
+    (but at least every `CRON_INTERVAL`).
     """
     app = create_app(config_file=config)
 
-    if not continuous:
+    if stats:
+        with app.app_context():
+            summary = task_run_stats()
+        echo("%-60s %6s %6s %9s %9s  %s" % (
+            'Function', 'Runs', 'Errors', 'p50 [s]', 'p95 [s]', 'Last run'))
+        for row in summary:
+            echo("%-60s %6i %6i %9.3f %9.3f  %s" % (
+                row['function'], row['runs'], row['errors'], row['p50'],
+                row['p95'], row['last_run'].isoformat(timespec='seconds')))
+    elif flush_mailing_lists:
+        with app.app_context():
+            updated = update_queued_files()
+        echo("Updated mailing lists of %i groups." % updated)
+    elif not continuous:
         run_cron(app)
     else:
         interval = app.config['CRON_INTERVAL']
 
-        echo('Running scheduled tasks periodically (every %i seconds).'
-             % interval.total_seconds())
+        echo('Running scheduled tasks when they are due (at least every %i '
+             'seconds).' % interval.total_seconds())
 
         while True:
             checkpoint = dt.utcnow()
@@ -97,10 +200,36 @@ def cron(config, continuous):
             echo('Tasks executed, total execution time: %.3f seconds.'
                  % execution_time.total_seconds())
 
-            if execution_time > interval:
-                echo('Warning: Execution time exceeds interval length.')
+            with app.app_context():
+                wait_for_tasks(interval)
+
+
+@cli.command()
+@config_option
+@option("--continuous", is_flag=True,
+        help="If set, continue running in a loop.")
+def mailer(config, continuous):
+    """Send queued mails.
+
+    Use --continuous to keep running and check the queue periodically
+    (every `MAIL_QUEUE_INTERVAL`).
+    """
+    app = create_app(config_file=config)
+
+    with app.app_context():
+        sent = send_queued_mails()
+        echo("Sent %i mails." % sent)
+
+        if continuous:
+            interval = app.config['MAIL_QUEUE_INTERVAL'].total_seconds()
+            echo('Sending queued mails (checking every %i seconds).'
+                 % interval)
 
-            sleep((interval - execution_time).total_seconds())
+            while True:
+                sleep(interval)
+                sent = send_queued_mails()
+                if sent:
+                    echo("Sent %i mails." % sent)
 
 
 @cli.command()
@@ -123,7 +252,9 @@ def ldap_sync(config, sync_all, nethz):
         with app.test_request_context():
             if sync_all:
                 res = ldap.sync_all()
-                echo("Synchronized %i users." % len(res))
+                echo("Synchronized %i users: %i created, %i updated, "
+                     "%i unchanged." % (sum(res.values()), res['created'],
+                                        res['updated'], res['unchanged']))
             else:
                 for user in nethz:
                     if ldap.sync_one(user) is not None:
@@ -20,7 +20,16 @@ Now you can schedule the task to be executed at a specific time:
 schedule_task(datetime(2012, 12, 21, 12, 0, 0), end_of_world,
               "Maya's calendar ran out of paper or something")
 
-This is of course possible multiple times.
+This is of course possible multiple times. To replace a previously
+scheduled task instead, provide a key:
+
+schedule_task(datetime(2012, 12, 21, 12, 0, 0), end_of_world,
+              "Postponed", key='end-of-world')
+
+Arguments are stored as BSON if possible, i.e. they should consist of
+dicts, lists, strings, numbers, datetimes, ObjectIds, etc. Tuples are
+converted to lists. Other arguments are pickled, which breaks easily if the
+code changes, so better avoid them. The format is stored in `args_format`.
 
 
 2. Periodic tasks
@@ -34,6 +43,28 @@ def weekly_hello(name):
 The first execution will happen the first time the scheduler is run.
 
 
+3. Execution
+
+Tasks are executed by `run_scheduled_tasks` (`amivapi cron`) with
+`CRON_WORKERS` threads. Before a task is executed, it is leased for
+`CRON_LEASE`, so several cron processes can share the tasks. A task is only
+removed after it has been executed successfully. If a worker crashes, the
+task is executed again after the lease has expired. Tasks raising an
+exception are retried as well, up to `CRON_MAX_ATTEMPTS` times.
+
+Periodic tasks are not retried, instead they are rescheduled for the next
+period.
+
+Every execution is logged in `scheduled_task_runs` (start, duration and
+outcome) for `CRON_RUN_LOG_TTL`. `amivapi cron --stats` shows a summary.
+
+Between executions, `amivapi cron --continuous` sleeps until the next task
+is due (see `wait_for_tasks`). If a task is scheduled earlier in the
+meantime, it wakes up early. This uses a MongoDB change stream, which
+requires a replica set. Otherwise, the next task is checked every
+`CRON_POLL_INTERVAL`.
+
+
 Notes:
 For all kind of scheduled tasks an app context is available, but no request
 context. If you need a request context, you can use the flask test client.
@@ -46,11 +77,24 @@ run every day at the same time, but will drift into the future slowly. This
 might sum up to a missing period, so after a year the function might have been
 called only 364 times.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
+from math import ceil
+from os import getpid
 import pickle
+from socket import gethostname
+from threading import get_ident
+from time import monotonic, sleep
 
+import bson
+from bson import ObjectId
+from bson.errors import InvalidDocument
 from flask import current_app
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from amivapi.indexes import register_indexes
 
 
 #
@@ -80,9 +124,10 @@ def periodic(period, *args):
     def wrap(func):
         @wraps(func)
         def wrapped():
-            schedule_task(datetime.utcnow() + period, wrapped)
-            func(*args)
+            # The next execution is scheduled by `run_scheduled_tasks`
+            return func(*args)
 
+        wrapped.period = period
         schedulable(wrapped)
 
         # if init_app has already run, schedule the first execution
@@ -96,19 +141,31 @@ def periodic(period, *args):
     return wrap
 
 
-def schedule_task(time, func, *args):
-    """ Schedule a task at some point in the future. """
+def schedule_task(time, func, *args, key=None):
+    """ Schedule a task at some point in the future.
+
+    If a key is given, a previously scheduled task with the same key is
+    replaced.
+    """
     func_s = func_str(func)
 
     if func_s not in schedulable_functions:
         raise NotSchedulable("%s is not schedulable. Did you forget the "
                              "@schedulable decorator?" % func.__name__)
 
-    current_app.data.driver.db['scheduled_tasks'].insert_one({
-        'time': time,
-        'function': func_s,
-        'args': pickle.dumps(args)
-    })
+    collection = current_app.data.driver.db['scheduled_tasks']
+    task = dict(time=time, function=func_s, **_encode_args(args))
+
+    if key is None:
+        collection.insert_one(task)
+        return
+
+    update = {'$set': task, '$unset': _LEASE_FIELDS}
+    try:
+        collection.update_one({'key': key}, update, upsert=True)
+    except DuplicateKeyError:
+        # Inserted by someone else in the meantime, replace it
+        collection.update_one({'key': key}, update)
 
 
 def update_scheduled_task(time, func, *args):
@@ -122,10 +179,7 @@ def update_scheduled_task(time, func, *args):
     current_app.data.driver.db['scheduled_tasks'].update_one({
         'function': func_s
     },
-        {'$set': {
-                 'time': time,
-                 'args': pickle.dumps(args)
-        }})
+        {'$set': dict(time=time, **_encode_args(args))})
 
 
 def schedule_once_soon(func, *args):
@@ -145,6 +199,31 @@ def schedule_once_soon(func, *args):
 schedulable_functions = {}
 periodic_functions = []
 
+# Formats of task arguments
+ARGS_PICKLE = 1  # Tasks without `args_format` are pickled as well
+ARGS_BSON = 2
+
+_LEASE_FIELDS = {'lease': '', 'owner': '', 'lease_until': '', 'attempts': ''}
+
+
+def _encode_args(args):
+    """Store arguments as BSON if possible, pickle them otherwise."""
+    args = list(args)
+    try:
+        bson.encode({'args': args})
+    except (InvalidDocument, OverflowError):
+        return {'args': pickle.dumps(tuple(args)), 'args_format': ARGS_PICKLE}
+    return {'args': args, 'args_format': ARGS_BSON}
+
+
+def _decode_args(task):
+    args_format = task.get('args_format', ARGS_PICKLE)
+    if args_format == ARGS_PICKLE:
+        return pickle.loads(task['args'])
+    if args_format == ARGS_BSON:
+        return task['args']
+    raise ValueError("Unknown format of task arguments: %s" % args_format)
+
 
 def func_str(func):
     """ Return a string describing the function """
@@ -154,21 +233,222 @@ def func_str(func):
 def run_scheduled_tasks():
     """ Check for scheduled task, which have passed the deadline and run them.
     This needs an app context.
+
+    With `CRON_WORKERS` > 1, tasks are executed in parallel threads.
     """
-    while True:
-        task = (current_app.data.driver.db['scheduled_tasks']
-                .find_one_and_delete(
-                    {'time': {'$lte': datetime.utcnow()}}))
+    workers = current_app.config['CRON_WORKERS']
+    if workers <= 1:
+        _work()
+        return
+
+    app = current_app._get_current_object()
 
+    def _work_with_context():
+        with app.app_context():
+            _work()
+
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='cron') as executor:
+        futures = [executor.submit(_work_with_context)
+                   for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+
+def next_due():
+    """Return the time when the next task is due, None if there are no tasks.
+
+    For leased tasks, this is the time when the lease expires.
+    """
+    collection = current_app.data.driver.db['scheduled_tasks']
+    now = datetime.utcnow()
+
+    free = collection.find_one({'lease_until': {'$not': {'$gt': now}}},
+                               projection={'time': True},
+                               sort=[('time', ASCENDING)])
+    leased = collection.find_one({'lease_until': {'$gt': now}},
+                                 projection={'lease_until': True},
+                                 sort=[('lease_until', ASCENDING)])
+
+    times = ([free['time']] if free else []) + \
+        ([leased['lease_until']] if leased else [])
+    return min(times) if times else None
+
+
+def wait_for_tasks(timeout):
+    """Sleep until the next task is due, but at most `timeout`.
+
+    Wakes up early if a task is scheduled earlier in the meantime.
+    This needs an app context.
+
+    Args:
+        timeout (timedelta): Maximum time to sleep
+    """
+    collection = current_app.data.driver.db['scheduled_tasks']
+    poll_interval = current_app.config['CRON_POLL_INTERVAL'].total_seconds()
+    deadline = datetime.utcnow() + timeout
+
+    def _wake_time():
+        due = next_due()
+        return deadline if due is None else min(due, deadline)
+
+    try:
+        # Changes are awaited on the server for at most one second
+        stream = collection.watch(
+            [{'$match': {'operationType': {'$in': ['insert', 'update',
+                                                   'replace']}}}],
+            max_await_time_ms=1000)
+    except PyMongoError:
+        stream = None  # Not supported, e.g. no replica set
+
+    try:
+        wake_time = _wake_time()
+        while True:
+            remaining = (wake_time - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                return
+
+            if stream is None:
+                sleep(min(remaining, poll_interval))
+                wake_time = _wake_time()
+                continue
+
+            try:
+                if stream.try_next() is not None:
+                    wake_time = _wake_time()
+            except PyMongoError:
+                stream.close()
+                stream = None
+    finally:
+        if stream is not None:
+            stream.close()
+
+
+def _work():
+    """Execute due tasks until there are none left."""
+    while True:
+        task = _claim()
         if task is None:
             return
+        _execute(task)
+
+
+def _claim():
+    """Lease the next task that is due (and not leased by another worker)."""
+    now = datetime.utcnow()
+    return current_app.data.driver.db['scheduled_tasks'].find_one_and_update(
+        {'time': {'$lte': now}, 'lease_until': {'$not': {'$gt': now}}},
+        {'$set': {'lease': ObjectId(),
+                  'owner': '%s:%i:%i' % (gethostname(), getpid(), get_ident()),
+                  'lease_until': now + current_app.config['CRON_LEASE']},
+         '$inc': {'attempts': 1}},
+        sort=[('time', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def _execute(task):
+    """Run a leased task, then remove or reschedule it."""
+    collection = current_app.data.driver.db['scheduled_tasks']
+    lease = {'_id': task['_id'], 'lease': task['lease']}
+    func = schedulable_functions.get(task['function'])
+    period = getattr(func, 'period', None)
+    start = datetime.utcnow()
+    clock = monotonic()
+
+    try:
+        if func is None:
+            raise NotSchedulable("Unknown function %s" % task['function'])
+        func(*_decode_args(task))
+    except Exception as error:
+        _log_run(task, start, monotonic() - clock, error)
+        current_app.logger.exception(
+            "Scheduled task '%s' failed (attempt %i)"
+            % (task['function'], task['attempts']))
+        if (period is None and
+                task['attempts'] < current_app.config['CRON_MAX_ATTEMPTS']):
+            return  # Retried when the lease expires
+    else:
+        _log_run(task, start, monotonic() - clock)
+
+    if period is None:
+        collection.delete_one(lease)
+    else:
+        collection.update_one(lease, {
+            '$set': {'time': datetime.utcnow() + period},
+            '$unset': _LEASE_FIELDS,
+        })
+
+
+def _log_run(task, start, duration, error=None):
+    current_app.data.driver.db['scheduled_task_runs'].insert_one({
+        'task': task['_id'],
+        'function': task['function'],
+        'key': task.get('key'),
+        'owner': task['owner'],
+        'attempt': task['attempts'],
+        'start': start,
+        'duration': duration,
+        'outcome': 'success' if error is None else 'error',
+        'error': None if error is None else repr(error),
+    })
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    return values[max(ceil(len(values) * percent / 100) - 1, 0)]
+
 
-        args = pickle.loads(task['args'])
-        func = schedulable_functions[task['function']]
-        func(*args)
+def task_run_stats():
+    """Summarize the logged executions for every function.
+
+    Needs an app context.
+
+    Returns:
+        list: dicts with `function`, number of `runs` and `errors`, the time
+            of the `last_run` and the `p50` and `p95` run times (seconds)
+    """
+    summaries = current_app.data.driver.db['scheduled_task_runs'].aggregate([
+        {'$group': {
+            '_id': '$function',
+            'durations': {'$push': '$duration'},
+            'errors': {'$sum': {'$cond': [{'$eq': ['$outcome', 'error']},
+                                          1, 0]}},
+            'last_run': {'$max': '$start'},
+        }},
+        {'$sort': {'_id': 1}},
+    ])
+
+    stats = []
+    for summary in summaries:
+        durations = sorted(summary['durations'])
+        stats.append({
+            'function': summary['_id'],
+            'runs': len(durations),
+            'errors': summary['errors'],
+            'last_run': summary['last_run'],
+            'p50': _percentile(durations, 50),
+            'p95': _percentile(durations, 95),
+        })
+    return stats
 
 
 def init_app(app):
+    register_indexes(app, 'scheduled_tasks', {
+        'time': ([('time', 1)], {'background': True}),
+        'function': ([('function', 1)], {'background': True}),
+        'lease_until': ([('lease_until', 1)],
+                        {'background': True, 'sparse': True}),
+        'key': ([('key', 1)],
+                {'background': True, 'unique': True, 'sparse': True}),
+    })
+    register_indexes(app, 'scheduled_task_runs', {
+        'start': ([('start', 1)], {
+            'background': True,
+            'expireAfterSeconds': int(
+                app.config['CRON_RUN_LOG_TTL'].total_seconds()),
+        }),
+    })
+
     # Periodic functions: If no execution is scheduled so far, schedule one
     with app.app_context():  # this is needed to run db queries
         for func in periodic_functions:
@@ -10,6 +10,15 @@ logic needed for signup of non members to events.
 
 
 from amivapi.events.authorization import EventAuthValidator
+from amivapi.events.counters import (
+    add_missing_signup_counts_on_startup,
+    add_signup_count_to_event,
+    add_signup_count_to_event_collection,
+    add_signup_counts_before_insert,
+    count_signup_after_delete,
+    count_signup_after_update,
+    count_signups_after_insert
+)
 from amivapi.events.emails import (
     send_confirmmail_to_unregistered_users,
     notify_signup_deleted
@@ -25,23 +34,25 @@ from amivapi.events.projections import (
     add_position_to_signup,
     add_position_to_signup_collection,
     add_position_to_signup_on_inserted,
-    add_signup_count_to_event,
-    add_signup_count_to_event_collection
+    invalidate_signup_positions
 )
 from amivapi.events.queue import (
     add_accepted_before_insert,
     notify_users_after_update,
     update_waiting_list_after_delete,
+    update_waiting_list_after_event_update,
     update_waiting_list_after_insert,
 )
 from amivapi.events.validation import EventValidator
 from amivapi.events.utils import create_token_secret_on_startup
+from amivapi.cache import TTLCache
 from amivapi.utils import register_domain, register_validator
 
 
 def init_app(app):
     """Register resources and blueprints, add hooks and validation."""
     create_token_secret_on_startup(app)
+    add_missing_signup_counts_on_startup(app)
 
     register_domain(app, eventdomain)
     register_validator(app, EventValidator)
@@ -52,11 +63,17 @@ def init_app(app):
     app.on_fetched_item_eventsignups += add_email_to_signup
 
     # Show user's position in the signup list
+    app.config['signup_position_cache'] = TTLCache(
+        maxsize=app.config['SIGNUP_POSITION_CACHE_SIZE'],
+        ttl=app.config['SIGNUP_POSITION_CACHE_TTL'])
+    app.on_inserted_eventsignups += invalidate_signup_positions
+    app.on_deleted_item_eventsignups += invalidate_signup_positions
     app.on_fetched_resource_eventsignups += add_position_to_signup_collection
     app.on_fetched_item_eventsignups += add_position_to_signup
     app.on_inserted_eventsignups += add_position_to_signup_on_inserted
 
-    # Show signup count in events
+    # Signup count in events
+    app.on_insert_events += add_signup_counts_before_insert
     app.on_fetched_resource_events += add_signup_count_to_event_collection
     app.on_fetched_item_events += add_signup_count_to_event
 
@@ -68,6 +85,11 @@ def init_app(app):
     # Auto accept registrations for fcfs system
     app.on_insert_eventsignups += add_accepted_before_insert
 
+    # Count signups, must happen before the waiting list is updated
+    app.on_inserted_eventsignups += count_signups_after_insert
+    app.on_updated_eventsignups += count_signup_after_update
+    app.on_deleted_item_eventsignups += count_signup_after_delete
+
     # Update waiting list after insert or delete of signups
     app.on_inserted_eventsignups += update_waiting_list_after_insert
     app.on_deleted_item_eventsignups += notify_signup_deleted
@@ -76,4 +98,7 @@ def init_app(app):
     # Notify users on manual updates
     app.on_updated_eventsignups += notify_users_after_update
 
+    # More spots or a different selection strategy may empty the waiting list
+    app.on_updated_events += update_waiting_list_after_event_update
+
     app.register_blueprint(email_blueprint)
@@ -9,6 +9,7 @@ from bson import ObjectId
 from flask import g, current_app, request
 from datetime import datetime as dt
 from amivapi.auth import AmivTokenAuth
+from amivapi.loader import load
 from amivapi.utils import get_id
 
 
@@ -45,8 +46,7 @@ class EventSignupAuth(AmivTokenAuth):
             event = item['event']
         else:
             # Event is not embedded, get the event first
-            lookup = {current_app.config['ID_FIELD']: item['event']}
-            event = current_app.data.find_one('events', None, **lookup)
+            event = load('events', item['event'])
 
         # Remove tzinfo to compare to utcnow (API only accepts UTC anyways)
         time_register_start = event['time_register_start'].replace(tzinfo=None)
@@ -92,18 +92,17 @@ class EventAuthValidator(object):
             if g.resource_admin or value is None:
                 return
 
-            id_field = current_app.config['ID_FIELD']
             # If PATCH, then event_id will not be provided, we have to find it
             if request.method == 'PATCH':
-                lookup = {id_field: self.persisted_document['event']}
+                event_id = self.persisted_document['event']
             elif 'event' in self.document:
-                lookup = {id_field: self.document['event']}
+                event_id = self.document['event']
             else:
                 # No event provided, the `required` validator of the event field
                 # will complain, but we can't continue here
                 return
 
-            event = current_app.data.find_one('events', None, **lookup)
+            event = load('events', event_id)
 
             if (g.get('current_user') != str(event['moderator'])
                     and g.get('current_user') != str(value)):
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Signup counters of events.
+
+`signup_count` and `unaccepted_count` are stored in the event and updated
+atomically (with `$inc`) whenever signups are created, accepted or deleted.
+This way, no signups need to be counted when events are fetched, and the
+waiting list can allocate spots atomically (see `amivapi.events.queue`).
+
+Events created before the counters existed get them when the API starts
+(see `add_missing_signup_counts_on_startup`). If the counters are ever out of
+sync, they can be recomputed with `amivapi repair-signup-counts`.
+"""
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from amivapi.loader import invalidate
+
+
+def update_signup_counts(event_id, accepted=0, unaccepted=0):
+    """Atomically change the signup counters of an event."""
+    if accepted or unaccepted:
+        current_app.data.driver.db['events'].update_one(
+            {'_id': event_id},
+            {'$inc': {'signup_count': accepted,
+                      'unaccepted_count': unaccepted}})
+        invalidate('events', event_id)
+
+
+def _count_signup(signup, direction):
+    if signup.get('accepted'):
+        update_signup_counts(signup['event'], accepted=direction)
+    else:
+        update_signup_counts(signup['event'], unaccepted=direction)
+
+
+def add_signup_counts_before_insert(items):
+    """New events have no signups yet."""
+    for item in items:
+        item['signup_count'] = 0
+        item['unaccepted_count'] = 0
+
+
+def count_signups_after_insert(signups):
+    """Count new signups.
+
+    Must run before the waiting list is updated, which moves signups from
+    `unaccepted_count` to `signup_count` when it accepts them.
+    """
+    for signup in signups:
+        _count_signup(signup, 1)
+
+
+def count_signup_after_update(updates, original):
+    """Move manually (un-)accepted signups to the respective counter."""
+    if ('accepted' in updates and
+            bool(updates['accepted']) != bool(original.get('accepted'))):
+        direction = 1 if updates['accepted'] else -1
+        update_signup_counts(original['event'],
+                             accepted=direction, unaccepted=-direction)
+
+
+def count_signup_after_delete(signup):
+    """Remove a deleted signup from the counters."""
+    _count_signup(signup, -1)
+
+
+def recount_signups(event_ids=None):
+    """Recompute the counters of events with a single aggregation.
+
+    Needs an app context.
+
+    Args:
+        event_ids (list): Only recount these events, all events if None.
+
+    Returns:
+        int: Number of modified events
+    """
+    db = current_app.data.driver.db
+    signups = {} if event_ids is None else {'event': {'$in': event_ids}}
+
+    counts = list(db['eventsignups'].aggregate([
+        {'$match': signups},
+        {'$group': {
+            '_id': '$event',
+            'signup_count': {'$sum': {'$cond': ['$accepted', 1, 0]}},
+            'unaccepted_count': {'$sum': {'$cond': ['$accepted', 0, 1]}},
+        }},
+    ]))
+    modified = 0
+
+    if counts:
+        operations = [UpdateOne({'_id': count['_id']},
+                                {'$set': {
+                                    'signup_count': count['signup_count'],
+                                    'unaccepted_count':
+                                        count['unaccepted_count'],
+                                }})
+                      for count in counts]
+        modified += db['events'].bulk_write(operations,
+                                            ordered=False).modified_count
+
+    # Events without any signups
+    events = {'$nin': [count['_id'] for count in counts]}
+    if event_ids is not None:
+        events['$in'] = event_ids
+    modified += db['events'].update_many(
+        {'_id': events},
+        {'$set': {'signup_count': 0, 'unaccepted_count': 0}}).modified_count
+
+    return modified
+
+
+def add_missing_signup_counts_on_startup(app):
+    """Count the signups of events which have no counters yet.
+
+    The counters are incremented with `$inc`, which would start at 0 for
+    events created by older versions, so they must exist beforehand.
+    """
+    with app.app_context():  # Context for db connection
+        missing = app.data.driver.db['events'].distinct(
+            '_id', {'$or': [{'signup_count': {'$exists': False}},
+                            {'unaccepted_count': {'$exists': False}}]})
+        if missing:
+            recount_signups(missing)
+            app.logger.info("Counted signups of %i events." % len(missing))
+
+
+def add_signup_count_to_event(item):
+    """The counters are stored in the event, only add missing defaults."""
+    item.setdefault('signup_count', 0)
+    item.setdefault('unaccepted_count', 0)
+
+
+def add_signup_count_to_event_collection(items):
+    for item in items['_items']:
+        add_signup_count_to_event(item)
@@ -15,6 +15,7 @@ from itsdangerous import BadSignature, URLSafeSerializer
 
 from amivapi.events.queue import update_waiting_list
 from amivapi.events.utils import get_token_secret
+from amivapi.loader import load
 
 email_blueprint = Blueprint('emails', __name__)
 
@@ -48,8 +49,7 @@ def on_confirm_email(token):
 
     # Now the user may be able to get accepted, so update the events waiting
     # list
-    lookup = {current_app.config['ID_FIELD']: signup_id}
-    signup = current_app.data.find_one('eventsignups', None, **lookup)
+    signup = load('eventsignups', signup_id)
 
     update_waiting_list(signup['event'])
 
@@ -11,16 +11,20 @@ from flask import current_app, url_for
 from itsdangerous import URLSafeSerializer
 
 from amivapi.events.utils import get_token_secret
-from amivapi.utils import mail_from_template, get_calendar_invite
+from amivapi.loader import load
+from amivapi.utils import (
+    find_user,
+    get_calendar_invite,
+    mail_from_template,
+    mail_many,
+    render_mail,
+)
 
 
 def find_reply_to_email(event):
     """Get the moderator or default event mailing reply-to email address."""
-    id_field = current_app.config['ID_FIELD']
-
     if event['moderator'] is not None:
-        lookup = {id_field: event['moderator']}
-        moderator = current_app.data.find_one('users', None, **lookup)
+        moderator = find_user(event['moderator'], fields=['email'])
 
         if moderator is not None:
             return moderator['email']
@@ -32,13 +36,16 @@ def notify_signup_accepted(
         event,
         signup,
         waiting_list=False,
-        spots_available=False):
-    """Send an email to a user that his signup was accepted"""
+        spots_available=False,
+        user=None):
+    """Send an email to a user that his signup was accepted
+
+    The user of the signup can be provided if it has been fetched already.
+    """
     id_field = current_app.config['ID_FIELD']
 
     if signup.get('user'):
-        lookup = {id_field: signup['user']}
-        user = current_app.data.find_one('users', None, **lookup)
+        user = user or find_user(signup['user'])
         name = user['firstname']
         email = user['email']
     else:
@@ -69,6 +76,10 @@ def notify_signup_accepted(
 
     reply_to_email = find_reply_to_email(event)
 
+    # Everything but name and link is the same for all signups of the event,
+    # render it only once per revision of the event
+    cache_key = (event_id, event['_etag']) if event.get('_etag') else None
+
     # Time is a required property for ics calendar events
     if time_start:
         calendar_invite = (
@@ -83,7 +94,7 @@ def notify_signup_accepted(
                 signup_additional_info=(signup_additional_info_en or
                                         signup_additional_info_de or
                                         ''),
-            )))
+            ), cache_key=cache_key))
     else:
         calendar_invite = None
 
@@ -95,9 +106,10 @@ def notify_signup_accepted(
                         % (title_en or title_de),
                 template_name='events_waitingListManual',
                 template_args=dict(
-                    name=name,
                     title_en=(title_en or title_de),
                     title_de=(title_de or title_en)),
+                recipient_args=dict(name=name),
+                cache_key=cache_key,
                 reply_to=reply_to_email)
         else:
             mail_from_template(
@@ -106,9 +118,10 @@ def notify_signup_accepted(
                         % (title_en or title_de),
                 template_name='events_waitingList',
                 template_args=dict(
-                    name=name,
                     title_en=(title_en or title_de),
                     title_de=(title_de or title_en)),
+                recipient_args=dict(name=name),
+                cache_key=cache_key,
                 reply_to=reply_to_email)
     else:
         mail_from_template(
@@ -117,26 +130,23 @@ def notify_signup_accepted(
                     % (title_en or title_de),
             template_name='events_accept',
             template_args=dict(
-                name=name,
                 title_en=(title_en or title_de),
                 title_de=(title_de or title_en),
-                link=deletion_link,
                 signup_additional_info_en=(signup_additional_info_en or
                                            signup_additional_info_de),
                 signup_additional_info_de=(signup_additional_info_de or
                                            signup_additional_info_en),
                 deadline=event['time_deregister_end']),
+            recipient_args=dict(name=name, link=deletion_link),
+            cache_key=cache_key,
             reply_to=reply_to_email,
             calendar_invite=calendar_invite)
 
 
 def notify_signup_deleted(signup):
     """Send an email to a user that his signup was deleted"""
-    id_field = current_app.config['ID_FIELD']
-
     if signup.get('user'):
-        lookup = {id_field: signup['user']}
-        user = current_app.data.find_one('users', None, **lookup)
+        user = find_user(signup['user'])
         if user is None:  # User was deleted
             return
         name = user['firstname']
@@ -145,9 +155,7 @@ def notify_signup_deleted(signup):
         name = 'Guest of AMIV'
         email = signup['email']
 
-    event = current_app.data.find_one(
-        'events', None,
-        **{current_app.config['ID_FIELD']: signup['event']})
+    event = load('events', signup['event'])
 
     if current_app.config.get('SERVER_NAME') is None:
         current_app.logger.warning("SERVER_NAME is not set. E-Mail links "
@@ -175,11 +183,10 @@ def send_confirmmail_to_unregistered_users(items):
     Args:
         item: The item, which was just inserted into the database
     """
+    mails = []
     for item in items:
         if item.get('user') is None:
-            event = current_app.data.find_one(
-                'events', None,
-                **{current_app.config['ID_FIELD']: item['event']})
+            event = load('events', item['event'])
 
             title_en = event.get('title_en')
             title_de = event.get('title_de')
@@ -196,7 +203,7 @@ def send_confirmmail_to_unregistered_users(items):
 
             reply_to_email = find_reply_to_email(event)
 
-            mail_from_template(
+            mails.append(render_mail(
                 to=[item['email']],
                 subject='Registration for %s' % (title_en or title_de),
                 template_name='events_confirm',
@@ -204,4 +211,6 @@ def send_confirmmail_to_unregistered_users(items):
                     title_en=(title_en or title_de),
                     title_de=(title_de or title_en),
                     link=confirm_link),
-                reply_to=reply_to_email)
+                reply_to=reply_to_email))
+
+    mail_many(mails)
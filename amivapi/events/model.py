@@ -165,6 +165,10 @@ eventdomain = {
         'public_methods': ['GET', 'HEAD'],
         'public_item_methods': ['GET', 'HEAD'],
 
+        'mongo_indexes': {
+            'moderator': ([('moderator', 1)], {'background': True}),
+        },
+
         'schema': {
             'title_de': {
                 'title': 'German Title',
@@ -576,6 +580,20 @@ eventdomain = {
 
         'public_methods': ['POST'],
 
+        'mongo_indexes': {
+            # Signup counts and the waiting list (ordered by signup time)
+            'event_accepted_created': ([('event', 1),
+                                        ('accepted', 1),
+                                        ('_created', 1)],
+                                       {'background': True}),
+            # Waiting list positions
+            'event_created': ([('event', 1), ('_created', 1)],
+                              {'background': True}),
+            'user_event': ([('user', 1), ('event', 1)], {'background': True}),
+            'email_event': ([('email', 1), ('event', 1)],
+                            {'background': True}),
+        },
+
         'schema': {
             'event': {
                 'description': "The event to sign up to (must require "
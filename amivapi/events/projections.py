@@ -4,55 +4,107 @@
 #          you to buy us beer if we meet and you like the software.
 """Hooks to generate fields in events and eventsignups"""
 
+from bisect import bisect_right
+
 from flask import current_app
 
+from amivapi.utils import find_users, get_id
 
-def add_email_to_signup(item):
-    if 'email' not in item:
+
+def add_email_to_signups(items):
+    """Add the user email to signups, all users are fetched at once."""
+    missing = [item for item in items if 'email' not in item]
+
+    # If user is embedded just copy the email, otherwise get the users
+    users = find_users((item['user'] for item in missing
+                        if not isinstance(item['user'], dict)),
+                       fields=['email'])
+
+    for item in missing:
         if isinstance(item['user'], dict):
-            # If user is embedded just copy the email
             item['email'] = item['user']['email']
         else:
-            # User is not embedded, get the user and insert email
-            lookup = {current_app.config['ID_FIELD']: item['user']}
-            user = current_app.data.find_one('users', None, **lookup)
-            item['email'] = user['email']
+            item['email'] = users[get_id(item['user'])]['email']
+
+
+def add_email_to_signup(item):
+    add_email_to_signups([item])
 
 
 def add_email_to_signup_collection(response):
-    for item in response['_items']:
-        add_email_to_signup(item)
+    add_email_to_signups(response['_items'])
+
+
+def _naive(time):
+    """Remove tzinfo, depending on the source `_created` may have one or not.
+
+    Everything is UTC anyways.
+    """
+    return time.replace(tzinfo=None)
+
+
+def _signup_times(event_ids):
+    """Get the sorted signup times for events.
+
+    Signup times are cached per event (see `invalidate_signup_positions`), all
+    missing events are fetched with a single aggregation.
+
+    Returns:
+        dict: event id -> sorted list of `_created` of all signups
+    """
+    cache = current_app.config['signup_position_cache']
+    times = {}
+    missing = []
+    for event_id in event_ids:
+        cached = cache.get(event_id)
+        if cached is None:
+            missing.append(event_id)
+        else:
+            times[event_id] = cached
+
+    if missing:
+        result = current_app.data.driver.db['eventsignups'].aggregate([
+            {'$match': {'event': {'$in': missing}}},
+            {'$group': {'_id': '$event', 'created': {'$push': '$_created'}}},
+        ])
+        fetched = {group['_id']: sorted(_naive(time)
+                                        for time in group['created'])
+                   for group in result}
+
+        for event_id in missing:
+            times[event_id] = fetched.get(event_id, [])
+            cache.set(event_id, times[event_id])
+
+    return times
+
+
+def add_position_to_signups(items):
+    """Add the position in the signup list, i.e. the number of signups for
+    the same event created before (or at the same time as) the signup."""
+    times = _signup_times({get_id(item['event']) for item in items})
+
+    for item in items:
+        event_times = times[get_id(item['event'])]
+        item['position'] = bisect_right(event_times, _naive(item['_created']))
 
 
 def add_position_to_signup(item):
-    signup_time = item['_created']
-    position = current_app.data.driver.db['eventsignups'].count_documents({
-        '_created': {'$lte': signup_time},
-        'event': item['event']})
-    item['position'] = position
+    add_position_to_signups([item])
 
 
 def add_position_to_signup_collection(response):
-    for item in response['_items']:
-        add_position_to_signup(item)
+    add_position_to_signups(response['_items'])
 
 
 def add_position_to_signup_on_inserted(items):
-    for item in items:
-        add_position_to_signup(item)
-
+    add_position_to_signups(items)
 
-def add_signup_count_to_event(item):
-    """After an event is fetched from the database we add the current signup
-    count"""
-    item['signup_count'] = (
-        current_app.data.driver.db['eventsignups'].count_documents(
-            {'event': item['_id'], 'accepted': True}))
-    item['unaccepted_count'] = (
-        current_app.data.driver.db['eventsignups'].count_documents(
-            {'event': item['_id'], 'accepted': False}))
 
+def invalidate_signup_positions(signups):
+    """Signups have been created or deleted, positions need to be updated."""
+    if not isinstance(signups, list):
+        signups = [signups]
 
-def add_signup_count_to_event_collection(items):
-    for item in items['_items']:
-        add_signup_count_to_event(item)
+    for signup in signups:
+        current_app.config['signup_position_cache'].pop(
+            get_id(signup['event']))
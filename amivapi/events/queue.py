@@ -4,10 +4,14 @@
 #          you to buy us beer if we meet and you like the software.
 """Logic to implement different signup queues."""
 
+from bson import ObjectId
 from flask import current_app, g
 from pymongo import ASCENDING
 
+from amivapi.events.counters import update_signup_counts
 from amivapi.events.emails import notify_signup_accepted
+from amivapi.loader import invalidate, load
+from amivapi.utils import deferred_mails, find_users
 
 
 def update_waiting_list(event_id):
@@ -18,43 +22,123 @@ def update_waiting_list(event_id):
     1. After a new signup is created.
     2. After a signup was deleted.
     3. After an external signup was confirmed.
+    4. After the spots or selection strategy of an event were changed.
+
+    Many signups may be created at the same time (e.g. when the registration
+    for a popular event opens), so the spots are allocated atomically using
+    the `signup_count` of the event (see `_reserve_spots`). Afterwards, all
+    signups are accepted with a single update, which only affects signups
+    that are still on the waiting list. Spots reserved for signups which
+    have been accepted (or deleted) concurrently are released again.
+
+    The notifications are sent in the background.
 
     Returns:
         list: ids of all singups which are newly accepted.
     """
-    id_field = current_app.config['ID_FIELD']
-    lookup = {id_field: event_id}
-    event = current_app.data.find_one('events', None, **lookup)
-
-    accepted_ids = []
-
-    if event['selection_strategy'] == 'fcfs':
-        lookup = {'event': event_id, 'accepted': True}
-        signup_count = (
-            current_app.data.driver.db['eventsignups'].count_documents(lookup))
-
-        # 0 spots == infinite spots
-        if event['spots'] == 0 or signup_count < event['spots']:
-            lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
-            new_list = current_app.data.driver.db['eventsignups'].find(
-                lookup).sort('_created', ASCENDING)
-
-            if event['spots'] > 0:
-                to_accept = new_list.limit(event['spots'] - signup_count)
-            else:
-                # infinite spots, so just accept everyone
-                to_accept = new_list
-
-            for new_accepted in to_accept:
-                accepted_ids.append(new_accepted['_id'])
-                # Set accepted flag
-                current_app.data.update('eventsignups', new_accepted[id_field],
-                                        {'accepted': True}, new_accepted)
-
-                # Notify user
-                notify_signup_accepted(event, new_accepted)
+    event = load('events', event_id)
+
+    if (event is None or event['selection_strategy'] != 'fcfs' or
+            event.get('spots') is None):
+        return []  # No signup (`spots` None) means no waiting list either
+
+    collection = current_app.data.driver.db['eventsignups']
+    accepted = []
+
+    while True:
+        to_accept = _reserve_spots(event_id)
+        if not to_accept:
+            break
+
+        # The promotion id (not part of the schema) identifies the signups
+        # accepted by this update, it is removed again afterwards
+        promotion = ObjectId()
+        result = collection.update_many(
+            {'_id': {'$in': [signup['_id'] for signup in to_accept]},
+             'accepted': False},
+            {'$set': {'accepted': True, '_promotion': promotion}})
+
+        released = len(to_accept) - result.modified_count
+        if released:
+            promoted = {signup['_id'] for signup in collection.find(
+                {'_promotion': promotion}, {'_id': 1})}
+            to_accept = [signup for signup in to_accept
+                         if signup['_id'] in promoted]
+            update_signup_counts(event_id, accepted=-released,
+                                 unaccepted=released)
+        collection.update_many({'_promotion': promotion},
+                               {'$unset': {'_promotion': ''}})
+
+        for signup in to_accept:
+            invalidate('eventsignups', signup['_id'])
+            signup['accepted'] = True
+        accepted.extend(to_accept)
+
+        if not released:
+            break
+        # Otherwise, the released spots may be given to someone else
+
+    users = find_users(signup.get('user') for signup in accepted)
+    with deferred_mails():
+        for signup in accepted:
+            user = users.get(signup['user']) if signup.get('user') else None
+            notify_signup_accepted(event, signup, user=user)
+
+    return [signup['_id'] for signup in accepted]
+
+
+def _reserve_spots(event_id):
+    """Reserve spots of an event for the next signups on the waiting list.
+
+    The spots are reserved by incrementing the `signup_count` of the event,
+    but only if the event still has enough free spots afterwards. If this
+    fails because someone else has reserved spots in the meantime, we try
+    again with the remaining free spots.
 
-    return accepted_ids
+    Returns:
+        list: The signups for which a spot was reserved.
+    """
+    db = current_app.data.driver.db
+
+    while True:
+        event = db['events'].find_one({'_id': event_id},
+                                      {'spots': 1, 'signup_count': 1})
+        if event is None:
+            return []
+
+        # None spots == no signup, 0 spots == infinite spots
+        spots = event.get('spots')
+        if spots is None:
+            return []
+        free = spots - event.get('signup_count', 0)
+        if spots != 0 and free <= 0:
+            return []
+
+        waiting = db['eventsignups'].find(
+            {'event': event_id, 'accepted': False, 'confirmed': True}
+        ).sort('_created', ASCENDING)
+        if spots != 0:
+            waiting = waiting.limit(free)
+        waiting = list(waiting)
+
+        if not waiting:
+            return []
+
+        # `spots` may have changed as well, so compare with the current value
+        reserved = db['events'].find_one_and_update(
+            {'_id': event_id, '$or': [
+                {'spots': 0},
+                {'$expr': {'$lte': [
+                    {'$add': [{'$ifNull': ['$signup_count', 0]},
+                              len(waiting)]},
+                    '$spots']}},
+            ]},
+            {'$inc': {'signup_count': len(waiting),
+                      'unaccepted_count': -len(waiting)}},
+            projection={'_id': 1})
+        if reserved is not None:
+            invalidate('events', event_id)
+            return waiting
 
 
 """
@@ -68,8 +152,7 @@ def add_accepted_before_insert(signups):
         # Admins may provide a value for `accepted`.
         # If not provided or not admin set it to false`.
 
-        lookup = {current_app.config['ID_FIELD']: signup.get('event')}
-        event = current_app.data.find_one('events', None, **lookup)
+        event = load('events', signup.get('event'))
 
         signup['accepted'] = (g.resource_admin or g.get('current_user') == str(
             event['moderator'])) and signup.get('accepted', False)
@@ -83,32 +166,35 @@ def update_waiting_list_after_insert(signups):
 
     This could be optimized if multiple signups are for the same event,
     however we do not know that, so this just loop over them and calls the hook
-    for each item.
+    for each item. All notifications are sent together.
     """
-    for signup in signups:
-        if signup['accepted']:
-            lookup = {current_app.config['ID_FIELD']: signup.get('event')}
-            event = current_app.data.find_one('events', None, **lookup)
+    with deferred_mails():
+        for signup in signups:
+            _update_waiting_list_after_insert(signup)
+
+
+def _update_waiting_list_after_insert(signup):
+    if signup['accepted']:
+        event = load('events', signup.get('event'))
+        if event is not None:
+            notify_signup_accepted(event, signup, False)
+    else:
+        accepted = update_waiting_list(signup['event'])
+        if signup['_id'] in accepted:
+            signup['accepted'] = True
+        elif signup.get('user') is not None:
+            event_id = signup.get('event')
+            event = load('events', event_id)
+            lookup = {'event': event_id, 'accepted': True}
+            signup_count = (
+                current_app.data.driver.db['eventsignups']
+                .count_documents(lookup))
             if event is not None:
-                notify_signup_accepted(event, signup, False)
-        else:
-            accepted = update_waiting_list(signup['event'])
-            if signup['_id'] in accepted:
-                signup['accepted'] = True
-            elif signup.get('user') is not None:
-                event_id = signup.get('event')
-                lookup = {current_app.config['ID_FIELD']: event_id}
-                event = current_app.data.find_one('events', None, **lookup)
-                lookup = {'event': event_id, 'accepted': True}
-                signup_count = (
-                    current_app.data.driver.db['eventsignups']
-                    .count_documents(lookup))
-                if event is not None:
-                    if event['selection_strategy'] == "manual" \
-                            and signup_count < event['spots']:
-                        notify_signup_accepted(event, signup, True, True)
-                    else:
-                        notify_signup_accepted(event, signup, True, False)
+                if event['selection_strategy'] == "manual" \
+                        and signup_count < event['spots']:
+                    notify_signup_accepted(event, signup, True, True)
+                else:
+                    notify_signup_accepted(event, signup, True, False)
 
 
 def update_waiting_list_after_delete(signup):
@@ -124,9 +210,14 @@ def notify_users_after_update(signup_updates, original_signup):
     """Hook to notify users after a signup is updated."""
     if signup_updates.get('accepted') and not original_signup.get('accepted'):
         # User was on the waitinglist and got accepted: Notify him
-        lookup = {current_app.config['ID_FIELD']: original_signup.get('event')}
-        event = current_app.data.find_one('events', None, **lookup)
+        event = load('events', original_signup.get('event'))
         if event is not None:
             new_signup = original_signup.copy()
             new_signup.update(signup_updates)
             notify_signup_accepted(event, new_signup, False)
+
+
+def update_waiting_list_after_event_update(updates, original):
+    """Hook to update the waiting list if more people can be accepted."""
+    if 'spots' in updates or 'selection_strategy' in updates:
+        update_waiting_list(original['_id'])
@@ -10,6 +10,8 @@ import json
 from flask import current_app, g, request
 from jsonschema import Draft4Validator, SchemaError
 
+from amivapi.loader import load
+
 
 class EventValidator(object):
     """Custom Validator for event validation rules."""
@@ -38,19 +40,18 @@ class EventValidator(object):
                         "Must be json, parsing failed with exception: %s" % e)
             return
 
-        id_field = current_app.config['ID_FIELD']
         # At this point we have valid JSON, check for event now.
         # If PATCH, then event_id will not be provided, we have to find it
         if request.method == 'PATCH':
-            lookup = {id_field: self.persisted_document['event']}
+            event_id = self.persisted_document['event']
         elif 'event' in self.document:
-            lookup = {id_field: self.document['event']}
+            event_id = self.document['event']
         else:
             # No event provided, the `required` validator of the event field
             # will complain, but we can't continue here
             return
 
-        event = current_app.data.find_one('events', None, **lookup)
+        event = load('events', event_id)
 
         # Load schema, we can use this without caution because only valid
         # json schemas can be written to the database
@@ -103,8 +104,7 @@ class EventValidator(object):
         if signup_possible:
             # We can assume event_id is valid, as the type validator will abort
             # otherwise and this validator is not executed
-            lookup = {current_app.config['ID_FIELD']: event_id}
-            event = current_app.data.find_one("events", None, **lookup)
+            event = load('events', event_id)
 
             if event['spots'] is None:
                 self._error(field, "the event with id %s has no signup"
@@ -148,8 +148,7 @@ class EventValidator(object):
         if enabled:
             # Get event
             event_id = self.document.get('event', None)
-            lookup = {current_app.config['ID_FIELD']: event_id}
-            event = current_app.data.find_one("events", None, **lookup)
+            event = load('events', event_id)
 
             # If the event doesnt exist we do not have to do anything,
             # The 'type' validator will generate an error anyway
@@ -171,18 +170,17 @@ class EventValidator(object):
         The rule's arguments are validated against this schema:
         {'type': 'boolean'}
         """
-        id_field = current_app.config['ID_FIELD']
         # If PATCH, then event_id will not be provided, we have to find it
         if request.method == 'PATCH':
-            lookup = {id_field: self.persisted_document['event']}
+            event_id = self.persisted_document['event']
         elif 'event' in self.document:
-            lookup = {id_field: self.document['event']}
+            event_id = self.document['event']
         else:
             # No event provided, the `required` validator of the event field
             # will complain, but we can't continue here
             return
 
-        event = current_app.data.find_one('events', None, **lookup)
+        event = load('events', event_id)
 
         if event is None:
             return
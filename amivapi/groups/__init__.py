@@ -13,16 +13,22 @@ from datetime import datetime, timedelta
 
 from flask import current_app
 
+from amivapi.cache import TTLCache
 from amivapi.cron import periodic
 from amivapi.groups.mailing_lists import (
+    RemoteSync,
     new_groups,
     new_members,
+    queue_groups,
     removed_group,
     removed_member,
     updated_group,
     updated_user)
 from amivapi.groups.model import groupdomain
-from amivapi.groups.permissions import check_group_permissions
+from amivapi.groups.permissions import (
+    check_group_permissions,
+    invalidate_all_permissions,
+    invalidate_member_permissions)
 from amivapi.groups.validation import GroupValidator
 from amivapi.utils import register_domain, register_validator
 
@@ -34,8 +40,18 @@ def init_app(app):
 
     # authentication
     app.after_auth += check_group_permissions
+    app.config['group_permission_cache'] = TTLCache(
+        maxsize=app.config['GROUP_PERMISSION_CACHE_SIZE'],
+        ttl=app.config['GROUP_PERMISSION_CACHE_TTL'])
+
+    app.on_inserted_groups += invalidate_all_permissions
+    app.on_updated_groups += invalidate_all_permissions
+    app.on_deleted_item_groups += invalidate_all_permissions
+    app.on_inserted_groupmemberships += invalidate_member_permissions
+    app.on_deleted_item_groupmemberships += invalidate_member_permissions
 
     # email lists
+    app.config['remote_mailing_lists'] = RemoteSync(app)
     app.on_inserted_groups += new_groups
     app.on_updated_groups += updated_group
     app.on_deleted_item_groups += removed_group
@@ -48,5 +64,9 @@ def init_app(app):
 
 @periodic(timedelta(days=1))
 def remove_expired_group_members():
-    current_app.data.driver.db['groupmemberships'].delete_many(
-        {'expiry': {'$lte': datetime.utcnow()}})
+    collection = current_app.data.driver.db['groupmemberships']
+    expired = {'expiry': {'$lte': datetime.utcnow()}}
+    group_ids = collection.distinct('group', expired)
+    collection.delete_many(expired)
+    invalidate_all_permissions()
+    queue_groups(group_ids)
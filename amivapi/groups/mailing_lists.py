@@ -6,33 +6,45 @@
 
 A email list can be generated for any group.
 Everytime a group changes or a groupmember is added/removed, the group mail
-files will be regenerated.
-(Since we do not get thousands of requests like this per second we don't need
- anything fancy.)
+files will be regenerated. The groups are queued and their files are created
+by `amivapi cron`, so many changes of the same group only require a single
+update. Files are only written if their content changes.
 
  The files can be created locally or remotely via ssh, to support the current
- mailing list server solution in place.
+ mailing list server solution in place. Remote changes are collected and
+ pushed together with a single ssh command (see `RemoteSync`).
 
  Ssh is probably not the best approach for this, but unfortunately the server
  does not support any other type of connection.
  If this changes, this implementation should be updated.
 """
 
+import atexit
+from datetime import datetime, timedelta
+from hashlib import sha256
+from io import BytesIO
 from itertools import chain
-from os import makedirs, path, remove
+from os import makedirs, path, remove, replace
+from shlex import quote
 from subprocess import Popen, PIPE
+import tarfile
+from tempfile import gettempdir
+from threading import Lock, Thread
+from time import sleep, time
+from weakref import WeakSet
 
 from bson import ObjectId
-
 from flask import current_app
+from pymongo import UpdateOne
+
+from amivapi.cron import periodic
 
 
 # Hooks
 
 def new_groups(groups):
     """Create mailing list files for all new groups."""
-    for group in groups:
-        make_files(group['_id'])
+    queue_groups(group['_id'] for group in groups)
 
 
 def updated_group(updates, original):
@@ -44,7 +56,7 @@ def updated_group(updates, original):
                      if address not in updates['receive_from'])
     # Update remaining forwards
     if ('receive_from' in updates) or ('forward_to' in updates):
-        make_files(original['_id'])
+        queue_groups([original['_id']])
 
 
 def removed_group(group):
@@ -55,26 +67,88 @@ def removed_group(group):
 
 def new_members(new_memberships):
     """Post on memberships, recreate files for the groups"""
-    # Get group ids without duplicates
-    group_ids = set(m['group'] for m in new_memberships)
-
-    for group_id in group_ids:
-        make_files(group_id)
+    queue_groups(m['group'] for m in new_memberships)
 
 
 def removed_member(member):
     """Update files for the group the user was in."""
-    make_files(member['group'])
+    queue_groups([member['group']])
 
 
 def updated_user(updates, original):
     """Update group mailing files if a member changes his email."""
     if 'email' in updates:
-        memberships = current_app.data.driver.db['groupmemberships'].find(
-            {'user': ObjectId(original['_id'])}, {'group': 1})
+        queue_groups(current_app.data.driver.db['groupmemberships'].distinct(
+            'group', {'user': ObjectId(original['_id'])}))
+
+
+# Queue
+
+def queue_groups(group_ids):
+    """Update the mailing lists of several groups later.
+
+    The groups are added to the `mailing_list_queue` collection and their
+    files are created by `update_queued_files`, which runs periodically with
+    `amivapi cron`. A group is only queued once, i.e. all changes until the
+    next run are handled by a single update.
+
+    With `MAILING_LIST_QUEUE = False`, the files are updated immediately.
+
+    Args:
+        group_ids (iterable): The ids of the groups
+    """
+    # Check if any file will be created, otherwise avoid db access
+    if not (current_app.config['MAILING_LIST_DIR'] or
+            current_app.config['REMOTE_MAILING_LIST_ADDRESS']):
+        return
+
+    group_ids = list({ObjectId(group_id) for group_id in group_ids})
+    if not group_ids:
+        return
+
+    if not current_app.config['MAILING_LIST_QUEUE']:
+        update_files({'_id': {'$in': group_ids}})
+        return
+
+    # If a group is being updated right now, it needs another update, so
+    # remove the claim (see below)
+    now = datetime.utcnow()
+    current_app.data.driver.db['mailing_list_queue'].bulk_write([
+        UpdateOne({'_id': group_id},
+                  {'$setOnInsert': {'time': now},
+                   '$unset': {'claim': '', 'claimed': ''}},
+                  upsert=True)
+        for group_id in group_ids
+    ], ordered=False)
 
-        for membership in memberships:
-            make_files(str(membership['group']))
+
+@periodic(timedelta(minutes=1))
+def update_queued_files():
+    """Update the mailing lists of all queued groups.
+
+    Needs an app context.
+
+    Returns:
+        int: The number of updated groups
+    """
+    queue = current_app.data.driver.db['mailing_list_queue']
+    claim = ObjectId()
+    now = datetime.utcnow()
+
+    # Claim all queued groups. Groups claimed by an update which has crashed
+    # are claimed again after a while.
+    queue.update_many(
+        {'$or': [{'claim': {'$exists': False}},
+                 {'claimed': {'$lt': now - timedelta(hours=1)}}]},
+        {'$set': {'claim': claim, 'claimed': now}})
+    group_ids = queue.distinct('_id', {'claim': claim})
+
+    if group_ids:
+        update_files({'_id': {'$in': group_ids}})
+        # Groups queued again in the meantime have lost the claim
+        queue.delete_many({'claim': claim})
+
+    return len(group_ids)
 
 
 # File Handling
@@ -82,53 +156,110 @@ def updated_user(updates, original):
 def make_files(group_id):
     """Create all mailing lists for a group.
 
-    If the file exists it will be overwritten.
     If `MAILING_LIST_DIR` set in config, create a local file.
     If `REMOTE_MAILING_LIST_ADDRESS` set in config, create remote file.
 
     Args:
         group_id (str): The id of the group
     """
+    update_files({'_id': ObjectId(group_id)})
+
+
+def update_files(lookup=None):
+    """Create the mailing lists of all groups matching the lookup.
+
+    The content of all lists is computed with a single aggregation. Files
+    are only written if their content has changed, which is detected with a
+    hash of the content stored in the `mailing_lists` collection. Local files
+    are replaced atomically, i.e. the mail server never sees a partial file.
+
+    Args:
+        lookup (dict): MongoDB query for groups, all groups if None
+
+    Returns:
+        int: The number of written files
+    """
     # Check if any file will be created, otherwise avoid db access
-    if (current_app.config['MAILING_LIST_DIR'] or
+    if not (current_app.config['MAILING_LIST_DIR'] or
             current_app.config['REMOTE_MAILING_LIST_ADDRESS']):
-        group_objectid = ObjectId(group_id)
-
-        # Get group, ensure to include mail addresses
-        group = current_app.data.driver.db['groups'].find_one(
-            {'_id': group_objectid}, {'receive_from': 1, 'forward_to': 1})
-
-        if group:
-            # get mail addresses of all users in group
-            memberships = current_app.data.driver.db['groupmemberships'].find(
-                {'group': group_objectid}, {'user': 1})
-            user_ids = [membership['user'] for membership in memberships]
-            users = current_app.data.driver.db['users'].find(
-                {'_id': {'$in': user_ids}}, {'email': 1})
-            user_mails = (user['email'] for user in users)
-
-            # file content: user mails and 'forward_to' entries
-            # The empty string (last arg) ensures that the data ends with '\n'
-            content = '\n'.join(chain(group.get('forward_to') or [],
-                                      user_mails,
-                                      ''))
-
-            # A file is required for each 'receive_from' entry
-            for address in group.get('receive_from') or []:
-                # Local
-                local_dir = current_app.config['MAILING_LIST_DIR']
-                if local_dir:
-                    # Create directory if needed
-                    if not path.isdir(local_dir):
-                        makedirs(local_dir)
-
-                    with open(_get_local_path(address), 'w') as file:
-                        file.write(content)
-                        file.truncate()  # If old file was larger, cut of rest
-
-                # Remote
-                if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-                    ssh_create(address, content)
+        return 0
+
+    db = current_app.data.driver.db
+    groups = list(db['groups'].aggregate([
+        {'$match': lookup or {}},
+        {'$project': {'receive_from': 1, 'forward_to': 1}},
+        {'$lookup': {'from': 'groupmemberships',
+                     'localField': '_id',
+                     'foreignField': 'group',
+                     'as': 'memberships'}},
+        {'$lookup': {'from': 'users',
+                     'localField': 'memberships.user',
+                     'foreignField': '_id',
+                     'as': 'users'}},
+        {'$project': {'receive_from': 1, 'forward_to': 1,
+                      'emails': '$users.email'}},
+    ]))
+
+    # Hashes of the current files
+    addresses = [address for group in groups
+                 for address in group.get('receive_from') or []]
+    hashes = {item['_id']: item['hash'] for item in db['mailing_lists'].find(
+        {'_id': {'$in': addresses}})}
+
+    written = 0
+    for group in groups:
+        # file content: user mails and 'forward_to' entries
+        # The empty string (last arg) ensures that the data ends with '\n'
+        content = '\n'.join(chain(group.get('forward_to') or [],
+                                  sorted(group['emails']),
+                                  ''))
+        content_hash = sha256(content.encode()).hexdigest()
+
+        # A file is required for each 'receive_from' entry
+        for address in group.get('receive_from') or []:
+            if (hashes.get(address) == content_hash and
+                    not _local_file_missing(address)):
+                continue
+
+            _write_file(address, content)
+            db['mailing_lists'].update_one(
+                {'_id': address},
+                {'$set': {'hash': content_hash, 'group': group['_id']}},
+                upsert=True)
+            written += 1
+
+    _push_remote_changes()
+    return written
+
+
+def _push_remote_changes():
+    if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
+        current_app.config['remote_mailing_lists'].schedule()
+
+
+def _local_file_missing(address):
+    return (current_app.config['MAILING_LIST_DIR'] and
+            not path.isfile(_get_local_path(address)))
+
+
+def _write_file(address, content):
+    # Local
+    local_dir = current_app.config['MAILING_LIST_DIR']
+    if local_dir:
+        # Create directory if needed
+        if not path.isdir(local_dir):
+            makedirs(local_dir)
+
+        # Write to a temporary file first, then replace the list
+        file = _get_local_path(address)
+        tempfile = file + '.tmp'
+        with open(tempfile, 'w') as handle:
+            handle.write(content)
+        replace(tempfile, file)
+
+    # Remote
+    if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
+        current_app.config['remote_mailing_lists'].create(address, content)
 
 
 def remove_files(addresses):
@@ -140,6 +271,7 @@ def remove_files(addresses):
     Args:
         addresses (list): email addresses with a forward file to delete
     """
+    addresses = list(addresses)
     for address in addresses:
         # Local
         if current_app.config['MAILING_LIST_DIR']:
@@ -153,7 +285,11 @@ def remove_files(addresses):
 
         # Remote
         if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-            ssh_remove(address)
+            current_app.config['remote_mailing_lists'].remove(address)
+
+    current_app.data.driver.db['mailing_lists'].delete_many(
+        {'_id': {'$in': addresses}})
+    _push_remote_changes()
 
 
 def _get_local_path(email):
@@ -168,35 +304,130 @@ def _get_remote_path(email):
                      current_app.config['MAILING_LIST_FILE_PREFIX'] + email)
 
 
+# Remote files
+
+class RemoteSync(object):
+    """Collects changes of remote files and pushes them together.
+
+    All changes are sent with a single ssh command (see `ssh_sync`). Unless
+    `REMOTE_MAILING_LIST_SYNC_DELAY` is None, changes are pushed by a
+    background thread after the delay, so that further changes (e.g. a
+    bulk import of memberships) are included in the same push.
+
+    If pushing fails, the stored hashes of the files are removed, so they
+    are written again on the next change (or `amivapi
+    recreate_mailing_lists`).
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._pending = {}  # address -> content, None to remove
+        self._lock = Lock()
+        self._thread = None
+        _remote_syncs.add(self)
+
+    def create(self, address, content):
+        with self._lock:
+            self._pending[address] = content
+
+    def remove(self, address):
+        with self._lock:
+            self._pending[address] = None
+
+    def schedule(self):
+        """Push the changes immediately or start the delayed push."""
+        delay = self.app.config['REMOTE_MAILING_LIST_SYNC_DELAY']
+        if not delay:
+            self.flush()
+            return
+
+        with self._lock:
+            if self._thread is None and self._pending:
+                self._thread = Thread(target=self._run,
+                                      args=(delay.total_seconds(),),
+                                      daemon=True, name='mailing-list-sync')
+                self._thread.start()
+
+    def flush(self):
+        """Push all pending changes with a single ssh command."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        with self.app.app_context():
+            try:
+                ssh_sync(pending)
+            except (RuntimeError, OSError) as error:
+                self.app.logger.error(
+                    "Could not update remote mailing lists %s: %s"
+                    % (', '.join(sorted(pending)), error))
+                self.app.data.driver.db['mailing_lists'].delete_many(
+                    {'_id': {'$in': list(pending)}})
+
+    def _run(self, delay):
+        sleep(delay)
+        with self._lock:
+            self._thread = None
+        self.flush()
+
+
+# Do not lose pending changes on shutdown
+_remote_syncs = WeakSet()
+
+
+@atexit.register
+def _flush_remote_syncs():
+    for remote_sync in list(_remote_syncs):
+        remote_sync.flush()
+
+
 # SSH Helpers (in separate functions for easier testing)
 
-def ssh_create(address, content):
-    """Create a file with content remotely over ssh."""
-    # Create dir, then use 'cat - ' to listen to stdin
-    # Create temporary file first, if upload is completed replace
-    folder = current_app.config['REMOTE_MAILING_LIST_DIR']
-    file = _get_remote_path(address)
-    tempfile = file + '.tmp'
-    ssh_command('mkdir -p %s; cat - > %s; mv %s %s;'
-                % (folder, tempfile, tempfile, file), input=content)
-
-
-def ssh_remove(address):
-    """Remove a file remotely over ssh."""
-    path = _get_remote_path(address)
-    try:
-        ssh_command('rm %s' % path)
-    except RuntimeError as e:
-        # File does not exist: log issue, but do not raise exception
-        no_file_error = ("rm: cannot remove '%s': No such file or directory" %
-                         path)
-        if no_file_error in str(e):
-            current_app.logger.error(
-                "Cannot remove remote mailing list '%s' because the file does "
-                "not exist. The mailing list database seems to be"
-                "inconsistent." % address)
-        else:
-            raise e
+def ssh_sync(files):
+    """Create and remove several files remotely with a single ssh command.
+
+    The new files are sent as tar archive, extracted into a temporary
+    directory and moved to their destination, so every file is replaced
+    atomically.
+
+    Args:
+        files (dict): address -> file content, or None to remove the file
+    """
+    folder = quote(current_app.config['REMOTE_MAILING_LIST_DIR'])
+    created = {address: content for address, content in files.items()
+               if content is not None}
+    removed = [address for address, content in files.items()
+               if content is None]
+
+    prefix = current_app.config['MAILING_LIST_FILE_PREFIX']
+    commands = ['mkdir -p %s' % folder]
+    archive = None
+    if created:
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for address, content in created.items():
+                data = content.encode()
+                info = tarfile.TarInfo(prefix + address)
+                info.size = len(data)
+                info.mtime = time()
+                info.mode = 0o644
+                tar.addfile(info, BytesIO(data))
+
+        commands.append(
+            'tmp=$(mktemp -d %s/.amivapi-sync.XXXXXX)' % folder)
+        commands.append('tar -x -f - -C "$tmp"')
+        commands.extend('mv -f "$tmp"/%s %s'
+                        % (quote(prefix + address), folder)
+                        for address in created)
+        commands.append('rmdir "$tmp"')
+    if removed:
+        commands.append('rm -f %s' % ' '.join(
+            quote(_get_remote_path(address)) for address in removed))
+
+    ssh_command(' && '.join(commands),
+                input=archive.getvalue() if archive else None)
 
 
 def ssh_command(remote_command, input=None):
@@ -204,9 +435,12 @@ def ssh_command(remote_command, input=None):
 
     Popen and communicate are used for compatibility with both python 2 and 3.
 
+    Unless `REMOTE_MAILING_LIST_CONTROL_PERSIST` is None, the connection is
+    kept open (ssh ControlMaster) and reused by the following commands.
+
     Args:
         remote_command(Str): Command to execute on remote server
-        input(Str): Input, is sent to remote process via stdin
+        input(Str or bytes): Input, is sent to remote process via stdin
 
     Returns:
         Str: stdout of command
@@ -219,13 +453,15 @@ def ssh_command(remote_command, input=None):
 
     # Construct local ssh command, use -i option if keyfile is specified
     cmd = (["ssh"] + (['-i', keyfile] if keyfile else []) +
-           [address, remote_command])
+           _control_options() + [address, remote_command])
 
     # Open subprocess, initialize pipes for input and errors
     process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
     # Send input (as bytes) and receive errors (will also be bytes)
-    out, error = process.communicate(input=input.encode() if input else None)
+    if isinstance(input, str):
+        input = input.encode()
+    out, error = process.communicate(input=input or None)
 
     # Raise RuntimeError if anything went wrong
     if error:
@@ -234,3 +470,14 @@ def ssh_command(remote_command, input=None):
 
     if out:
         return out.decode()
+
+
+def _control_options():
+    """Options to share a single ssh connection between commands."""
+    persist = current_app.config['REMOTE_MAILING_LIST_CONTROL_PERSIST']
+    if not persist:
+        return []
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % path.join(gettempdir(),
+                                               'amivapi-ssh-%C'),
+            '-o', 'ControlPersist=%i' % persist.total_seconds()]
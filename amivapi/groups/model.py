@@ -228,7 +228,8 @@ groupdomain = {
         },
 
         'mongo_indexes': {
-            'name': ([('name', 1)], {'background': True})
+            'name': ([('name', 1)], {'background': True}),
+            'moderator': ([('moderator', 1)], {'background': True}),
         },
 
         'schema': {
@@ -339,6 +340,13 @@ groupdomain = {
 
         'authentication': GroupMembershipAuth,
 
+        'mongo_indexes': {
+            'user_group': ([('user', 1), ('group', 1)], {'background': True}),
+            'group': ([('group', 1)], {'background': True}),
+            # Used to remove expired memberships
+            'expiry': ([('expiry', 1)], {'background': True}),
+        },
+
         'schema': {
             'group': {
                 'example': 'e0fb1d077ff6ca3c9dd731c4',
@@ -3,13 +3,66 @@
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
 
-"""Permissions for group members."""
+"""Permissions for group members.
+
+The permissions of a user are resolved for all resources at once, i.e. a map
+`resource -> {'read', 'readwrite'}` is computed with a single query. The map
+is kept in `g` for the rest of the request (the home endpoint checks every
+resource) and in a per-process cache for subsequent requests.
+
+The cache is invalidated by the groups and groupmemberships hooks below.
+"""
 
 from bson import ObjectId
 
 from flask import current_app, g
 
 
+def get_group_permissions(user):
+    """Return the resolved permissions of a user.
+
+    Args:
+        user (str): The user id
+
+    Returns:
+        dict: resource -> frozenset of permissions ('read', 'readwrite').
+            Must not be modified, the dict is shared by all requests.
+    """
+    if g.get('group_permissions', (None, None))[0] == user:
+        return g.group_permissions[1]
+
+    cache = current_app.config['group_permission_cache']
+    permissions = cache.get(user)
+
+    if permissions is None:
+        permissions = _query_group_permissions(user)
+        cache.set(user, permissions)
+
+    g.group_permissions = (user, permissions)
+    return permissions
+
+
+def _query_group_permissions(user):
+    """Get the permissions of all groups of a user with a single query."""
+    groups = current_app.data.driver.db['groupmemberships'].aggregate([
+        {'$match': {'user': ObjectId(user)}},
+        {'$lookup': {'from': 'groups',
+                     'localField': 'group',
+                     'foreignField': '_id',
+                     'as': 'group'}},
+        {'$unwind': '$group'},
+        {'$project': {'_id': 0, 'permissions': '$group.permissions'}},
+    ])
+
+    permissions = {}
+    for group in groups:
+        for resource, permission in (group.get('permissions') or {}).items():
+            permissions.setdefault(resource, set()).add(permission)
+
+    return {resource: frozenset(values)
+            for resource, values in permissions.items()}
+
+
 def check_group_permissions(resource):
     """Retrieve groups for current user and apply permissions for resource.
 
@@ -20,17 +73,30 @@ def check_group_permissions(resource):
     user = g.get('current_user')
 
     if user:
-        # Find the users groups giving permission for a resource
-        memberships = current_app.data.driver.db['groupmemberships'].find(
-            {'user': ObjectId(user)}, {'group': 1})
-        group_ids = [m['group'] for m in memberships]
-        permission_key = 'permissions.%s' % resource
-        groups = current_app.data.driver.db['groups'].find(
-            {'_id': {'$in': group_ids}, permission_key: {'$exists': True}},
-            {permission_key: 1})
-        permissions = [group['permissions'][resource] for group in groups]
+        permissions = get_group_permissions(user).get(resource, ())
 
         if 'read' in permissions:
             g.resource_admin_readonly = True
         if 'readwrite' in permissions:
             g.resource_admin = True
+
+
+def _reset_request_permissions():
+    """Permissions may have changed during the request."""
+    g.pop('group_permissions', None)
+
+
+def invalidate_all_permissions(*_):
+    """Group permissions have changed, affecting all members."""
+    current_app.config['group_permission_cache'].clear()
+    _reset_request_permissions()
+
+
+def invalidate_member_permissions(items):
+    """Memberships have changed, only affecting the respective users."""
+    if not isinstance(items, list):
+        items = [items]
+
+    for item in items:
+        current_app.config['group_permission_cache'].pop(str(item['user']))
+    _reset_request_permissions()
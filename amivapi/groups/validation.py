@@ -9,6 +9,8 @@ Also has method to create group_permissions_jsonschema.
 
 from flask import current_app, g
 
+from amivapi.loader import load
+
 
 class GroupValidator(object):
     """Custom Validator for group validation rules."""
@@ -25,7 +27,7 @@ class GroupValidator(object):
         if enabled and not g.get('resource_admin'):
             # Get moderator id
             group_id = self.document['group']
-            group = current_app.data.find_one('groups', None, _id=group_id)
+            group = load('groups', group_id)
 
             # If the group doesnt exist we dont have to do anything,
             # The 'type' validator will generate an error anyway
@@ -47,7 +49,7 @@ class GroupValidator(object):
         """
         if enabled and not g.get('resource_admin'):
             # Check if moderator
-            group = current_app.data.find_one('groups', None, _id=value)
+            group = load('groups', value)
             moderator = group.get('moderator')
             if not (group.get('allow_self_enrollment') or
                     (moderator and str(moderator) == g.get('current_user'))):
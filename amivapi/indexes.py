@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""MongoDB index management.
+
+Resources declare the indexes needed by their lookups and hooks in their
+domain using `mongo_indexes` (see the Eve documentation). Collections which
+are not resources (e.g. `scheduled_tasks`) register their indexes with
+`register_indexes`.
+
+By default, all indexes are created when the app starts. Building indexes for
+large collections can take a while, so this can be disabled with
+
+    MONGO_INDEXES_ON_STARTUP = False
+
+in the config. In this case, use `amivapi ensure-indexes` to create them.
+The command also reports indexes which are missing, unused (according to
+`$indexStats`) or not declared anywhere.
+"""
+
+from pymongo.errors import OperationFailure
+
+
+def register_indexes(app, collection, indexes):
+    """Declare indexes for a collection that is not an Eve resource.
+
+    Args:
+        app (Eve): The app
+        collection (str): The name of the collection
+        indexes (dict): name -> (list of keys, options), like `mongo_indexes`
+    """
+    app.config.setdefault('collection_indexes', {}).setdefault(
+        collection, {}).update(indexes)
+
+    if app.config['MONGO_INDEXES_ON_STARTUP']:
+        with app.app_context():
+            _create_indexes(app, collection, indexes)
+
+
+def declared_indexes(app):
+    """Collect all declared indexes.
+
+    Returns:
+        dict: collection -> {name: (list of keys, options)}
+    """
+    result = {}
+    for resource, settings in app.config['DOMAIN'].items():
+        indexes = settings.get('mongo_indexes')
+        if indexes:
+            collection = app.config['SOURCES'][resource]['source']
+            result.setdefault(collection, {}).update(
+                {name: _normalize(value) for name, value in indexes.items()})
+
+    for collection, indexes in app.config.get('collection_indexes',
+                                              {}).items():
+        result.setdefault(collection, {}).update(
+            {name: _normalize(value) for name, value in indexes.items()})
+
+    return result
+
+
+def _normalize(value):
+    """Index definitions may omit the options."""
+    if isinstance(value, tuple):
+        return value
+    return (value, {})
+
+
+def _key(keys):
+    """Comparable representation of an index key specification."""
+    return tuple((field, int(direction)
+                  if isinstance(direction, (int, float)) else direction)
+                 for field, direction in keys)
+
+
+def _create_indexes(app, collection, indexes):
+    db = app.data.driver.db
+    for name, value in indexes.items():
+        keys, options = _normalize(value)
+        db[collection].create_index(keys, name=name, **options)
+
+
+def ensure_indexes(app, create=True):
+    """Create missing indexes and report on the state of all indexes.
+
+    Needs an app context.
+
+    Args:
+        app (Eve): The app
+        create (bool): If False, only report
+
+    Returns:
+        dict: collection -> {
+            'created': names of created indexes,
+            'missing': names of declared indexes which do not exist,
+            'unused': {name: time since when the usage is tracked} for
+                all indexes which have not been used,
+            'undeclared': names of existing indexes which are not declared
+        }
+    """
+    db = app.data.driver.db
+    report = {}
+
+    for collection, indexes in sorted(declared_indexes(app).items()):
+        existing = {_key(info['key']): name for name, info
+                    in db[collection].index_information().items()}
+
+        missing = {name: value for name, value in indexes.items()
+                   if _key(value[0]) not in existing}
+        if create and missing:
+            _create_indexes(app, collection, missing)
+            existing = {_key(info['key']): name for name, info
+                        in db[collection].index_information().items()}
+
+        declared_keys = {_key(keys) for keys, _ in indexes.values()}
+        report[collection] = {
+            'created': sorted(missing) if create else [],
+            'missing': sorted(name for name, (keys, _) in indexes.items()
+                              if _key(keys) not in existing),
+            'unused': _unused_indexes(db[collection]),
+            'undeclared': sorted(name for key, name in existing.items()
+                                 if key not in declared_keys and
+                                 name != '_id_'),
+        }
+
+    return report
+
+
+def _unused_indexes(collection):
+    """Use `$indexStats` to find indexes without any operations.
+
+    The statistics are reset when the MongoDB server is restarted, so the
+    time since when the statistics are collected is returned as well.
+    """
+    try:
+        stats = collection.aggregate([{'$indexStats': {}}])
+        return {stat['name']: stat['accesses']['since'] for stat in stats
+                if stat['accesses']['ops'] == 0 and stat['name'] != '_id_'}
+    except OperationFailure:
+        # Not supported, e.g. missing privileges
+        return {}
@@ -38,18 +38,192 @@ and looks (almost) identical, except that the string does not start with "ETH "
 anymore. Unfortunately, the info for all previous students is still in the
 `departmentNumber` field, thus we check which of both fields is in use before
 parsing.
+
+
+Note on skipping unchanged users:
+
+Every login with LDAP synchronizes the user. To avoid updating users whose
+data has not changed (which creates a new etag and runs all update hooks),
+a digest of the processed LDAP data is stored in the user (`ldap_digest`,
+not part of the schema) and the update is skipped if the digest matches.
+If any of the synchronized fields is changed with the API, the digest is
+removed again. The metric `ldap_syncs` counts `skipped` and `applied`
+synchronizations.
+
+
+Note on connections:
+
+The ETH has several LDAP hosts, and single hosts are sometimes slow or not
+reachable at all. `LdapPool` keeps connectors for every host and sends
+requests to the fastest healthy host. Requests are bounded by
+`LDAP_TIMEOUT` (logins) or `LDAP_SEARCH_TIMEOUT`, and a host that fails or
+times out is avoided for `LDAP_HOST_COOLDOWN`.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
+from hashlib import sha256
+import json
+from threading import Lock
+from time import monotonic
+
+from eve.methods.common import resolve_document_etag
 from eve.methods.patch import patch_internal
 from eve.methods.post import post_internal
 from flask import current_app
+from ldap3.core.exceptions import LDAPException
 from nethz.ldap import AuthenticatedLdap
+from pymongo import UpdateOne
 
+from amivapi import metrics
 from amivapi.utils import admin_permissions
 
 
+ATTRIBUTES = [
+    'cn',
+    'swissEduPersonMatriculationNumber',
+    'givenName',
+    'sn',
+    'swissEduPersonGender',
+    'ou',
+    # Dept for old students in 'departmentNumber', for new in 'description'
+    'departmentNumber',
+    'description',
+]
+
+# Changes of unique fields need validation, i.e. `patch_internal`
+UNIQUE_FIELDS = ('legi',)
+
+# All user fields which may be set by `_process_data`
+SYNCED_FIELDS = ('nethz', 'firstname', 'lastname', 'legi', 'email', 'gender',
+                 'department', 'membership', 'send_newsletter')
+
+
+class _Host(object):
+    """Connectors and health of a single LDAP host."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.latency = 0  # moving average (seconds), unknown hosts first
+        self.down_until = 0
+        self.idle = []
+        # Bounds the number of requests which are still running after their
+        # timeout has expired. Every host has its own threads, so a host
+        # which stops responding can't block the requests to other hosts.
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='ldap')
+
+
+class LdapPool(object):
+    """Reuse LDAP connectors and prefer the fastest healthy host.
+
+    Provides `authenticate` and `search` like the nethz connectors. Every
+    request is run with a connector of the healthy host with the lowest
+    latency. If the request fails or does not finish within the timeout, the
+    host is marked as unhealthy for `cooldown` and the next host is tried.
+    If all hosts are unhealthy, they are tried anyway.
+
+    Args:
+        connect (callable): Creates a connector for a single host
+        hosts (list): The hosts, in order of preference
+        size (int): Number of idle connectors kept per host
+        timeout (timedelta): Maximum time for `authenticate`
+        search_timeout (timedelta): Maximum time for `search`
+        cooldown (timedelta): Time to avoid a host after a failure
+    """
+
+    def __init__(self, connect, hosts, size, timeout, search_timeout,
+                 cooldown):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout.total_seconds()
+        self.search_timeout = search_timeout.total_seconds()
+        self.cooldown = cooldown.total_seconds()
+        self.hosts = [_Host(host, max(size, 1) * len(hosts))
+                      for host in hosts]
+        self._lock = Lock()
+
+    def authenticate(self, cn, password):
+        """Check the password of a user."""
+        return self._request(
+            lambda connector: connector.authenticate(cn, password),
+            self.timeout)
+
+    def search(self, query, **kwargs):
+        """Search the ldap, returns a list of results."""
+        return self._request(
+            lambda connector: list(connector.search(query, **kwargs)),
+            self.search_timeout)
+
+    def healthy_hosts(self):
+        """Number of hosts which are not avoided at the moment."""
+        now = monotonic()
+        return sum(1 for host in self.hosts if host.down_until <= now)
+
+    def _ranked_hosts(self):
+        now = monotonic()
+        with self._lock:
+            return sorted(self.hosts, key=lambda host: (
+                (True, host.down_until) if host.down_until > now
+                else (False, host.latency)))
+
+    def _request(self, func, timeout):
+        error = None
+        for host in self._ranked_hosts():
+            future = host.executor.submit(self._run, host, func)
+            try:
+                result, seconds = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                error = "Timeout after %.1f seconds" % timeout
+                self._failed(host, 'timeout', error)
+            except (LDAPException, OSError) as exception:
+                error = exception
+                self._failed(host, 'error', error)
+            else:
+                self._succeeded(host, seconds)
+                return result
+
+        raise LDAPException("No LDAP host available: %s" % error)
+
+    def _run(self, host, func):
+        """Run the request with an idle or new connector (in a thread)."""
+        with self._lock:
+            connector = host.idle.pop() if host.idle else None
+        if connector is None:
+            connector = self.connect(host.name)
+
+        start = monotonic()
+        result = func(connector)  # Failed connectors are not reused
+        seconds = monotonic() - start
+
+        with self._lock:
+            if len(host.idle) < self.size:
+                host.idle.append(connector)
+        return result, seconds
+
+    def _succeeded(self, host, seconds):
+        with self._lock:
+            host.down_until = 0
+            host.latency = (seconds if not host.latency
+                            else 0.8 * host.latency + 0.2 * seconds)
+        metrics.increment('ldap_requests', host=host.name, result='ok')
+        metrics.increment('ldap_request_seconds', seconds, host=host.name)
+
+    def _failed(self, host, result, error):
+        current_app.logger.warning("LDAP host '%s' failed: %s"
+                                   % (host.name, error))
+        with self._lock:
+            host.down_until = monotonic() + self.cooldown
+            host.idle = []
+        metrics.increment('ldap_requests', host=host.name, result=result)
+
+
 def init_app(app):
-    """Attach an ldap connection to the app."""
+    """Attach an ldap connection pool to the app."""
+    app.on_updated_users += reset_digest
+
     user = app.config['LDAP_USERNAME']
     password = app.config['LDAP_PASSWORD']
     hosts = app.config['LDAP_HOSTS']
@@ -61,7 +235,14 @@ def init_app(app):
         raise ValueError("You cannot set only a username or only a password "
                          "for ldap.")
 
-    app.config['ldap_connector'] = AuthenticatedLdap(user, password, hosts)
+    app.config['ldap_connector'] = pool = LdapPool(
+        lambda host: AuthenticatedLdap(user, password, [host]),
+        hosts,
+        size=app.config['LDAP_POOL_SIZE'],
+        timeout=app.config['LDAP_TIMEOUT'],
+        search_timeout=app.config['LDAP_SEARCH_TIMEOUT'],
+        cooldown=app.config['LDAP_HOST_COOLDOWN'])
+    app.config['metrics'].gauge('ldap_healthy_hosts', pool.healthy_hosts)
 
 
 def authenticate_user(cn, password):
@@ -72,9 +253,14 @@ def authenticate_user(cn, password):
         password (string): the user password (plaintext)
 
     Returns:
-        bool: True if successful, False otherwise
+        bool: True if successful, False otherwise (also if no LDAP host is
+            available)
     """
-    return current_app.config['ldap_connector'].authenticate(cn, password)
+    try:
+        return current_app.config['ldap_connector'].authenticate(cn, password)
+    except LDAPException as error:
+        current_app.logger.error("LDAP authentication failed: %s" % error)
+        return False
 
 
 def sync_one(cn):
@@ -86,7 +272,8 @@ def sync_one(cn):
         cn (string): Common name of user.
 
     Returns:
-        dict: Data of updated or newly created user in database,
+        dict: Data of updated or newly created user in database (the
+              unchanged database document if the update was skipped),
               None if user not found in ldap.
     """
     query = "(cn=%s)" % _escape(cn)
@@ -99,39 +286,187 @@ def sync_one(cn):
 def sync_all():
     """Query the ETH LDAP for all our members. Adds non-existing ones to db.
 
-    Updates existing ones if ldap data has changed.
-    Depending on the system, this can take 30 seconds or longer.
+    Updates existing ones if ldap data has changed. All existing users are
+    fetched with a single query and compared with the ldap data in memory.
+    Unchanged users are skipped, changed users are updated with a single
+    `bulk_write` and new users are created with a single `post_internal`.
+    The `on_updated` hooks (e.g. for mailing lists) still run for every
+    updated user.
+
+    With `LDAP_SYNC_WORKERS` > 1, the members of every department are
+    fetched in parallel, spread across all `LDAP_HOSTS`.
 
     Returns:
-        list: Data of all updated users.
+        dict: Number of 'created', 'updated' and 'unchanged' users.
     """
+    departments = current_app.config['LDAP_DEPARTMENT_MAP']
+    workers = current_app.config['LDAP_SYNC_WORKERS']
+
+    if workers > 1:
+        ldap_data = _search_parallel(
+            [_members_query([department]) for department in departments],
+            workers)
+    else:
+        ldap_data = _search(_members_query(departments))
+
+    return _sync_users(ldap_data)
+
+
+def _members_query(departments):
+    """Query for the VSETH members of the given departments."""
     # See file docstring for explanation of `deparmentNumber` field
     keywords = ''.join(u"(departmentNumber=*%s*)" % _escape(item)
-                       for item in current_app.config['LDAP_DEPARTMENT_MAP'])
-    query = u"(& (ou=VSETH Mitglied) (| %s) )" % keywords
-    ldap_data = _search(query)
-
-    return [_create_or_update_user(user) for user in ldap_data]
+                       for item in departments)
+    return u"(& (ou=VSETH Mitglied) (| %s) )" % keywords
 
 
 def _search(query):
     """Search the LDAP. Returns filtered data (iterable) for string query."""
-    attr = [
-        'cn',
-        'swissEduPersonMatriculationNumber',
-        'givenName',
-        'sn',
-        'swissEduPersonGender',
-        'ou',
-        # Dept for old students in 'departmentNumber', for new in 'description'
-        'departmentNumber',
-        'description',
-    ]
-    results = current_app.config['ldap_connector'].search(query,
-                                                          attributes=attr)
+    results = current_app.config['ldap_connector'].search(
+        query, attributes=ATTRIBUTES)
     return (_process_data(res) for res in results)
 
 
+def _search_parallel(queries, workers):
+    """Run multiple queries at the same time.
+
+    Every query uses its own connection, which prefers another host. The
+    remaining hosts are used if the preferred host is not available.
+
+    Returns:
+        list: Filtered data of all results
+    """
+    username = current_app.config['LDAP_USERNAME']
+    password = current_app.config['LDAP_PASSWORD']
+    hosts = current_app.config['LDAP_HOSTS']
+
+    def _run(index, query):
+        # No app context in this thread, only query the ldap
+        offset = index % len(hosts)
+        connector = AuthenticatedLdap(username, password,
+                                      hosts[offset:] + hosts[:offset])
+        return list(connector.search(query, attributes=ATTRIBUTES))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_run, range(len(queries)), queries))
+
+    return [_process_data(res) for result in results for res in result]
+
+
+def _sync_users(ldap_data):
+    """Create, update or skip users in bulk (see `sync_all`)."""
+    collection = current_app.data.driver.db['users']
+    # Users may be found by several queries
+    entries = {data['nethz']: data for data in ldap_data if 'nethz' in data}
+    existing = {user['nethz']: user for user in collection.find(
+        {'nethz': {'$in': list(entries)}})}
+
+    new, updated, validated = [], [], []
+    digests = {}  # nethz -> new digest
+    for nethz, data in entries.items():
+        digest = _digest(data)
+        original = existing.get(nethz)
+        if original is None:
+            new.append(data)
+            digests[nethz] = digest
+            continue
+        if original.get('ldap_digest') == digest:
+            continue
+        digests[nethz] = digest
+
+        changes = {key: value for key, value
+                   in _ldap_updates(data, original).items()
+                   if original.get(key) != value}
+        if any(field in changes for field in UNIQUE_FIELDS):
+            validated.append((changes, original))
+        elif changes:
+            updated.append((changes, original))
+
+    _bulk_update(updated)
+
+    with admin_permissions():
+        for changes, original in validated:
+            response, _, _, status, _ = patch_internal(
+                'users', changes, _id=original['_id'])
+            if status != 200:
+                # Try again next time
+                digests.pop(original['nethz'])
+                current_app.logger.error(
+                    "Could not update user '%s' from LDAP: %s"
+                    % (original['nethz'], response.get('_issues')))
+        created = _bulk_create(new)
+
+    # Only now, the update hooks have removed the old digests
+    _store_digests(digests)
+
+    result = {
+        'created': created,
+        'updated': len(updated) + len(validated),
+        'unchanged': len(existing) - len(updated) - len(validated),
+    }
+    metrics.increment('ldap_syncs', result['created'] + result['updated'],
+                      result='applied')
+    metrics.increment('ldap_syncs', result['unchanged'], result='skipped')
+    return result
+
+
+def _bulk_update(updated):
+    """Write changes with a single `bulk_write`, then run the update hooks.
+
+    Args:
+        updated (list): (changes, original) for every user
+    """
+    if not updated:
+        return
+
+    config = current_app.config
+    now = datetime.utcnow().replace(microsecond=0)
+    operations = []
+    for changes, original in updated:
+        changes[config['LAST_UPDATED']] = now
+
+        # Same etag as computed by `patch_internal`
+        document = dict(original, **changes)
+        document.pop(config['ETAG'], None)
+        resolve_document_etag(document, 'users')
+        changes[config['ETAG']] = document[config['ETAG']]
+
+        operations.append(UpdateOne({'_id': original['_id']},
+                                    {'$set': changes}))
+
+    current_app.data.driver.db['users'].bulk_write(operations, ordered=False)
+
+    for changes, original in updated:
+        current_app.on_updated('users', changes, original)
+        current_app.on_updated_users(changes, original)
+
+
+def _bulk_create(new):
+    """Create all users with a single request, one by one on errors.
+
+    Returns:
+        int: The number of created users
+    """
+    if not new:
+        return 0
+
+    status = post_internal('users', new)[3]
+    if status == 201:
+        return len(new)
+
+    # Nothing has been created, find the invalid data
+    created = 0
+    for data in new:
+        response, _, _, status, _ = post_internal('users', data)
+        if status == 201:
+            created += 1
+        else:
+            current_app.logger.error(
+                "Could not create user '%s' from LDAP: %s"
+                % (data['nethz'], response.get('_issues')))
+    return created
+
+
 def _escape(query):
     """LDAP-style escape according to the ldap3 documentation."""
     replacements = (
@@ -206,26 +541,70 @@ def _process_data(data):
     return res
 
 
+def _ldap_updates(ldap_data, db_data):
+    """Select the ldap data which may be changed for an existing user."""
+    updates = dict(ldap_data)
+    # Membership will not be downgraded and email not be overwritten
+    # Newsletter settings will also not be adjusted
+    updates.pop('email', None)
+    if db_data.get('membership') != u"none":
+        updates.pop('membership', None)
+        updates.pop('send_newsletter', None)
+    return updates
+
+
 def _create_or_update_user(ldap_data):
-    """Try to find user in database. Update if it exists, create otherwise."""
+    """Try to find user in database. Update if it exists, create otherwise.
+
+    If the ldap data has not changed since the last update, nothing is
+    done and the database document is returned.
+    """
     query = {'nethz': ldap_data['nethz']}
     db_data = current_app.data.driver.db['users'].find_one(query)
+    digest = _digest(ldap_data)
+
+    if db_data and db_data.get('ldap_digest') == digest:
+        metrics.increment('ldap_syncs', result='skipped')
+        return db_data
 
     with admin_permissions():
         if db_data:
-            # Membership will not be downgraded and email not be overwritten
-            # Newsletter settings will also not be adjusted
-            ldap_data.pop('email', None)
-            if db_data.get('membership') != u"none":
-                ldap_data.pop('membership', None)
-                ldap_data.pop('send_newsletter', None)
-
-            user = patch_internal('users',
-                                  ldap_data,
-                                  _id=db_data['_id'])[0]
+            user, _, _, status, _ = patch_internal(
+                'users', _ldap_updates(ldap_data, db_data),
+                _id=db_data['_id'])
         else:
             # For new members,
 
-            user = post_internal('users', ldap_data)[0]
+            user, _, _, status, _ = post_internal('users', ldap_data)
+
+    metrics.increment('ldap_syncs', result='applied')
+    if status in (200, 201):
+        _store_digests({query['nethz']: digest})
 
     return user
+
+
+def _digest(ldap_data):
+    """Hash of the processed ldap data of a user."""
+    return sha256(json.dumps(ldap_data, sort_keys=True).encode()).hexdigest()
+
+
+def _store_digests(digests):
+    """Save the digests (nethz -> digest) of synchronized users."""
+    if digests:
+        current_app.data.driver.db['users'].bulk_write([
+            UpdateOne({'nethz': nethz}, {'$set': {'ldap_digest': digest}})
+            for nethz, digest in digests.items()
+        ], ordered=False)
+
+
+def reset_digest(updates, original):
+    """Synchronize users again if their ldap fields are changed with the API.
+
+    This also runs for updates by the synchronization itself, the new
+    digest is stored afterwards.
+    """
+    if ('ldap_digest' in original and
+            any(field in updates for field in SYNCED_FIELDS)):
+        current_app.data.driver.db['users'].update_one(
+            {'_id': original['_id']}, {'$unset': {'ldap_digest': ''}})
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Request-scoped identity map for documents.
+
+Hooks and validators often need the same documents during a single request,
+e.g. the event of a signup is needed for validation, authorization, the
+waiting list and the notification emails. Use
+
+>>> event = load('events', event_id)
+
+instead of `current_app.data.find_one`. Only the first call queries the
+database, all subsequent calls in the same request return the same document.
+Multiple documents can be fetched with a single query:
+
+>>> events = load_many('events', [event_id, other_id])  # id -> document
+
+Documents are dropped when they are modified with Eve (the `on_inserted`,
+`on_updated`, `on_replaced` and `on_deleted_item` hooks, which are also
+triggered by `post_internal`, `patch_internal`, etc.). Code that modifies
+documents directly in the database must call `invalidate`.
+
+Notes:
+The returned documents are shared, do not modify them.
+
+Outside of requests (e.g. scheduled tasks), documents are not kept at all.
+
+The number of documents found in the identity map (`loader_hits`) and the
+number of database queries (`loader_queries`) are counted in the metrics.
+"""
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import current_app, g, has_request_context
+
+from amivapi import metrics
+
+
+def _key(_id):
+    """Ids may be provided as strings or ObjectIds."""
+    try:
+        return ObjectId(_id)
+    except (InvalidId, TypeError):
+        return _id
+
+
+def _identity_map(resource):
+    if not has_request_context():
+        return {}
+    if 'loader' not in g:
+        g.loader = {}
+    return g.loader.setdefault(resource, {})
+
+
+def load_many(resource, ids):
+    """Get multiple documents of a resource by id.
+
+    Args:
+        resource (str): The resource name
+        ids (iterable): The ids, `None` is ignored
+
+    Returns:
+        dict: id (as ObjectId if possible) -> document. Missing documents
+            are not included.
+    """
+    documents = _identity_map(resource)
+    keys = {_key(_id) for _id in ids if _id is not None}
+    missing = [key for key in keys if key not in documents]
+
+    if len(keys) > len(missing):
+        metrics.increment('loader_hits', len(keys) - len(missing),
+                          resource=resource)
+
+    if missing:
+        metrics.increment('loader_queries', resource=resource)
+        id_field = current_app.config['DOMAIN'][resource]['id_field']
+        collection = current_app.config['SOURCES'][resource]['source']
+
+        # Remember missing documents as well
+        documents.update((key, None) for key in missing)
+        for document in current_app.data.driver.db[collection].find(
+                {id_field: {'$in': missing}}):
+            documents[_key(document[id_field])] = document
+
+    return {key: documents[key] for key in keys
+            if documents[key] is not None}
+
+
+def load(resource, _id):
+    """Get a single document by id (or None, if it does not exist)."""
+    return load_many(resource, [_id]).get(_key(_id))
+
+
+def invalidate(resource, _id=None):
+    """Drop a document (or all documents of a resource) for this request."""
+    if 'loader' not in g:
+        return
+    if _id is None:
+        g.loader.pop(resource, None)
+    else:
+        g.loader.get(resource, {}).pop(_key(_id), None)
+
+
+def _invalidate_items(resource, items):
+    id_field = current_app.config['DOMAIN'][resource]['id_field']
+    for item in items:
+        invalidate(resource, item[id_field])
+
+
+def _clear(*_):
+    g.pop('loader', None)
+
+
+def init_app(app):
+    """Register hooks to keep the identity map up to date."""
+    app.on_inserted += _invalidate_items
+    app.on_updated += (lambda resource, updates, original:
+                       _invalidate_items(resource, [original]))
+    app.on_replaced += (lambda resource, document, original:
+                        _invalidate_items(resource, [original]))
+    app.on_deleted_item += (lambda resource, item:
+                            _invalidate_items(resource, [item]))
+    app.on_deleted_resource += invalidate
+
+    # The app context (and `g`) may be shared by multiple requests (in tests)
+    app.teardown_request(_clear)
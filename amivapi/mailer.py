@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Outgoing mail queue.
+
+Talking to the SMTP server can take seconds, which is too slow to do during
+a request. Therefore, `amivapi.utils.mail` only puts mails into a queue
+(the `mail_queue` collection), and a worker sends them later:
+
+    amivapi mailer --continuous
+
+The queue is also processed by `amivapi cron`, but only every
+`CRON_INTERVAL`, so a separate mailer is recommended.
+
+If sending a mail fails, it is retried with exponential backoff, i.e. after
+`MAIL_RETRY_DELAY`, two times that, four times that, etc. After
+`MAIL_MAX_ATTEMPTS` the mail is dropped and an error is logged. Mails
+rejected by the server (e.g. an invalid recipient) are not retried.
+
+While a worker sends a mail, it is leased for `MAIL_LEASE`, so several
+workers can run at the same time. If a worker dies, the mail is sent by
+another worker after the lease has expired.
+
+With `MAIL_QUEUE = False`, mails are sent immediately instead. In `TESTING`
+mode, mails are never sent but stored in `app.test_mails`.
+
+Metrics:
+The worker runs in another process than the API, so the statistics are kept
+in the database (`mail_stats`) and exposed by the API at `/metrics`:
+
+- `mail_queue_depth`: Number of mails in the queue
+- `mails_sent`, `mails_failed`, `mail_retries`: Number of mails
+- `mail_delivery_seconds`: Total time from enqueueing to sending all mails.
+  Divide by `mails_sent` to get the average latency.
+- `mail_send_seconds`: Total time spent talking to the SMTP server
+
+SMTP connections are kept open for `SMTP_KEEPALIVE` and reused (see
+`SMTPPool`), so sending many mails does not require a new connection, TLS
+handshake and login for every single mail.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import smtplib
+from threading import Lock
+from time import monotonic
+
+from flask import current_app
+from pymongo import ASCENDING, ReturnDocument
+
+from amivapi.cache import TTLCache
+from amivapi.indexes import register_indexes
+
+
+class MailError(Exception):
+    """Sending a mail failed, but might succeed later."""
+
+
+def enqueue(messages):
+    """Add messages (see `amivapi.utils.mail`) to the queue."""
+    now = datetime.utcnow()
+    documents = [dict(message, _created=now, next_attempt=now, attempts=0)
+                 for message in messages]
+    if documents:
+        current_app.data.driver.db['mail_queue'].insert_many(documents)
+
+
+def deliver(messages):
+    """Send messages right away over a single SMTP session, log errors."""
+    for message, error in send(messages):
+        current_app.logger.error("SMTP error trying to send mails: %s"
+                                 % error)
+
+
+def send(messages):
+    """Send messages with SMTP (or store them in `test_mails` if testing).
+
+    All messages are sent over a single connection from the pool. If the
+    connection breaks, a new one is used for the remaining messages.
+
+    Returns:
+        list: (message, MailError) for all messages which could not be sent,
+            but might be sent later.
+    """
+    if current_app.config.get('TESTING', False):
+        for message in messages:
+            _store_test_mail(message)
+        return []
+
+    config = current_app.config
+    if not (config.get('SMTP_SERVER') and config.get('SMTP_PORT')):
+        return []
+
+    pool = config['smtp_pool']
+    remaining = list(messages)
+    failed = []
+    while remaining:
+        try:
+            with pool.connection() as smtp:
+                while remaining:
+                    _sendmail(smtp, remaining[0])
+                    remaining.pop(0)
+        except MailError as error:
+            # No connection, no need to try the other messages
+            failed.extend((message, error) for message in remaining)
+            break
+        except (smtplib.SMTPException, OSError) as error:
+            failed.append((remaining.pop(0), MailError(error)))
+
+    return failed
+
+
+def _store_test_mail(message):
+    mail = {
+        'subject': message['subject'],
+        'from': message['sender'],
+        'receivers': message['to'],
+        'text': message['text'],
+        'html': message['html'],
+    }
+
+    if message.get('reply_to') is not None:
+        mail['reply-to'] = message['reply_to']
+    if message.get('calendar_invite') is not None:
+        mail['calendar_invite'] = message['calendar_invite']
+
+    current_app.test_mails.append(mail)
+
+
+def _sendmail(smtp, message):
+    try:
+        smtp.sendmail(current_app.config['API_MAIL_ADDRESS'], message['to'],
+                      _mime(message).as_string())
+    except smtplib.SMTPRecipientsRefused:
+        # Retrying will not help
+        error = ("Failed to send mail:\n"
+                 "From: %s\nTo: %s\n"
+                 "Subject: %s\n\n%s")
+        current_app.logger.error(error % (
+            message['sender'], str(message['to']),
+            message['subject'], message['text']))
+
+
+class SMTPPool(object):
+    """Keeps SMTP connections open to reuse them.
+
+    Idle connections are checked with NOOP before they are used again and
+    closed after `keepalive`. At most `size` idle connections are kept.
+    """
+
+    def __init__(self, size, keepalive):
+        self.size = size
+        self.keepalive = keepalive.total_seconds()
+        self._idle = []  # (last used, connection)
+        self._lock = Lock()
+
+    @contextmanager
+    def connection(self):
+        """Get a connection, which is returned to the pool afterwards.
+
+        If anything goes wrong during the block, the connection is closed.
+
+        Raises:
+            MailError: If no connection can be established.
+        """
+        smtp = self._get()
+        try:
+            yield smtp
+        except BaseException:
+            _quit(smtp)
+            raise
+        self._put(smtp)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, smtp in idle:
+            _quit(smtp)
+
+    def _get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                last_used, smtp = self._idle.pop()
+
+            if monotonic() - last_used < self.keepalive:
+                try:
+                    if smtp.noop()[0] == 250:
+                        return smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+            _quit(smtp)
+
+        return _connect()
+
+    def _put(self, smtp):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((monotonic(), smtp))
+                return
+        _quit(smtp)
+
+
+def _connect():
+    """Open a new secure and authenticated SMTP connection."""
+    config = current_app.config
+    try:
+        smtp = smtplib.SMTP(config['SMTP_SERVER'],
+                            port=config['SMTP_PORT'],
+                            timeout=config['SMTP_TIMEOUT'])
+    except (smtplib.SMTPException, OSError) as error:
+        raise MailError(error)
+
+    try:
+        status_code, _ = smtp.starttls()
+        if status_code != 220:
+            raise MailError("Failed to create secure SMTP connection!")
+
+        if config.get('SMTP_USERNAME') and config.get('SMTP_PASSWORD'):
+            smtp.login(config['SMTP_USERNAME'], config['SMTP_PASSWORD'])
+        else:
+            smtp.ehlo()
+    except (smtplib.SMTPException, OSError, MailError) as error:
+        _quit(smtp)
+        raise MailError(error)
+
+    return smtp
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+def _mime(message):
+    """Create the MIME message."""
+    msg = MIMEMultipart('mixed')
+    if message.get('html') is not None:
+        msg_body = MIMEMultipart('alternative')
+        msg_body.attach(MIMEText(message['text'], 'plain'))
+        msg_body.attach(MIMEText(message['html'], 'html'))
+        msg.attach(msg_body)
+    else:
+        msg.attach(MIMEText(message['text']))
+
+    if message.get('calendar_invite') is not None:
+        calendar_mime = MIMEText(message['calendar_invite'], 'calendar',
+                                 "utf-8")
+        calendar_mime['Content-Disposition'] = (
+            'attachment; filename="invite.ics"; ' +
+            'charset="utf-8"; method=PUBLISH')
+        msg.attach(calendar_mime)
+
+    msg['Subject'] = message['subject']
+    msg['From'] = message['sender']
+    to = message['to']
+    msg['To'] = ';'.join([to] if isinstance(to, str) else to)
+
+    if message.get('reply_to') is not None:
+        msg['reply-to'] = message['reply_to']
+
+    return msg
+
+
+def send_queued_mails():
+    """Send all mails in the queue which are due. Needs an app context.
+
+    The mails are sent in batches of `MAIL_BATCH_SIZE` over a single SMTP
+    connection.
+
+    Returns:
+        int: The number of sent mails.
+    """
+    collection = current_app.data.driver.db['mail_queue']
+    batch_size = current_app.config['MAIL_BATCH_SIZE']
+    sent = 0
+
+    while True:
+        batch = []
+        while len(batch) < batch_size:
+            message = _claim()
+            if message is None:
+                break
+            batch.append(message)
+
+        if not batch:
+            return sent
+
+        start = monotonic()
+        failed = send(batch)
+        send_seconds = monotonic() - start
+
+        for message, error in failed:
+            _retry(message, error)
+
+        failed_ids = {message['_id'] for message, _ in failed}
+        delivered = [message for message in batch
+                     if message['_id'] not in failed_ids]
+        if delivered:
+            now = datetime.utcnow()
+            collection.delete_many(
+                {'_id': {'$in': [message['_id'] for message in delivered]}})
+            _update_stats(
+                mails_sent=len(delivered),
+                mail_send_seconds=send_seconds,
+                mail_delivery_seconds=sum(
+                    (now - message['_created']).total_seconds()
+                    for message in delivered))
+        sent += len(delivered)
+
+        if len(batch) < batch_size:
+            return sent
+
+
+def _claim():
+    """Lease the next mail that is due."""
+    now = datetime.utcnow()
+    return current_app.data.driver.db['mail_queue'].find_one_and_update(
+        {'next_attempt': {'$lte': now}},
+        {'$set': {'next_attempt': now + current_app.config['MAIL_LEASE']},
+         '$inc': {'attempts': 1}},
+        sort=[('next_attempt', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def _retry(message, error):
+    """Schedule the next attempt with exponential backoff (or give up)."""
+    collection = current_app.data.driver.db['mail_queue']
+    attempts = message['attempts']
+
+    if attempts >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        current_app.logger.error(
+            "Giving up to send mail '%s' to %s after %i attempts: %s"
+            % (message['subject'], message['to'], attempts, error))
+        collection.delete_one({'_id': message['_id']})
+        _update_stats(mails_failed=1)
+        return
+
+    delay = current_app.config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+    current_app.logger.warning(
+        "Could not send mail '%s' to %s (attempt %i), retrying in %s: %s"
+        % (message['subject'], message['to'], attempts, delay, error))
+    collection.update_one(
+        {'_id': message['_id']},
+        {'$set': {'next_attempt': datetime.utcnow() + delay}})
+    _update_stats(mail_retries=1)
+
+
+def _update_stats(**values):
+    current_app.data.driver.db['mail_stats'].update_one(
+        {'_id': 'mailer'}, {'$inc': values}, upsert=True)
+
+
+def _stat(name):
+    """Create a function to read a statistic from the database."""
+    def _get():
+        stats = current_app.data.driver.db['mail_stats'].find_one(
+            {'_id': 'mailer'}) or {}
+        return stats.get(name, 0)
+    return _get
+
+
+def _queue_depth():
+    return current_app.data.driver.db['mail_queue'].count_documents({})
+
+
+def init_app(app):
+    """Create the connection pool and caches, register indexes and metrics.
+    """
+    app.config['smtp_pool'] = SMTPPool(app.config['SMTP_POOL_SIZE'],
+                                       app.config['SMTP_KEEPALIVE'])
+
+    # Rendering mails, see `amivapi.utils.mail_from_template`
+    app.config['mail_templates'] = {}  # name -> exists
+    app.config['mail_render_cache'] = TTLCache(
+        maxsize=app.config['MAIL_RENDER_CACHE_SIZE'],
+        ttl=app.config['MAIL_RENDER_CACHE_TTL'])
+
+    register_indexes(app, 'mail_queue', {
+        'next_attempt': ([('next_attempt', 1)], {'background': True}),
+    })
+
+    metrics = app.config['metrics']
+    metrics.gauge('mail_queue_depth', _queue_depth)
+    for name in ('mails_sent', 'mails_failed', 'mail_retries',
+                 'mail_delivery_seconds', 'mail_send_seconds'):
+        metrics.gauge(name, _stat(name))
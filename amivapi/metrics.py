@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Simple metrics for monitoring.
+
+Counters can be incremented from anywhere inside an app context:
+
+>>> from amivapi import metrics
+>>> metrics.increment('apikey_requests', apikey='Beer', resource='users')
+
+Values which are not counted by the API itself (e.g. the number of documents
+in a collection) can be provided as gauges, which are computed whenever the
+metrics are requested:
+
+>>> app.config['metrics'].gauge('queue_depth', count_queued_items)
+
+All metrics are exposed as plain text (Prometheus format) at `/metrics`.
+The endpoint is secured by Basic Auth, username and password need to be
+specified in the app config with the keys:
+
+    METRICS_USERNAME
+    METRICS_PASSWORD
+
+Notes:
+Metrics are kept per process, i.e. each process (e.g. each worker of the
+production server) reports its own values.
+"""
+
+from collections import defaultdict
+from threading import Lock
+
+from flask import abort, Blueprint, current_app, request, Response
+
+
+class Metrics(object):
+    """Thread-safe registry of labeled counters and gauges."""
+
+    def __init__(self):
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._gauges = {}
+        self._lock = Lock()
+
+    def increment(self, name, amount=1, **labels):
+        """Increment the counter `name` with the given labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[name][key] += amount
+
+    def get(self, name, **labels):
+        """Return the current value of a counter."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name not in self._counters:
+                return 0
+            return self._counters[name].get(key, 0)
+
+    def gauge(self, name, func):
+        """Register a function to compute the value of `name` on render."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def render(self):
+        """Format all metrics as text."""
+        with self._lock:
+            counters = {name: dict(values)
+                        for name, values in self._counters.items()}
+            gauges = dict(self._gauges)
+
+        lines = []
+        for name, values in sorted(counters.items()):
+            lines.append('# TYPE amivapi_%s counter' % name)
+            for labels, value in sorted(values.items()):
+                lines.append('amivapi_%s%s %s'
+                             % (name, _format_labels(labels), value))
+        for name, func in sorted(gauges.items()):
+            lines.append('# TYPE amivapi_%s gauge' % name)
+            lines.append('amivapi_%s %s' % (name, func()))
+        return ''.join(line + '\n' for line in lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def increment(name, amount=1, **labels):
+    """Increment a counter of the current app."""
+    current_app.config['metrics'].increment(name, amount, **labels)
+
+
+blueprint = Blueprint('metrics', __name__)
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Return all metrics if authorized."""
+    if check_auth():
+        return Response(current_app.config['metrics'].render(),
+                        mimetype='text/plain')
+    abort(401)
+
+
+def check_auth():
+    """Compare request basic auth with settings."""
+    auth = request.authorization
+    user = current_app.config['METRICS_USERNAME']
+    password = current_app.config['METRICS_PASSWORD']
+    return (user and password and auth and
+            (auth['username'] == user) and (auth['password'] == password))
+
+
+def init_app(app):
+    """Create the metrics registry and register the endpoint."""
+    user = app.config['METRICS_USERNAME']
+    password = app.config['METRICS_PASSWORD']
+
+    if (user or password) and not (user and password):
+        raise ValueError("You need to specify both username and password to "
+                         "make the metrics available.")
+
+    app.config['metrics'] = Metrics()
+    app.register_blueprint(blueprint)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Password hashing and verification in worker processes.
+
+`pbkdf2_sha256` is slow on purpose and keeps the CPU (and the GIL) busy for
+the whole computation. Therefore, passwords are hashed and verified by a
+fixed number of worker processes (`PASSWORD_WORKERS`), which bounds the CPU
+time spent on logins and leaves the request threads free for other
+requests. With `PASSWORD_WORKERS = 0`, everything runs in the request
+thread.
+
+Note that a single-threaded server (e.g. bjoern) still waits for the result,
+but logins of several server processes share the workers instead of
+competing for the CPU.
+
+Failed verifications are remembered for `PASSWORD_FAILURE_CACHE_TTL`, so
+clients repeating a wrong password (e.g. with stored credentials) do not
+trigger the expensive hash every time. Only a keyed hash of the wrong
+password is stored, and only in memory.
+
+The number of verifications and cached failures are counted in the metrics
+(`password_verifications` with result `valid`, `invalid` and `cached`).
+
+The workers are started with `forkserver`, since forking the (multi-threaded)
+API process could copy locks held by other threads. If a worker dies (e.g.
+killed because of low memory), the pool is replaced.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hmac
+import multiprocessing
+from os import urandom
+from threading import Lock
+
+from flask import current_app
+from passlib.context import CryptContext
+
+from amivapi import metrics
+from amivapi.cache import TTLCache
+
+
+# Context of a worker process
+_context = None
+
+
+def _init_worker(config):
+    global _context
+    _context = CryptContext.from_string(config)
+
+
+def _hash(plaintext):
+    return _context.hash(plaintext)
+
+
+def _verify_and_update(plaintext, hashed):
+    return _context.verify_and_update(plaintext, hashed)
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords with a pool of worker processes.
+
+    The processes are started when they are needed first.
+
+    Args:
+        context (CryptContext): The password context
+        workers (int): Number of processes, 0 to work in the calling thread
+        failure_cache (TTLCache): Cache for failed verifications
+    """
+
+    def __init__(self, context, workers, failure_cache):
+        self.context = context
+        self.workers = workers
+        self.failure_cache = failure_cache
+        self._key = urandom(32)
+        self._executor = None
+        self._lock = Lock()
+
+    def hash(self, plaintext):
+        """Hash a password."""
+        if not self.workers:
+            return self.context.hash(plaintext)
+        return self._submit(_hash, plaintext)
+
+    def verify_and_update(self, plaintext, hashed):
+        """Verify a password and create a new hash if needed.
+
+        Returns:
+            tuple: (True if the password is valid, new hash or None)
+        """
+        key = (hashed,
+               hmac.new(self._key, plaintext.encode(), 'sha256').digest())
+        if key in self.failure_cache:
+            metrics.increment('password_verifications', result='cached')
+            return False, None
+
+        if not self.workers:
+            result = self.context.verify_and_update(plaintext, hashed)
+        else:
+            result = self._submit(_verify_and_update, plaintext, hashed)
+
+        if result[0]:
+            metrics.increment('password_verifications', result='valid')
+        else:
+            metrics.increment('password_verifications', result='invalid')
+            self.failure_cache.set(key, True)
+        return result
+
+    def close(self):
+        """Stop the worker processes."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _submit(self, func, *args):
+        """Run a function in a worker, retry once if the pool is broken."""
+        executor = self._pool()
+        try:
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            current_app.logger.warning(
+                "Password worker died, restarting the workers.")
+            self._drop(executor)
+            return self._pool().submit(func, *args).result()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_init_worker,
+                    initargs=(self.context.to_string(),))
+            return self._executor
+
+    def _drop(self, executor):
+        """Remove a broken pool, unless another thread has done so."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+
+def hash_password(plaintext):
+    """Hash a password with the hasher of the current app."""
+    return current_app.config['password_hasher'].hash(plaintext)
+
+
+def verify_password(plaintext, hashed):
+    """Verify a password with the hasher of the current app.
+
+    Returns:
+        tuple: (True if the password is valid, new hash or None)
+    """
+    return current_app.config['password_hasher'].verify_and_update(
+        plaintext, hashed)
+
+
+def init_app(app):
+    """Create the password hasher."""
+    app.config['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_CONTEXT'],
+        workers=app.config['PASSWORD_WORKERS'],
+        failure_cache=TTLCache(
+            maxsize=app.config['PASSWORD_FAILURE_CACHE_SIZE'],
+            ttl=app.config['PASSWORD_FAILURE_CACHE_TTL']))
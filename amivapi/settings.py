@@ -59,9 +59,17 @@ EXTENDED_MEDIA_INFO = ['name', 'content_type', 'length', 'upload_date']
 # Mailing Lists, local and remote options (by default no storage)
 MAILING_LIST_FILE_PREFIX = '.forward+'  # default file name: .forward+groupname
 MAILING_LIST_DIR = None
+# Queue changed groups and update their files with `amivapi cron`. Set to
+# False to update the files during the request
+MAILING_LIST_QUEUE = True
 REMOTE_MAILING_LIST_ADDRESS = None
 REMOTE_MAILING_LIST_KEYFILE = None
 REMOTE_MAILING_LIST_DIR = './'  # Use home directory on remote by default
+# Remote changes are collected and pushed together after the delay.
+# Set to None to push the changes of every request immediately.
+REMOTE_MAILING_LIST_SYNC_DELAY = timedelta(seconds=5)
+# Keep the ssh connection open for further commands (None to disable)
+REMOTE_MAILING_LIST_CONTROL_PERSIST = timedelta(minutes=1)
 
 # SMTP server defaults
 API_MAIL_ADDRESS = 'no-reply@amiv.ethz.ch'
@@ -70,6 +78,19 @@ API_MAIL_SUBJECT = "[AMIV] {subject}"
 SMTP_HOST = 'localhost'
 SMTP_PORT = 587
 SMTP_TIMEOUT = 10
+SMTP_POOL_SIZE = 2  # idle connections kept open
+SMTP_KEEPALIVE = timedelta(seconds=30)  # then idle connections are closed
+
+# Outgoing mails are queued and sent by `amivapi mailer` (or `amivapi cron`)
+MAIL_QUEUE = True  # set to False to send mails immediately during requests
+MAIL_QUEUE_INTERVAL = timedelta(seconds=5)  # check queue every 5 s (mailer)
+MAIL_RETRY_DELAY = timedelta(minutes=1)  # doubled after every failed attempt
+MAIL_MAX_ATTEMPTS = 10
+MAIL_BATCH_SIZE = 50  # mails sent over a single connection
+MAIL_LEASE = timedelta(minutes=5)  # then mails of crashed workers are retried
+# Mails rendered for many recipients (e.g. all accepted signups of an event)
+MAIL_RENDER_CACHE_TTL = timedelta(hours=1)
+MAIL_RENDER_CACHE_SIZE = 100
 
 # LDAP
 LDAP_USERNAME = None
@@ -80,24 +101,80 @@ LDAP_HOSTS = ["ldaps://ldaps-rz-1.ethz.ch",
               "ldaps://ldaps-hit-1.ethz.ch",
               "ldaps://ldaps-hit-2.ethz.ch",
               "ldaps://ldaps-hit-3.ethz.ch"]
+# Number of parallel queries for `amivapi ldap_sync --all`, spread across
+# all hosts
+LDAP_SYNC_WORKERS = 1
+# Idle connections kept per host
+LDAP_POOL_SIZE = 2
+# Requests taking longer are retried with the next host
+LDAP_TIMEOUT = timedelta(seconds=5)
+LDAP_SEARCH_TIMEOUT = timedelta(minutes=5)
+# Failed hosts are avoided for this time
+LDAP_HOST_COOLDOWN = timedelta(minutes=1)
+
+# Create missing MongoDB indexes at startup. Large deployments can disable this
+# to start faster, but must then run `amivapi ensure-indexes` on every
+# deployment, otherwise new indexes (e.g. unique or TTL indexes) are missing
+MONGO_INDEXES_ON_STARTUP = True
 
 # Execution of periodic tasks with `amivapi run cron`
-CRON_INTERVAL = timedelta(minutes=5)  # per default, check tasks every 5 min
+# `amivapi cron --continuous` sleeps until the next task is due, but at
+# most `CRON_INTERVAL` (the mail queue is checked at least this often)
+CRON_INTERVAL = timedelta(minutes=5)
+# Without change streams (i.e. no replica set), check for new tasks this often
+CRON_POLL_INTERVAL = timedelta(seconds=5)
+CRON_WORKERS = 1  # threads executing tasks
+# Tasks of crashed workers are executed again after the lease has expired.
+# Must be longer than the longest task, e.g. `ldap.sync_all`
+CRON_LEASE = timedelta(minutes=30)
+CRON_MAX_ATTEMPTS = 3  # failing tasks are retried after the lease
+CRON_RUN_LOG_TTL = timedelta(days=30)  # see `amivapi cron --stats`
+
+# Delete (or unlink) items referencing a deleted item with `amivapi cron`
+# instead of during the DELETE request, see `amivapi cascades`
+CASCADE_ASYNC = False
+CASCADE_CHUNK_SIZE = 100  # items per step, progress is stored in between
 
 # Security
 ROOT_PASSWORD = u"root"  # Will be overwridden by config.py
 SESSION_TIMEOUT = timedelta(days=14)
+# Sessions are cached per process to avoid a database query for every request.
+# Changes by other processes (e.g. deleted sessions) are visible after the TTL.
+SESSION_CACHE_TTL = timedelta(minutes=1)  # set to None to disable the cache
+SESSION_CACHE_SIZE = 10000
+# The `_updated` time of a session is written to the database at most once per
+# interval and in bulk. Set to None to write on every request.
+SESSION_REFRESH_INTERVAL = timedelta(minutes=1)
+# Resolved group permissions per user, cached like sessions (see above)
+GROUP_PERMISSION_CACHE_TTL = timedelta(minutes=1)
+GROUP_PERMISSION_CACHE_SIZE = 10000
+# API keys, cached like sessions (see above)
+APIKEY_CACHE_TTL = timedelta(minutes=1)
+APIKEY_CACHE_SIZE = 10000
+APIKEY_REFRESH_INTERVAL = timedelta(minutes=1)
+# Signup times per event, used to compute waiting list positions
+SIGNUP_POSITION_CACHE_TTL = timedelta(minutes=1)
+SIGNUP_POSITION_CACHE_SIZE = 1000
 PASSWORD_CONTEXT = CryptContext(
     schemes=["pbkdf2_sha256"],
     pbkdf2_sha256__default_rounds=10 ** 3,
     # min_rounds is used to determine if a hash needs to be upgraded
     pbkdf2_sha256__min_rounds=8 * 10 ** 2,
 )
+# Processes to hash and verify passwords, 0 to hash in the request thread
+PASSWORD_WORKERS = 2
+# Repeated wrong passwords are rejected without hashing them again
+PASSWORD_FAILURE_CACHE_TTL = timedelta(minutes=1)
+PASSWORD_FAILURE_CACHE_SIZE = 10000
 
 # Newsletter subscriber list view authorization
 SUBSCRIBER_LIST_USERNAME = None
 SUBSCRIBER_LIST_PASSWORD = None
 
+# Metrics view authorization (`/metrics`)
+METRICS_USERNAME = None
+METRICS_PASSWORD = None
+
 # Aspect ratio tolerance for non-integer ratios (like DIN A)
 ASPECT_RATIO_TOLERANCE = 0.01
 
@@ -4,6 +4,10 @@
 #          you to buy us beer if we meet and you like the software.
 """Test apikey authorization."""
 
+from datetime import timedelta
+
+from freezegun import freeze_time
+
 from amivapi.tests.utils import WebTest, WebTestNoAuth
 
 
@@ -105,6 +109,61 @@ class ApiKeyPermissionsTest(WebTest):
 
         self.api.get('/apikeys', token=token, status_code=403)
 
+    def test_cached_key_is_updated(self):
+        """Test that changed or deleted keys are not used from the cache."""
+        key = self.new_object("apikeys", permissions={'users': 'readwrite'})
+        token = key['token']
+        root = self.get_root_token()
+        url = '/apikeys/%s' % key['_id']
+
+        self.api.get('/apikeys', token=token, status_code=403)
+
+        key = self.api.patch(url, token=root,
+                             headers={'If-Match': key['_etag']},
+                             data={'permissions': {'apikeys': 'read'}},
+                             status_code=200).json
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.api.delete(url, token=root, headers={'If-Match': key['_etag']},
+                        status_code=204)
+        self.api.get('/apikeys', token=token, status_code=401)
+
+    def test_request_metrics(self):
+        """Test that requests are counted once per key and resource."""
+        key = self.new_object("apikeys", name="Beer",
+                              permissions={'users': 'read'})
+        token = key['token']
+
+        self.api.get('/users', token=token, status_code=200)
+        self.api.get('/users', token=token, status_code=200)
+        self.api.get('/', token=token, status_code=200)
+
+        metrics = self.app.config['metrics']
+        self.assertEqual(
+            metrics.get('apikey_requests', apikey='Beer', resource='users'),
+            2)
+        self.assertEqual(
+            metrics.get('apikey_requests', apikey='Beer', resource='events'),
+            0)
+        # The home endpoint is not counted under any resource
+        self.assertEqual(
+            metrics.get('apikey_requests', apikey='Beer', resource=None), 0)
+        self.assertEqual(
+            metrics.get('apikey_requests', apikey='Beer',
+                        resource='apikeys'), 0)
+
+    def test_last_used_timestamp(self):
+        """Test that the timestamp is written in the background."""
+        with freeze_time("2020-01-01 12:00:00") as frozen_time:
+            key = self.new_object("apikeys", permissions={'users': 'read'})
+            frozen_time.tick(delta=timedelta(hours=1))
+            self.api.get('/users', token=key['token'], status_code=200)
+
+        self.app.config['apikey_timestamps'].flush()
+        updated = self.db['apikeys'].find_one({'_id': key['_id']})['_updated']
+        self.assertGreater(updated.replace(tzinfo=None),
+                           key['_updated'].replace(tzinfo=None))
+
 
 class ApiKeyModelTests(WebTestNoAuth):
     """Test that tokens are correctly generated and permissions validation."""
@@ -307,6 +307,8 @@ class AuthFunctionTest(FakeAuthTest):
                 # g.current_user shoudl be a string
                 expected_user = str(session['user'])
 
+                # Timestamps are written in the background, write them now
+                self.app.config['session_timestamps'].flush()
                 session_in_db = \
                     self.db['sessions'].find_one({'_id': session['_id']})
                 self.assertEqual(g.current_session, session_in_db)
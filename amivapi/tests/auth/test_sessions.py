@@ -4,11 +4,16 @@
 #          you to buy us beer if we meet and you like the software.
 """Tests for session."""
 
+from datetime import timedelta
+
 from bson import ObjectId
+from freezegun import freeze_time
 from passlib.context import CryptContext
 from passlib.hash import pbkdf2_sha256
 
 from amivapi.auth.sessions import verify_password
+from amivapi.cron import run_scheduled_tasks
+from amivapi.passwords import PasswordHasher
 from amivapi.tests.utils import WebTest
 
 
@@ -174,6 +179,48 @@ class AuthentificationTest(WebTest):
         """Try to do a request using invalid token."""
         self.api.get("/users", token=u"There is no token!", status_code=401)
 
+    def test_session_cache(self):
+        """Test that sessions are cached and timestamps written in bulk."""
+        user = self.new_object('users')
+        with freeze_time("2020-01-01 12:00:00") as frozen_time:
+            token = self.get_user_token(str(user['_id']))
+            session = self.db['sessions'].find_one({'token': token})
+            last_used = session.get('_updated', session['_created'])
+
+            frozen_time.tick(delta=timedelta(hours=1))
+            self.api.get("/sessions", token=token, status_code=200)
+            self.assertIsNotNone(self.app.config['session_cache'].get(token))
+
+            # The cached session is used, even if the database is not queried
+            self.db['sessions'].delete_one({'_id': session['_id']})
+            self.api.get("/sessions", token=token, status_code=200)
+
+        # The timestamp is written in the background (here: on flush)
+        self.db['sessions'].insert_one(session)
+        self.app.config['session_timestamps'].flush()
+        updated = self.db['sessions'].find_one({'_id': session['_id']})
+        self.assertGreater(updated['_updated'].replace(tzinfo=None),
+                           last_used.replace(tzinfo=None))
+
+    def test_session_cache_invalidated_on_logout(self):
+        """A new or deleted session must not be served from the cache."""
+        password = u"awesome-password"
+        user = self.new_object('users', password=password)
+
+        # Unknown tokens are cached as well
+        self.api.get("/sessions", token=u"unknown", status_code=401)
+        self.assertIn(u"unknown", self.app.config['session_cache'])
+
+        session = self.new_object('sessions', username=str(user['_id']),
+                                  password=password)
+        token = session['token']
+        self.api.get("/sessions", token=token, status_code=200)
+
+        self.api.delete("/sessions/%s" % session['_id'], token=token,
+                        headers={'If-Match': session['_etag']}, status_code=204)
+        self.assertNotIn(token, self.app.config['session_cache'])
+        self.api.get("/sessions", token=token, status_code=401)
+
 
 class PasswordVerificationTest(WebTest):
     """Test if password verfication and rehashing works."""
@@ -232,10 +279,9 @@ class PasswordVerificationTest(WebTest):
         This is supposed to happen if the security of the crypt context
         is increased.
 
-        Needs request context because Eve requires this for "patch_internal"
-        which is used to updated the hash.
+        The new hash is stored by a scheduled task.
         """
-        with self.app.test_request_context():
+        with self.app.app_context():
             db = self.db['users']
             password = "some_pw"
             weak_hash = self._get_weak_hash(password)
@@ -247,9 +293,91 @@ class PasswordVerificationTest(WebTest):
 
             # Verify password, should be true
             self.assertTrue(verify_password(user, password))
+            self.assertEqual(db.find_one({'_id': user_id})['password'],
+                             weak_hash)
 
+            # Logging in again does not schedule another rehash
+            self.assertTrue(verify_password(user, password))
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'key': 'rehash-%s' % user_id}), 1)
+
+            run_scheduled_tasks()
             self.assertRehashed(user_id, password, weak_hash)
 
+    def test_changed_password_is_not_rehashed(self):
+        """Test that a pending rehash does not overwrite a new password."""
+        with self.app.app_context():
+            db = self.db['users']
+            weak_hash = self._get_weak_hash("some_pw")
+            user_id = db.insert_one({'password': weak_hash}).inserted_id
+
+            self.assertTrue(
+                verify_password(db.find_one({'_id': user_id}), "some_pw"))
+            db.update_one({'_id': user_id}, {'$set': {'password': 'new'}})
+            run_scheduled_tasks()
+
+            self.assertEqual(db.find_one({'_id': user_id})['password'], 'new')
+
+    def test_failed_attempts_are_cached(self):
+        """Test that a repeated wrong password is not hashed again."""
+        metrics = self.app.config['metrics']
+
+        with self.app.app_context():
+            user = {'password': self.app.config['PASSWORD_CONTEXT'].hash(
+                "some_pw")}
+
+            for _ in range(3):
+                self.assertFalse(verify_password(user, "NotThePassword"))
+            self.assertTrue(verify_password(user, "some_pw"))
+
+        self.assertEqual(
+            metrics.get('password_verifications', result='invalid'), 1)
+        self.assertEqual(
+            metrics.get('password_verifications', result='cached'), 2)
+        self.assertEqual(
+            metrics.get('password_verifications', result='valid'), 1)
+
+    def test_worker_processes(self):
+        """Test hashing and verification in worker processes."""
+        context = self.app.config['PASSWORD_CONTEXT']
+        hasher = PasswordHasher(context, workers=1,
+                                failure_cache=self.app.config[
+                                    'password_hasher'].failure_cache)
+        try:
+            with self.app.app_context():
+                hashed = hasher.hash("some_pw")
+                self.assertTrue(context.verify("some_pw", hashed))
+
+                self.assertEqual(hasher.verify_and_update("some_pw", hashed),
+                                 (True, None))
+                self.assertFalse(
+                    hasher.verify_and_update("other_pw", hashed)[0])
+
+                valid, new_hash = hasher.verify_and_update(
+                    "some_pw", self._get_weak_hash("some_pw"))
+                self.assertTrue(valid)
+                self.assertTrue(context.verify("some_pw", new_hash))
+        finally:
+            hasher.close()
+
+    def test_dead_worker(self):
+        """Test that the workers are restarted if a worker dies."""
+        context = self.app.config['PASSWORD_CONTEXT']
+        hasher = PasswordHasher(context, workers=1,
+                                failure_cache=self.app.config[
+                                    'password_hasher'].failure_cache)
+        try:
+            with self.app.app_context():
+                hasher.hash("some_pw")
+                for process in list(hasher._executor._processes.values()):
+                    process.kill()
+                    process.join()
+
+                hashed = hasher.hash("some_pw")
+                self.assertTrue(context.verify("some_pw", hashed))
+        finally:
+            hasher.close()
+
     def test_hash_update_on_login(self):
         """Test that passwords are rehashed when needed on login."""
         db = self.db['users']
@@ -266,5 +394,7 @@ class PasswordVerificationTest(WebTest):
 
         self.api.post("/sessions", data=login_data, status_code=201)
 
-        # Check database
+        # Check database after the scheduled update
+        with self.app.app_context():
+            run_scheduled_tasks()
         self.assertRehashed(user_id, password, weak_hash)
@@ -486,3 +486,40 @@ class EventMailTest(WebTestNoAuth):
                        headers={'If-Match': fcfc_signup_waitlist['_etag']},
                        status_code=200)
         self.assertTrue('was accepted' in self.app.test_mails[4]['text'])
+
+    def test_rendered_mails_are_cached(self):
+        """Test that mails for the same event only differ in recipient fields
+        and that the cache is not used for a changed event."""
+        event = self.new_object(
+            'events', spots=100, selection_strategy='fcfs', title_en='Party',
+            time_start=datetime.datetime(2019, 1, 1),
+            time_end=datetime.datetime(2019, 1, 2))
+        pablo = self.new_object('users', firstname='Pablo')
+        other = self.new_object('users', firstname='<b>Pablito</b>')
+
+        for user in pablo, other:
+            self.new_object('eventsignups', event=event['_id'],
+                            user=user['_id'])
+        first, second = self.app.test_mails
+
+        self.assertIn('Hello Pablo!', first['text'])
+        self.assertIn('Hello <b>Pablito</b>!', second['text'])
+        self.assertIn('Hello &lt;b&gt;Pablito&lt;/b&gt;!', second['html'])
+        self.assertIsNotNone(first['calendar_invite'])
+        self.assertEqual(first['calendar_invite'],
+                         second['calendar_invite'])
+        # Different deletion links
+        self.assertNotEqual(
+            re.search(r'/delete_signup/\S+', first['text']).group(0),
+            re.search(r'/delete_signup/\S+', second['text']).group(0))
+        self.assertNotIn('\x00', first['text'] + first['html'])
+
+        # Change the event
+        etag = self.api.get('/events/%s' % event['_id'],
+                            status_code=200).json['_etag']
+        self.api.patch('/events/%s' % event['_id'], data={'title_en': 'Fest'},
+                       headers={'If-Match': etag}, status_code=200)
+        self.new_object('eventsignups', event=event['_id'],
+                        user=self.new_object('users')['_id'])
+        self.assertIn('Fest', self.app.test_mails[-1]['text'])
+        self.assertIn('Fest', self.app.test_mails[-1]['calendar_invite'])
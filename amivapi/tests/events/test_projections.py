@@ -13,6 +13,10 @@ import re
 
 from freezegun import freeze_time
 
+from amivapi.events.counters import (
+    add_missing_signup_counts_on_startup,
+    recount_signups,
+)
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -63,6 +67,81 @@ class EventProjectionTest(WebTestNoAuth):
         self.assertEqual(event['signup_count'], 100)
         self.assertEqual(event['unaccepted_count'], 1)
 
+    def test_signup_count_stored(self):
+        """Test that the counters are stored and kept up to date."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        first, second = self.load_fixture({
+            'users': [{}, {}],
+            'eventsignups': [{'event': str(event['_id'])} for _ in range(2)]
+        })[2:]
+
+        def assertCounts(accepted, unaccepted):
+            stored = self.db['events'].find_one({'_id': event['_id']})
+            self.assertEqual(stored['signup_count'], accepted)
+            self.assertEqual(stored['unaccepted_count'], unaccepted)
+
+        assertCounts(1, 1)
+
+        # Manually accepting the waiting signup
+        self.api.patch('/eventsignups/%s' % second['_id'],
+                       headers={'If-Match': second['_etag']},
+                       data={'accepted': True}, status_code=200)
+        assertCounts(2, 0)
+
+        # Deleting signups
+        for signup in first, second:
+            etag = self.api.get('/eventsignups/%s' % signup['_id'],
+                                status_code=200).json['_etag']
+            self.api.delete('/eventsignups/%s' % signup['_id'],
+                            headers={'If-Match': etag}, status_code=204)
+        assertCounts(0, 0)
+
+    def test_recount_signups(self):
+        """Test that counters can be recomputed."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        other = self.new_object('events', spots=1, selection_strategy='fcfs')
+        self.load_fixture({
+            'users': [{}, {}],
+            'eventsignups': [{'event': str(event['_id'])} for _ in range(2)]
+        })
+
+        self.db['events'].update_many({}, {'$set': {'signup_count': 42},
+                                           '$unset': {'unaccepted_count': 1}})
+        with self.app.app_context():
+            self.assertEqual(recount_signups(), 2)
+
+        stored = self.db['events'].find_one({'_id': event['_id']})
+        self.assertEqual(stored['signup_count'], 1)
+        self.assertEqual(stored['unaccepted_count'], 1)
+        stored = self.db['events'].find_one({'_id': other['_id']})
+        self.assertEqual(stored['signup_count'], 0)
+        self.assertEqual(stored['unaccepted_count'], 0)
+
+    def test_add_missing_counts_on_startup(self):
+        """Test that events of older versions get their counters."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        counted = self.new_object('events', spots=1,
+                                  selection_strategy='fcfs')
+        self.load_fixture({
+            'users': [{}, {}],
+            'eventsignups': [{'event': str(event['_id'])} for _ in range(2)]
+        })
+
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': 1, 'unaccepted_count': 1}})
+        # Existing counters are not touched
+        self.db['events'].update_one({'_id': counted['_id']},
+                                     {'$set': {'signup_count': 42}})
+
+        add_missing_signup_counts_on_startup(self.app)
+
+        stored = self.db['events'].find_one({'_id': event['_id']})
+        self.assertEqual(stored['signup_count'], 1)
+        self.assertEqual(stored['unaccepted_count'], 1)
+        stored = self.db['events'].find_one({'_id': counted['_id']})
+        self.assertEqual(stored['signup_count'], 42)
+
     def test_signuplist_position_projection(self):
         """Test that signup list position is correctly inserted into a
         signup information"""
@@ -107,6 +186,39 @@ class EventProjectionTest(WebTestNoAuth):
             self.assertEqual(event['signup_count'], 3)
             self.assertEqual(event['unaccepted_count'], 1)
 
+    def test_signup_positions_updated(self):
+        """Test positions of a signup collection, also after a deletion."""
+        with freeze_time("2016-01-01 00:00:00") as frozen_time:
+            event = self.new_object('events', spots=1,
+                                    selection_strategy='fcfs')
+            signups = []
+            for _ in range(3):
+                user = self.new_object('users')
+                signups.append(self.api.post('/eventsignups', data={
+                    'event': str(event['_id']),
+                    'user': str(user['_id'])
+                }, status_code=201).json)
+                frozen_time.tick(delta=timedelta(seconds=1))
+
+            def positions():
+                items = self.api.get('/eventsignups', status_code=200).json
+                return {item['_id']: item['position']
+                        for item in items['_items']}
+
+            self.assertEqual(positions(), {signup['_id']: index + 1
+                                           for index, signup
+                                           in enumerate(signups)})
+
+            first = signups.pop(0)
+            etag = self.api.get('/eventsignups/%s' % first['_id'],
+                                status_code=200).json['_etag']
+            self.api.delete('/eventsignups/%s' % first['_id'],
+                            headers={'If-Match': etag}, status_code=204)
+
+            self.assertEqual(positions(), {signup['_id']: index + 1
+                                           for index, signup
+                                           in enumerate(signups)})
+
     def test_signup_email_correct(self):
         """Test that signups display the correct email address"""
         event = self.new_object('events', spots=100)
@@ -126,6 +238,21 @@ class EventProjectionTest(WebTestNoAuth):
                               status_code=200).json
         self.assertEqual(signup['email'], 'testemail@amiv.com')
 
+    def test_signup_emails_in_collection(self):
+        """Test that all signups of a collection get the right email."""
+        event = self.new_object('events', spots=100, allow_email_signup=True)
+        users = self.load_fixture({'users': [{} for _ in range(3)]})
+        for user in users:
+            self.new_object('eventsignups', user=str(user['_id']),
+                            event=str(event['_id']))
+        guest = self.new_object('eventsignups', email='guest@example.com',
+                                event=str(event['_id']))
+
+        expected = {user['email'] for user in users} | {guest['email']}
+        signups = self.api.get('/eventsignups', status_code=200).json
+        self.assertEqual({item['email'] for item in signups['_items']},
+                         expected)
+
     def test_confirmed_projected(self):
         """Test that an external signups gets the confirmed field"""
         event = self.new_object('events', spots=100, additional_fields=None,
@@ -4,6 +4,7 @@
 #          you to buy us beer if we meet and you like the software.
 """Test that people are correctly added and removed from the waiting list"""
 
+from amivapi.events.queue import _reserve_spots, update_waiting_list
 from amivapi.tests.utils import WebTestNoAuth, WebTest
 
 
@@ -138,3 +139,87 @@ class EventsignupQueueTest(WebTestNoAuth):
         self.api.delete('/eventsignups/%s' % signup2['_id'],
                         headers={'If-Match': signup2['_etag']},
                         status_code=204)
+
+    def test_more_spots_accept_waiting_list(self):
+        """Test that waiting signups are accepted if spots are added."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        signups = [self.new_object('eventsignups', event=event['_id'],
+                                   user=self.new_object('users')['_id'])
+                   for _ in range(4)]
+        self.assertEqual([signup['accepted'] for signup in signups],
+                         [True, False, False, False])
+        self.app.test_mails = []
+
+        event = self.api.get('/events/%s' % event['_id'],
+                             status_code=200).json
+        self.api.patch('/events/%s' % event['_id'],
+                       headers={'If-Match': event['_etag']},
+                       data={'spots': 3}, status_code=200)
+
+        accepted = [self.api.get('/eventsignups/%s' % signup['_id'],
+                                 status_code=200).json['accepted']
+                    for signup in signups]
+        self.assertEqual(accepted, [True, True, True, False])
+        self.assertEqual(len(self.app.test_mails), 2)
+
+        event = self.api.get('/events/%s' % event['_id'],
+                             status_code=200).json
+        self.assertEqual(event['signup_count'], 3)
+        self.assertEqual(event['unaccepted_count'], 1)
+
+    def test_switch_to_fcfs_accepts_signups(self):
+        """Test that signups are accepted when switching from manual to fcfs.
+        """
+        event = self.new_object('events', spots=2,
+                                selection_strategy='manual')
+        for _ in range(3):
+            self.new_object('eventsignups', event=event['_id'],
+                            user=self.new_object('users')['_id'])
+
+        etag = self.api.get('/events/%s' % event['_id'],
+                            status_code=200).json['_etag']
+        self.api.patch('/events/%s' % event['_id'],
+                       headers={'If-Match': etag},
+                       data={'selection_strategy': 'fcfs'}, status_code=200)
+
+        self.assertEqual(self.db['eventsignups'].count_documents(
+            {'event': event['_id'], 'accepted': True}), 2)
+
+    def test_update_event_without_signup(self):
+        """Test that events without signup can be changed."""
+        event = self.new_object('events', spots=None,
+                                selection_strategy='manual')
+        self.api.patch('/events/%s' % event['_id'],
+                       headers={'If-Match': event['_etag']},
+                       data={'selection_strategy': 'fcfs'},
+                       status_code=200)
+
+        # E.g. if spots were removed while the waiting list is updated
+        with self.app.test_request_context():
+            self.assertEqual(_reserve_spots(event['_id']), [])
+
+    def test_reserved_spots_are_respected(self):
+        """Test that spots reserved by someone else (i.e. counted in the
+        signup_count of the event) are not given away."""
+        event = self.new_object('events', spots=2, selection_strategy='fcfs')
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$set': {'signup_count': 2}})
+
+        signup = self.new_object('eventsignups', event=event['_id'],
+                                 user=self.new_object('users')['_id'])
+        self.assertFalse(signup['accepted'])
+
+        # Releasing a spot accepts the signup
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$set': {'signup_count': 1}})
+        with self.app.test_request_context():
+            accepted = update_waiting_list(event['_id'])
+
+        self.assertEqual(accepted, [signup['_id']])
+        self.assertEqual(
+            self.db['events'].find_one({'_id': event['_id']})['signup_count'],
+            2)
+        # The promotion id is not kept
+        self.assertNotIn('_promotion',
+                         self.db['eventsignups'].find_one(
+                             {'_id': signup['_id']}))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Fake LDAP hosts to test (and benchmark) the LDAP pool without ETH access.
+
+Every host can be slowed down or taken offline:
+
+>>> fake = FakeLdap(['ldaps://a', 'ldaps://b'])
+>>> fake.add_user('pablo', 'p4bl0', {'givenName': ['Pablo']})
+>>> fake.hosts['ldaps://a'].latency = 0.5
+>>> fake.hosts['ldaps://b'].down = True
+>>> pool = LdapPool(fake.connect, ['ldaps://a', 'ldaps://b'], ...)
+"""
+
+import re
+from threading import Lock
+from time import sleep
+
+from ldap3.core.exceptions import LDAPSocketOpenError
+
+
+class FakeHost(object):
+    """A single host, counts requests and connections."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = 0  # seconds per request
+        self.down = False
+        self.requests = 0
+        self.connections = 0
+        self._lock = Lock()
+
+    def request(self):
+        """Simulate a request to this host."""
+        with self._lock:
+            self.requests += 1
+        if self.down:
+            raise LDAPSocketOpenError("Host '%s' is down" % self.name)
+        sleep(self.latency)
+
+
+class FakeConnector(object):
+    """Provides `authenticate` and `search` like the nethz connectors."""
+
+    def __init__(self, ldap, host):
+        self.ldap = ldap
+        self.host = host
+
+    def authenticate(self, cn, password):
+        self.host.request()
+        user = self.ldap.users.get(cn)
+        return user is not None and user[0] == password
+
+    def search(self, query, attributes=None):
+        """Only `(cn=...)` queries are supported, all other queries return
+        all users."""
+        self.host.request()
+        match = re.match(r'^\(cn=(.*)\)$', query)
+        entries = [entry for cn, (_, entry) in self.ldap.users.items()
+                   if match is None or cn == match.group(1)]
+
+        if attributes is None:
+            return entries
+        return [{key: value for key, value in entry.items()
+                 if key in attributes} for entry in entries]
+
+
+class FakeLdap(object):
+    """In-memory LDAP directory served by several fake hosts."""
+
+    def __init__(self, hosts):
+        self.hosts = {host: FakeHost(host) for host in hosts}
+        self.users = {}  # cn -> (password, entry)
+
+    def add_user(self, cn, password, entry=None):
+        self.users[cn] = (password, dict(entry or {}, cn=[cn]))
+
+    def connect(self, host):
+        """Create a connector, which fails if the host is down."""
+        fake_host = self.hosts[host]
+        fake_host.request()
+        fake_host.connections += 1
+        return FakeConnector(self, fake_host)
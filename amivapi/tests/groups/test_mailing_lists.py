@@ -9,17 +9,20 @@ To run integration tests for remote files, you need to set some environment
 variables (see below)
 """
 
-from os import getenv
+from datetime import timedelta
+from os import getenv, listdir, remove
 from os.path import isfile, join
 from shutil import rmtree
+from subprocess import PIPE, Popen
 from tempfile import mkdtemp
 
-from unittest.mock import patch, call
+from unittest.mock import patch
 
 from amivapi.tests.utils import WebTestNoAuth, skip_if_false
 
 from amivapi.groups.mailing_lists import (
-    make_files, remove_files, ssh_command, ssh_create, ssh_remove)
+    make_files, remove_files, ssh_command, ssh_sync, update_files,
+    update_queued_files)
 
 
 class MailingListTest(WebTestNoAuth):
@@ -163,6 +166,47 @@ class MailingListTest(WebTestNoAuth):
 
         self.assertFileContent('a', ['new@amiv.ch'])
 
+    def test_unchanged_files_are_skipped(self):
+        """Test that files are only written if the content changes."""
+        self._add_user_and_group()
+        self.api.post('/groupmemberships',
+                      data={'user': 24 * '0', 'group': 24 * '2'},
+                      status_code=201)
+
+        with self.app.app_context():
+            self.assertEqual(update_files(), 0)
+
+            # Missing files are created again
+            remove(self._full_name('a'))
+            self.assertEqual(update_files(), 1)
+
+        self.assertFileContent('a', ['user@amiv.ch', 'b@amiv.ch'])
+        # No temporary files are left
+        self.assertEqual(
+            listdir(self.app.config['MAILING_LIST_DIR']),
+            [self.app.config['MAILING_LIST_FILE_PREFIX'] + 'a'])
+
+    def test_queued_updates(self):
+        """Test that changes are queued and each group is updated once."""
+        self._add_user_and_group()
+        self.app.config['MAILING_LIST_QUEUE'] = True
+
+        for user in 24 * '0', 24 * '1':
+            self.api.post('/groupmemberships',
+                          data={'user': user, 'group': 24 * '2'},
+                          status_code=201)
+
+        # Not updated yet, but queued only once
+        self.assertFileContent('a', ['b@amiv.ch'])
+        self.assertEqual(self.db['mailing_list_queue'].count_documents({}), 1)
+
+        with self.app.app_context():
+            self.assertEqual(update_queued_files(), 1)
+
+        self.assertFileContent('a',
+                               ['user@amiv.ch', 'other@amiv.ch', 'b@amiv.ch'])
+        self.assertEqual(self.db['mailing_list_queue'].count_documents({}), 0)
+
 
 class RemoteMailingListTest(WebTestNoAuth):
     """Test creation and removal of remote mailing list files via ssh.
@@ -179,33 +223,103 @@ class RemoteMailingListTest(WebTestNoAuth):
         """Set config key and mock ssh call."""
         super().setUp()
         self.app.config['REMOTE_MAILING_LIST_ADDRESS'] = 'not none!'
+        # Push changes immediately
+        self.app.config['REMOTE_MAILING_LIST_SYNC_DELAY'] = None
 
     def test_remote_create_called(self):
-        """Test that creating the file over ssh is attempted."""
-        with patch('amivapi.groups.mailing_lists.ssh_create') as create:
+        """Test that creating the files over ssh is attempted."""
+        with patch('amivapi.groups.mailing_lists.ssh_sync') as sync:
             group_id = 24 * '0'
             receive_from = ['a', 'b']
             self.load_fixture({
                 'groups': [{'_id': group_id, 'receive_from': receive_from}]
             })
+            sync.reset_mock()
             with self.app.app_context():
+                self.app.data.driver.db['mailing_lists'].delete_many({})
                 make_files(group_id)
-                # Both times there will be no content
-                create.assert_has_calls(
-                    [call(address, '') for address in receive_from],
-                    any_order=True
-                )
+                # Both files in one command, there will be no content
+                sync.assert_called_once_with(
+                    {address: '' for address in receive_from})
 
     def test_remote_remove_called(self):
-        """Test that removing the file over ssh is attempted."""
+        """Test that removing the files over ssh is attempted."""
         addresses = ['a', 'b']
-        with patch('amivapi.groups.mailing_lists.ssh_remove') as remove:
+        with patch('amivapi.groups.mailing_lists.ssh_sync') as sync:
             with self.app.app_context():
                 remove_files(addresses)
-                remove.assert_has_calls(
-                    [call(address) for address in addresses],
-                    any_order=True
-                )
+                sync.assert_called_once_with(
+                    {address: None for address in addresses})
+
+    def test_delayed_push(self):
+        """Test that changes of several requests are pushed together."""
+        self.app.config['REMOTE_MAILING_LIST_SYNC_DELAY'] = timedelta(
+            minutes=1)
+        with patch('amivapi.groups.mailing_lists.ssh_sync') as sync:
+            self.load_fixture({'groups': [{'receive_from': ['a']},
+                                          {'receive_from': ['b']}]})
+            sync.assert_not_called()
+
+            self.app.config['remote_mailing_lists'].flush()
+            sync.assert_called_once_with({'a': '', 'b': ''})
+
+    def test_failed_push(self):
+        """Test that files are written again if pushing them failed."""
+        with patch('amivapi.groups.mailing_lists.ssh_command',
+                   side_effect=RuntimeError('Connection refused')):
+            self.load_fixture({'groups': [{'receive_from': ['a']}]})
+
+        self.assertEqual(self.db['mailing_lists'].count_documents({}), 0)
+
+
+def run_locally(remote_command, input=None):
+    """Local stand-in for the remote server, run the command with `sh`."""
+    process = Popen(['sh', '-c', remote_command],
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    if isinstance(input, str):
+        input = input.encode()
+    out, error = process.communicate(input=input)
+    if error:
+        raise RuntimeError(error.decode())
+    return out.decode()
+
+
+class RemoteSyncTest(WebTestNoAuth):
+    """Test the commands sent to the remote server with a local directory."""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = mkdtemp(prefix='amivapi_test')
+        self.app.config['REMOTE_MAILING_LIST_DIR'] = self.directory
+
+    def tearDown(self):
+        rmtree(self.directory, ignore_errors=True)
+        super().tearDown()
+
+    def _content(self, name):
+        with open(join(self.directory,
+                       self.app.config['MAILING_LIST_FILE_PREFIX'] + name),
+                  'r') as file:
+            return file.read()
+
+    def test_sync(self):
+        """Test creating, replacing and removing files in one command."""
+        with self.app.app_context(), \
+                patch('amivapi.groups.mailing_lists.ssh_command',
+                      side_effect=run_locally) as command:
+            ssh_sync({'a': 'a@amiv.ch\n', 'b': 'b@amiv.ch\n',
+                      'c': 'c@amiv.ch\n'})
+            self.assertEqual(self._content('a'), 'a@amiv.ch\n')
+            self.assertEqual(self._content('b'), 'b@amiv.ch\n')
+
+            ssh_sync({'a': None, 'b': 'new@amiv.ch\n'})
+            self.assertEqual(command.call_count, 2)
+
+        prefix = self.app.config['MAILING_LIST_FILE_PREFIX']
+        # No temporary directories are left
+        self.assertItemsEqual(listdir(self.directory),
+                              [prefix + 'b', prefix + 'c'])
+        self.assertEqual(self._content('b'), 'new@amiv.ch\n')
 
 
 # Decorator to mark tests to be skipped if ssh envvars are missing.
@@ -252,20 +366,27 @@ class SSHIntegrationTest(WebTestNoAuth):
 
     @skip_without_address
     def test_create_and_remove(self):
-        """Test that a file can be created and removed.
+        """Test that files can be created and removed with one sync.
 
         (Both in same test to clean up remote server)
         """
         with self.app.app_context():
-            filename = 'test.txt'
+            first, second = 'test.txt', 'test2.txt'
             content = 'test@amiv.ch\ntest2@amiv.ch\n'
-            self.assert_remote_does_not_exist(filename)
+            self.assert_remote_does_not_exist(first)
+            self.assert_remote_does_not_exist(second)
 
-            ssh_create(filename, content)
-            self.assert_remote_content(filename, content)
+            ssh_sync({first: content, second: content})
+            self.assert_remote_content(first, content)
+            self.assert_remote_content(second, content)
 
-            ssh_remove(filename)
-            self.assert_remote_does_not_exist(filename)
+            # Replace one file and remove the other in the same sync
+            ssh_sync({first: None, second: 'new@amiv.ch\n'})
+            self.assert_remote_does_not_exist(first)
+            self.assert_remote_content(second, 'new@amiv.ch\n')
+
+            ssh_sync({second: None})
+            self.assert_remote_does_not_exist(second)
 
     @skip_without_address
     def test_remove_does_not_raise(self):
@@ -273,4 +394,4 @@ class SSHIntegrationTest(WebTestNoAuth):
         with self.app.app_context():
             filename = 'ThisDoesNotExistsIHope.txt'
             self.assert_remote_does_not_exist(filename)
-            ssh_remove(filename)  # No Exception should crash the test
+            ssh_sync({filename: None})  # No Exception should crash the test
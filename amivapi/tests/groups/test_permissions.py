@@ -60,3 +60,27 @@ class PermissionsTest(WebTest):
         """Test that 'readwrite' gives admin permissions."""
         self.permission_fixture({'groups': 'read'})
         self.assertAdminReadonly()
+
+    def test_permission_cache_invalidation(self):
+        """Test that changes to groups and memberships take effect."""
+        self.permission_fixture({'groups': 'read'})
+        self.assertAdminReadonly()
+        self.assertIn(self.UID, self.app.config['group_permission_cache'])
+
+        # Update group permissions
+        root = self.get_root_token()
+        group = self.api.get('/groups/' + 24 * '1', token=root,
+                             status_code=200).json
+        self.api.patch('/groups/' + group['_id'], token=root,
+                       headers={'If-Match': group['_etag']},
+                       data={'permissions': {'groups': 'readwrite'}},
+                       status_code=200)
+        self.assertAdmin()
+
+        # Remove membership
+        membership = self.api.get('/groupmemberships', token=root,
+                                  status_code=200).json['_items'][0]
+        self.api.delete('/groupmemberships/' + membership['_id'], token=root,
+                        headers={'If-Match': membership['_etag']},
+                        status_code=204)
+        self.assertNothing()
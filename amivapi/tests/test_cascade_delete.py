@@ -4,8 +4,12 @@
 #          you to buy us beer if we meet and you like the software.
 """Test for cascading deletes"""
 
+from unittest.mock import patch
+
 from bson import ObjectId
 
+from amivapi import cascade
+from amivapi.cascade import pending_cascades, process_cascade_jobs
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -51,3 +55,207 @@ class CascadingDeleteTest(WebTestNoAuth):
         session_count = self.db['sessions'].count_documents({
             'user': ObjectId('deadbeefdeadbeefdeadbeef')})
         self.assertEqual(session_count, 0)
+
+    def test_relations(self):
+        """Test that the references are collected once."""
+        relations = self.app.config['cascade_relations']
+        self.assertIn(('sessions', 'user', True), relations['users'])
+        self.assertIn(('events', 'moderator', False), relations['users'])
+        self.assertIn(('groupmemberships', 'group', True),
+                      relations['groups'])
+        # Signups require an event
+        self.assertNotIn('events', relations)
+
+    def test_delete_many(self):
+        """Test that all referencing objects are deleted and hooks run."""
+        user = self.new_object('users')
+        events = [self.new_object('events', spots=10) for _ in range(3)]
+        for event in events:
+            self.new_object('eventsignups', user=user['_id'],
+                            event=event['_id'])
+        group = self.new_object('groups')
+        self.new_object('groupmemberships', user=user['_id'],
+                        group=group['_id'])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.assertEqual(self.db['eventsignups'].count_documents({}), 0)
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+        # The signup hooks ran for every signup
+        for event in events:
+            self.assertEqual(self.db['events'].find_one(
+                {'_id': ObjectId(event['_id'])})['signup_count'], 0)
+
+    def test_remove_references(self):
+        """Test that references are set to None with new etags."""
+        user = self.new_object('users')
+        events = [self.new_object('events', moderator=user['_id'])
+                  for _ in range(2)]
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        for event in events:
+            updated = self.api.get('/events/%s' % event['_id'],
+                                   status_code=200).json
+            self.assertIsNone(updated['moderator'])
+            self.assertNotEqual(updated['_etag'], event['_etag'])
+
+            # The new etag is valid
+            self.api.patch('/events/%s' % event['_id'],
+                           headers={'If-Match': updated['_etag']},
+                           data={'title_en': 'Changed'},
+                           status_code=200)
+
+    def test_keep_required_references(self):
+        """Test that references which can't be None are not changed."""
+        event = self.new_object('events', spots=10)
+        signup = self.new_object('eventsignups', event=event['_id'])
+
+        self.api.delete('/events/%s' % event['_id'],
+                        headers={'If-Match': event['_etag']},
+                        status_code=204)
+
+        self.assertEqual(self.db['eventsignups'].find_one(
+            {'_id': ObjectId(signup['_id'])})['event'],
+            ObjectId(event['_id']))
+
+
+class AsyncCascadeTest(WebTestNoAuth):
+    """Test that references are handled later with `CASCADE_ASYNC`."""
+
+    def setUp(self):
+        super().setUp(CASCADE_ASYNC=True, CASCADE_CHUNK_SIZE=2)
+
+    def test_cascade_in_background(self):
+        """Test that only sessions are deleted during the request."""
+        user = self.new_object('users', nethz='pablo')
+        self.new_object('sessions', username='pablo')
+        event = self.new_object('events', spots=10)
+        for _ in range(3):
+            self.new_object('eventsignups', user=user['_id'],
+                            event=event['_id'])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.assertEqual(self.db['sessions'].count_documents({}), 0)
+        self.assertEqual(self.db['eventsignups'].count_documents({}), 3)
+
+        with self.app.app_context():
+            jobs = pending_cascades()
+            self.assertEqual(len(jobs), 1)
+            self.assertEqual(jobs[0]['resource'], 'users')
+            self.assertEqual(jobs[0]['item'], ObjectId(user['_id']))
+            self.assertEqual(jobs[0]['processed'], 0)
+
+            self.assertEqual(process_cascade_jobs(), 1)
+            self.assertEqual(pending_cascades(), [])
+
+        self.assertEqual(self.db['eventsignups'].count_documents({}), 0)
+        self.assertEqual(self.db['events'].find_one(
+            {'_id': ObjectId(event['_id'])})['signup_count'], 0)
+
+    def test_waiting_list_in_background(self):
+        """Test that the waiting list is updated by the job.
+
+        Accepting a signup sends a mail with links, which needs a request
+        context.
+        """
+        user = self.new_object('users', nethz='pablo')
+        other = self.new_object('users', email='other@example.com')
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        self.api.post('/eventsignups', data={
+            'user': str(user['_id']),
+            'event': str(event['_id'])
+        }, status_code=201)
+        waiting = self.api.post('/eventsignups', data={
+            'user': str(other['_id']),
+            'event': str(event['_id'])
+        }, status_code=201).json
+        self.assertFalse(waiting['accepted'])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.app.test_mails = []
+        with self.app.app_context():
+            self.assertEqual(process_cascade_jobs(), 1)
+            self.assertEqual(pending_cascades(), [])
+
+        signup = self.db['eventsignups'].find_one(
+            {'_id': ObjectId(waiting['_id'])})
+        self.assertTrue(signup['accepted'])
+        self.assertEqual(len(self.app.test_mails), 1)
+        self.assertEqual(self.app.test_mails[0]['receivers'][0],
+                         'other@example.com')
+
+    def test_resume(self):
+        """Test that an interrupted job continues with the remaining items."""
+        group = self.new_object('groups')
+        for _ in range(3):
+            self.new_object('groupmemberships', group=group['_id'])
+
+        self.api.delete('/groups/%s' % group['_id'],
+                        headers={'If-Match': group['_etag']},
+                        status_code=204)
+
+        delete_items = cascade._delete_items
+
+        def interrupt(resource, items):
+            """Fail after the first chunk."""
+            if self.db['groupmemberships'].count_documents({}) < 3:
+                raise RuntimeError("Interrupted")
+            delete_items(resource, items)
+
+        with self.app.app_context():
+            with patch('amivapi.cascade._delete_items',
+                       side_effect=interrupt):
+                self.assertEqual(process_cascade_jobs(), 0)
+
+            job = pending_cascades()[0]
+            self.assertEqual(job['total'], 3)
+            self.assertEqual(job['processed'], 2)
+            self.assertIn('Interrupted', job['error'])
+            self.assertEqual(
+                self.db['groupmemberships'].count_documents({}), 1)
+
+            self.assertEqual(process_cascade_jobs(), 1)
+
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+
+    def test_failed_job_does_not_block(self):
+        """Test that later jobs are processed if a job fails."""
+        groups = [self.new_object('groups') for _ in range(2)]
+        for group in groups:
+            self.new_object('groupmemberships', group=group['_id'])
+            self.api.delete('/groups/%s' % group['_id'],
+                            headers={'If-Match': group['_etag']},
+                            status_code=204)
+
+        delete_items = cascade._delete_items
+
+        def fail_first(resource, items):
+            if items[0]['group'] == ObjectId(groups[0]['_id']):
+                raise RuntimeError("Broken")
+            delete_items(resource, items)
+
+        with self.app.app_context():
+            with patch('amivapi.cascade._delete_items',
+                       side_effect=fail_first):
+                self.assertEqual(process_cascade_jobs(), 1)
+
+            jobs = pending_cascades()
+            self.assertEqual(len(jobs), 1)
+            self.assertEqual(jobs[0]['item'], ObjectId(groups[0]['_id']))
+            self.assertIn('Broken', jobs[0]['error'])
+            self.assertEqual(self.db['groupmemberships'].count_documents(
+                {'group': ObjectId(groups[1]['_id'])}), 0)
+
+            # Retried by the next run
+            self.assertEqual(process_cascade_jobs(), 1)
@@ -7,6 +7,10 @@
 """ Test scheduler """
 
 from datetime import datetime, timedelta
+import pickle
+from threading import Timer, current_thread
+from time import monotonic, sleep
+
 from freezegun import freeze_time
 
 from amivapi import cron
@@ -17,8 +21,12 @@ from amivapi.cron import (
     schedulable,
     schedule_once_soon,
     schedule_task,
-    update_scheduled_task
+    task_run_stats,
+    update_scheduled_task,
+    wait_for_tasks
 )
+from bson import ObjectId
+
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -139,3 +147,232 @@ class CronTest(WebTestNoAuth):
 
             self.assertTrue(CronTest.has_run)
             self.assertEqual(CronTest.received_arg, "new-arg")
+
+    def test_failed_task_is_retried(self):
+        """Test that failing tasks are executed again after the lease."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def flaky():
+                CronTest.run_count += 1
+                if CronTest.run_count < 2:
+                    raise RuntimeError("Flaky")
+
+            schedule_task(datetime.utcnow(), flaky)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            # Still leased
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            frozen_time.tick(delta=self.app.config['CRON_LEASE'])
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': cron.func_str(flaky)}), 0)
+
+    def test_failing_task_is_dropped(self):
+        """Test that tasks are given up after `CRON_MAX_ATTEMPTS`."""
+        self.app.config['CRON_MAX_ATTEMPTS'] = 2
+
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def broken():
+                CronTest.run_count += 1
+                raise RuntimeError("Broken")
+
+            schedule_task(datetime.utcnow(), broken)
+            for _ in range(3):
+                run_scheduled_tasks()
+                frozen_time.tick(delta=self.app.config['CRON_LEASE'])
+
+            self.assertEqual(CronTest.run_count, 2)
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': cron.func_str(broken)}), 0)
+
+    def test_expired_lease(self):
+        """Test that tasks of crashed workers are executed later."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def inc():
+                CronTest.run_count += 1
+
+            schedule_task(datetime.utcnow(), inc)
+            # Claim all tasks without executing them, like a crashed worker
+            while cron._claim() is not None:
+                pass
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 0)
+
+            frozen_time.tick(delta=self.app.config['CRON_LEASE'])
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+    def test_parallel_workers(self):
+        """Test that tasks are executed by several threads."""
+        self.app.config['CRON_WORKERS'] = 4
+        threads = []
+
+        with self.app.app_context():
+            @schedulable
+            def slow(index):
+                sleep(0.1)
+                threads.append((index, current_thread().name))
+
+            for index in range(8):
+                schedule_task(datetime.utcnow(), slow, index)
+            run_scheduled_tasks()
+
+        self.assertCountEqual([index for index, _ in threads], range(8))
+        self.assertGreater(len({name for _, name in threads}), 1)
+
+    def test_wait_until_due(self):
+        """Test that the scheduler sleeps until the next task is due."""
+        self.app.config['CRON_POLL_INTERVAL'] = timedelta(seconds=0.05)
+
+        with self.app.app_context():
+            @schedulable
+            def inc():
+                CronTest.run_count += 1
+
+            # Only the test task
+            self.db['scheduled_tasks'].delete_many({})
+            self.assertIsNone(cron.next_due())
+
+            due = datetime.utcnow() + timedelta(seconds=0.3)
+            schedule_task(due, inc)
+            self.assertEqual(cron.next_due().replace(microsecond=0),
+                             due.replace(microsecond=0))
+
+            start = monotonic()
+            wait_for_tasks(timedelta(seconds=5))
+            self.assertLess(monotonic() - start, 2)
+            self.assertGreaterEqual(datetime.utcnow(), due)
+
+    def test_wake_up_early(self):
+        """Test that newly scheduled tasks end the sleep."""
+        self.app.config['CRON_POLL_INTERVAL'] = timedelta(seconds=0.05)
+        app = self.app
+
+        @schedulable
+        def inc():
+            CronTest.run_count += 1
+
+        def schedule():
+            with app.app_context():
+                schedule_task(datetime.utcnow(), inc)
+
+        with self.app.app_context():
+            self.db['scheduled_tasks'].delete_many({})
+            Timer(0.2, schedule).start()
+
+            start = monotonic()
+            wait_for_tasks(timedelta(seconds=10))
+            self.assertLess(monotonic() - start, 3)
+
+    def test_bson_arguments(self):
+        """Test that arguments are stored as BSON if possible."""
+        _id = ObjectId()
+        time = datetime(2016, 1, 1)
+
+        with self.app.app_context():
+            @schedulable
+            def receive(item, number):
+                CronTest.received_arg = (item, number)
+
+            schedule_task(datetime.utcnow(), receive,
+                          {'_id': _id, 'end_time': time}, 42)
+
+            task = self.db['scheduled_tasks'].find_one(
+                {'function': cron.func_str(receive)})
+            self.assertEqual(task['args_format'], cron.ARGS_BSON)
+            self.assertEqual(task['args'][0]['_id'], _id)
+
+            run_scheduled_tasks()
+            item, number = CronTest.received_arg
+            self.assertEqual(item['_id'], _id)
+            # Datetimes are returned in UTC
+            self.assertEqual(item['end_time'].replace(tzinfo=None), time)
+            self.assertEqual(number, 42)
+
+    def test_pickled_arguments(self):
+        """Test that other arguments and old tasks are pickled."""
+        with self.app.app_context():
+            @schedulable
+            def receive(arg):
+                CronTest.received_arg = arg
+
+            schedule_task(datetime.utcnow(), receive, {1, 2})
+            task = self.db['scheduled_tasks'].find_one(
+                {'function': cron.func_str(receive)})
+            self.assertEqual(task['args_format'], cron.ARGS_PICKLE)
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.received_arg, {1, 2})
+
+            # Tasks scheduled by older versions
+            self.db['scheduled_tasks'].insert_one({
+                'time': datetime.utcnow(),
+                'function': cron.func_str(receive),
+                'args': pickle.dumps(('old',)),
+            })
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.received_arg, 'old')
+
+    def test_replace_by_key(self):
+        """Test that tasks with the same key replace each other."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def receive(arg):
+                CronTest.run_count += 1
+                CronTest.received_arg = arg
+
+            schedule_task(datetime(2016, 1, 1, 1), receive, 'first',
+                          key='test')
+            schedule_task(datetime(2016, 1, 1, 2), receive, 'second',
+                          key='test')
+            self.assertEqual(
+                self.db['scheduled_tasks'].count_documents({'key': 'test'}),
+                1)
+
+            frozen_time.tick(delta=timedelta(hours=2))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+            self.assertEqual(CronTest.received_arg, 'second')
+
+    def test_run_log(self):
+        """Test that executions are logged and summarized."""
+        with self.app.app_context():
+            @schedulable
+            def works():
+                pass
+
+            @schedulable
+            def fails():
+                raise RuntimeError("Fails")
+
+            for _ in range(3):
+                schedule_task(datetime.utcnow(), works)
+            schedule_task(datetime.utcnow(), fails)
+            run_scheduled_tasks()
+
+            runs = self.db['scheduled_task_runs']
+            self.assertEqual(runs.count_documents(
+                {'function': cron.func_str(works), 'outcome': 'success'}), 3)
+            failed = runs.find_one({'function': cron.func_str(fails)})
+            self.assertEqual(failed['outcome'], 'error')
+            self.assertIn('Fails', failed['error'])
+
+            stats = {row['function']: row for row in task_run_stats()}
+
+        self.assertEqual(stats[cron.func_str(works)]['runs'], 3)
+        self.assertEqual(stats[cron.func_str(works)]['errors'], 0)
+        self.assertEqual(stats[cron.func_str(fails)]['errors'], 1)
+        self.assertLessEqual(stats[cron.func_str(works)]['p50'],
+                             stats[cron.func_str(works)]['p95'])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for index management."""
+
+from amivapi.indexes import declared_indexes, ensure_indexes
+from amivapi.tests.utils import WebTest
+
+
+class IndexesOnStartupTest(WebTest):
+    """Test that indexes are created when the app starts by default."""
+
+    def test_declared_indexes(self):
+        """Test that indexes from domains and other collections are found."""
+        indexes = declared_indexes(self.app)
+        self.assertIn('token', indexes['sessions'])
+        self.assertIn('event_accepted_created', indexes['eventsignups'])
+        self.assertIn('time', indexes['scheduled_tasks'])
+
+    def test_indexes_created(self):
+        """Nothing is missing or needs to be created."""
+        with self.app.app_context():
+            report = ensure_indexes(self.app)
+
+        for result in report.values():
+            self.assertEqual(result['created'], [])
+            self.assertEqual(result['missing'], [])
+
+
+class IndexesNotOnStartupTest(WebTest):
+    """Test that indexes can be created later."""
+
+    def setUp(self):
+        """Disable index creation at startup."""
+        super().setUp(MONGO_INDEXES_ON_STARTUP=False)
+
+    def test_ensure_indexes(self):
+        """Missing indexes are reported and created."""
+        with self.app.app_context():
+            report = ensure_indexes(self.app, create=False)
+            self.assertIn('token', report['sessions']['missing'])
+            self.assertEqual(report['sessions']['created'], [])
+            self.assertNotIn('token',
+                             self.db['sessions'].index_information())
+
+            report = ensure_indexes(self.app)
+            self.assertIn('token', report['sessions']['created'])
+            self.assertEqual(report['sessions']['missing'], [])
+            self.assertIn('token', self.db['sessions'].index_information())
+
+            # Newly created indexes have not been used yet
+            self.assertIn('token', report['sessions']['unused'])
+
+    def test_undeclared_indexes(self):
+        """Indexes not declared by the API are reported."""
+        self.db['sessions'].create_index([('something', 1)], name='other')
+
+        with self.app.app_context():
+            report = ensure_indexes(self.app)
+
+        self.assertEqual(report['sessions']['undeclared'], ['other'])
@@ -11,13 +11,19 @@ There is another file, "ldap_integration.py", which can be used to test
 integration with the real ldap. More info there.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from unittest.mock import MagicMock, patch, call
 import warnings
 
 from os import getenv
 from pprint import pformat
+from time import monotonic
+
+from ldap3.core.exceptions import LDAPException
 
 from amivapi import ldap
+from amivapi.tests.fake_ldap import FakeLdap
 from amivapi.tests.utils import WebTest, WebTestNoAuth, skip_if_false
 
 
@@ -36,18 +42,24 @@ class LdapTest(WebTestNoAuth):
         ldap_user = 'test'
         ldap_pass = 'T3ST'
         ldap_hosts = self.app.config['LDAP_HOSTS']
-        initialized_ldap = 'I totally am an ldap instance.'
 
         self.app.config['LDAP_USERNAME'] = ldap_user
         self.app.config['LDAP_PASSWORD'] = ldap_pass
         to_patch = 'amivapi.ldap.AuthenticatedLdap'
 
-        with patch(to_patch, return_value=initialized_ldap) as init:
+        with patch(to_patch) as init:
+            init.return_value.authenticate.return_value = True
             ldap.init_app(self.app)
 
-            init.assert_called_with(ldap_user, ldap_pass, ldap_hosts)
-            self.assertEqual(self.app.config['ldap_connector'],
-                             initialized_ldap)
+            pool = self.app.config['ldap_connector']
+            self.assertIsInstance(pool, ldap.LdapPool)
+
+            # Connectors are created for single hosts when needed
+            init.assert_not_called()
+            with self.app.app_context():
+                self.assertTrue(pool.authenticate('pablo', 'p4bl0'))
+            init.assert_called_once_with(ldap_user, ldap_pass,
+                                         [ldap_hosts[0]])
 
     def test_ldap_auth(self):
         """Test that ldap can authenticate a user."""
@@ -252,6 +264,32 @@ class LdapTest(WebTestNoAuth):
             else:
                 self.assertEqual(result[field], db_value)
 
+    def test_skip_unchanged_user(self):
+        """Test that users are only updated if the ldap data changes."""
+        metrics = self.app.config['metrics']
+
+        with self.app.test_request_context():
+            ldap._create_or_update_user(self.fake_filtered_data())
+        etag = self.db['users'].find_one({'nethz': 'pablo'})['_etag']
+
+        with self.app.test_request_context():
+            ldap._create_or_update_user(self.fake_filtered_data())
+        self.assertEqual(
+            self.db['users'].find_one({'nethz': 'pablo'})['_etag'], etag)
+        self.assertEqual(metrics.get('ldap_syncs', result='applied'), 1)
+        self.assertEqual(metrics.get('ldap_syncs', result='skipped'), 1)
+
+        # Changes with the API are overwritten by the next sync
+        user = self.api.get('/users/pablo', status_code=200).json
+        self.assertNotIn('ldap_digest', user)
+        self.api.patch('/users/pablo', data={'lastname': 'Changed'},
+                       headers={'If-Match': user['_etag']}, status_code=200)
+
+        with self.app.test_request_context():
+            result = ldap._create_or_update_user(self.fake_filtered_data())
+        self.assertEqual(result['lastname'], 'Ablo')
+        self.assertEqual(metrics.get('ldap_syncs', result='applied'), 2)
+
     def test_upgrade_membership(self):
         # Insert non-member and upgrade by ldap later
         user = self.api.post('/users', data={
@@ -330,22 +368,169 @@ class LdapTest(WebTestNoAuth):
                 mock_create.assert_not_called()
 
     def test_sync_all(self):
-        """Test if sync_all builds the query correctly and creates users."""
+        """Test if sync_all builds the query correctly and syncs users."""
         # Shorten ou list
         self.app.config['LDAP_DEPARTMENT_MAP'] = {'a': 'itet'}
         expected_query = '(& (ou=VSETH Mitglied) (| (departmentNumber=*a*)) )'
-        search_results = (i for i in [1, 2])
-        search = 'amivapi.ldap._search'
-        create = 'amivapi.ldap._create_or_update_user'
 
-        with patch(search, return_value=search_results) as mock_search:
-            with patch(create, return_value=3) as mock_create:
-                with self.app.app_context():
-                    result = ldap.sync_all()
+        unchanged = dict(self.fake_filtered_data(), nethz='unchanged',
+                         email='unchanged@ethz.ch', legi='00000001')
+        changed = dict(self.fake_filtered_data(), nethz='changed',
+                       email='changed@ethz.ch', legi='00000002')
+        new = dict(self.fake_filtered_data(), nethz='new',
+                   email='new@ethz.ch', legi='00000003')
+        self.new_object('users', **unchanged)
+        original = self.new_object('users', **dict(changed, lastname='Old'))
+        unchanged_etag = self.db['users'].find_one(
+            {'nethz': 'unchanged'})['_etag']
+
+        search_results = [dict(data) for data in (unchanged, changed, new)]
+        with patch('amivapi.ldap._search',
+                   return_value=search_results) as mock_search:
+            with self.app.test_request_context():
+                result = ldap.sync_all()
+
+        mock_search.assert_called_with(expected_query)
+        self.assertEqual(result,
+                         {'created': 1, 'updated': 1, 'unchanged': 1})
+
+        self.assertEqual(self.db['users'].find_one(
+            {'nethz': 'unchanged'})['_etag'], unchanged_etag)
+        updated = self.api.get('/users/changed', status_code=200).json
+        self.assertEqual(updated['lastname'], 'Ablo')
+        self.assertNotEqual(updated['_etag'], original['_etag'])
+        self.api.get('/users/new', status_code=200)
+
+        # The etag is valid, i.e. the user can be patched
+        self.api.patch('/users/changed', data={'lastname': 'New'},
+                       headers={'If-Match': updated['_etag']},
+                       status_code=200)
+
+    def test_sync_all_parallel(self):
+        """Test that departments are queried in parallel on several hosts."""
+        self.app.config['LDAP_SYNC_WORKERS'] = 2
+        self.app.config['LDAP_DEPARTMENT_MAP'] = {
+            'Student D-ITET': 'itet',
+            'Student D-MAVT': 'mavt',
+        }
+        hosts = self.app.config['LDAP_HOSTS']
+        results = {
+            'itet': self.fake_ldap_data(
+                cn=['pablo'], departmentNumber=['ETH Student D-ITET']),
+            'mavt': self.fake_ldap_data(
+                cn=['pablito'], departmentNumber=['ETH Student D-MAVT'],
+                swissEduPersonMatriculationNumber='76543210'),
+        }
+
+        def _search(query, attributes):
+            return [results['itet' if 'ITET' in query else 'mavt']]
+
+        with patch('amivapi.ldap.AuthenticatedLdap') as connector:
+            connector.return_value.search.side_effect = _search
+            with self.app.test_request_context():
+                result = ldap.sync_all()
+
+        self.assertEqual(result,
+                         {'created': 2, 'updated': 0, 'unchanged': 0})
+        connector.assert_has_calls([
+            call(None, None, hosts),
+            call(None, None, hosts[1:] + hosts[:1]),
+        ], any_order=True)
+        self.assertEqual(
+            self.api.get('/users/pablito', status_code=200).json['department'],
+            'mavt')
+
+
+class LdapPoolTest(WebTestNoAuth):
+    """Tests for the LDAP pool with fake hosts."""
 
-                mock_search.assert_called_with(expected_query)
-                mock_create.assert_has_calls([call(1), call(2)])
-                self.assertEqual(result, [3, 3])
+    hosts = ['ldaps://a', 'ldaps://b', 'ldaps://c']
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.fake = FakeLdap(self.hosts)
+        self.fake.add_user('pablo', 'p4bl0')
+        self.pool = ldap.LdapPool(self.fake.connect, self.hosts,
+                                  size=2,
+                                  timeout=timedelta(seconds=0.2),
+                                  search_timeout=timedelta(seconds=1),
+                                  cooldown=timedelta(minutes=1))
+        self.app.config['ldap_connector'] = self.pool
+
+    def requests(self):
+        return [self.fake.hosts[host].requests for host in self.hosts]
+
+    def test_connectors_are_reused(self):
+        with self.app.app_context():
+            for _ in range(5):
+                self.assertTrue(self.pool.authenticate('pablo', 'p4bl0'))
+            self.assertFalse(self.pool.authenticate('pablo', 'wrong'))
+            self.assertEqual(len(self.pool.search('(cn=pablo)')), 1)
+
+        # At most one connector per host
+        self.assertLessEqual(
+            max(host.connections for host in self.fake.hosts.values()), 1)
+
+    def test_fastest_host(self):
+        """Test that the host with the lowest latency is preferred."""
+        self.fake.hosts['ldaps://a'].latency = 0.05
+        self.fake.hosts['ldaps://b'].latency = 0.02
+
+        with self.app.app_context():
+            for _ in range(10):
+                self.pool.authenticate('pablo', 'p4bl0')
+
+        # Every host is tried once (connect + request), then 'c' is used
+        self.assertEqual(self.requests(), [2, 2, 9])
+
+    def test_unavailable_host(self):
+        """Test that failed hosts are avoided."""
+        self.fake.hosts['ldaps://a'].down = True
+
+        with self.app.app_context():
+            for _ in range(3):
+                self.assertTrue(self.pool.authenticate('pablo', 'p4bl0'))
+            self.assertEqual(self.pool.healthy_hosts(), 2)
+
+        self.assertEqual(self.requests()[0], 1)
+        self.assertEqual(
+            self.app.config['metrics'].get('ldap_requests', host='ldaps://a',
+                                           result='error'), 1)
+
+    def test_timeout(self):
+        """Test that slow hosts do not block logins."""
+        self.fake.hosts['ldaps://a'].latency = 1
+
+        with self.app.app_context():
+            start = monotonic()
+            self.assertTrue(self.pool.authenticate('pablo', 'p4bl0'))
+            self.assertLess(monotonic() - start, 0.5)
+
+            self.assertEqual(
+                self.app.config['metrics'].get(
+                    'ldap_requests', host='ldaps://a', result='timeout'), 1)
+
+    def test_hanging_host(self):
+        """Test that requests to a hanging host do not block other hosts."""
+        self.fake.hosts['ldaps://a'].latency = 1
+
+        def login(_):
+            with self.app.app_context():
+                return self.pool.authenticate('pablo', 'p4bl0')
+
+        # More logins at the same time than threads per host
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            self.assertTrue(all(executor.map(login, range(10))))
+
+    def test_no_host_available(self):
+        """Test that logins fail (but do not raise) without LDAP."""
+        for host in self.fake.hosts.values():
+            host.down = True
+
+        with self.app.app_context():
+            with self.assertRaises(LDAPException):
+                self.pool.authenticate('pablo', 'p4bl0')
+            self.assertFalse(ldap.authenticate_user('pablo', 'p4bl0'))
 
 
 # Integration Tests
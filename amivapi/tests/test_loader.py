@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the request-scoped document loader."""
+
+from eve.methods.patch import patch_internal
+
+from amivapi.loader import invalidate, load, load_many
+from amivapi.tests.utils import WebTestNoAuth
+from amivapi.utils import admin_permissions
+
+
+class LoaderTest(WebTestNoAuth):
+    """Test identity map, invalidation and counters."""
+
+    def assertCounts(self, resource, hits, queries):
+        metrics = self.app.config['metrics']
+        self.assertEqual(metrics.get('loader_hits', resource=resource), hits)
+        self.assertEqual(metrics.get('loader_queries', resource=resource),
+                         queries)
+
+    def test_identity_map(self):
+        """Documents are only loaded once per request."""
+        first, second = self.load_fixture({'groups': [{}, {}]})
+
+        with self.app.test_request_context():
+            group = load('groups', str(first['_id']))
+            self.assertEqual(group['name'], first['name'])
+            self.assertIs(load('groups', first['_id']), group)
+            self.assertCounts('groups', 1, 1)
+
+            # Only missing documents are queried, all in one go
+            groups = load_many('groups', [first['_id'], second['_id']])
+            self.assertEqual(set(groups), {first['_id'], second['_id']})
+            self.assertCounts('groups', 2, 2)
+
+            # Documents that do not exist are remembered as well
+            self.assertIsNone(load('groups', 24 * 'f'))
+            self.assertIsNone(load('groups', 24 * 'f'))
+            self.assertIsNone(load('groups', None))
+            self.assertCounts('groups', 3, 3)
+
+        # A new request starts with an empty identity map
+        with self.app.test_request_context():
+            load('groups', first['_id'])
+            self.assertCounts('groups', 3, 4)
+
+    def test_invalidation(self):
+        """Modified documents are loaded again."""
+        group = self.new_object('groups', name='old')
+
+        with self.app.test_request_context():
+            self.assertEqual(load('groups', group['_id'])['name'], 'old')
+
+            with admin_permissions():
+                patch_internal('groups', {'name': 'new'},
+                               concurrency_check=False, _id=group['_id'])
+            self.assertEqual(load('groups', group['_id'])['name'], 'new')
+
+            # Direct database changes need manual invalidation
+            self.db['groups'].update_one({'_id': group['_id']},
+                                         {'$set': {'name': 'direct'}})
+            self.assertEqual(load('groups', group['_id'])['name'], 'new')
+            invalidate('groups', group['_id'])
+            self.assertEqual(load('groups', group['_id'])['name'], 'direct')
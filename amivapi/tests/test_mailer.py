@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the mail queue."""
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from freezegun import freeze_time
+
+from amivapi.mailer import MailError, send_queued_mails
+from amivapi.tests.utils import WebTestNoAuth
+from amivapi.utils import deferred_mails, mail, mail_many
+
+
+class MailQueueTest(WebTestNoAuth):
+    """Test that mails are queued and sent by the worker."""
+
+    def setUp(self):
+        super().setUp(MAIL_QUEUE=True,
+                      MAIL_RETRY_DELAY=timedelta(minutes=1),
+                      MAIL_MAX_ATTEMPTS=3,
+                      METRICS_USERNAME='test', METRICS_PASSWORD='test')
+
+    def test_mails_are_queued(self):
+        """Test that mails are only sent by the worker."""
+        with self.app.app_context():
+            mail(['pablo@example.com'], 'Hello', 'Hello Pablo!')
+
+            self.assertEqual(self.app.test_mails, [])
+            self.assertEqual(self.db['mail_queue'].count_documents({}), 1)
+
+            self.assertEqual(send_queued_mails(), 1)
+
+        self.assertEqual(self.db['mail_queue'].count_documents({}), 0)
+        self.assertEqual(len(self.app.test_mails), 1)
+        self.assertEqual(self.app.test_mails[0]['receivers'],
+                         ['pablo@example.com'])
+        self.assertEqual(self.app.test_mails[0]['subject'], '[AMIV] Hello')
+
+    def test_deferred_mails(self):
+        """Test that mails are queued together at the end of the block."""
+        with self.app.test_request_context():
+            with deferred_mails():
+                for i in range(3):
+                    mail(['pablo%i@example.com' % i], 'Hello', 'Hi!')
+                self.assertEqual(
+                    self.db['mail_queue'].count_documents({}), 0)
+
+        self.assertEqual(self.db['mail_queue'].count_documents({}), 3)
+
+    def test_retry_with_backoff(self):
+        """Test that failed mails are retried later and dropped eventually."""
+        start = datetime(2020, 1, 1)
+
+        def fail(messages):
+            return [(message, MailError('Down')) for message in messages]
+
+        with self.app.app_context(), freeze_time(start) as frozen_time, \
+                patch('amivapi.mailer.send', side_effect=fail):
+            mail(['pablo@example.com'], 'Hello', 'Hello Pablo!')
+
+            self.assertEqual(send_queued_mails(), 0)
+            queued = self.db['mail_queue'].find_one()
+            self.assertEqual(queued['attempts'], 1)
+            self.assertEqual(queued['next_attempt'],
+                             start + timedelta(minutes=1))
+
+            # Not due yet
+            frozen_time.tick(timedelta(seconds=30))
+            send_queued_mails()
+            self.assertEqual(self.db['mail_queue'].find_one()['attempts'], 1)
+
+            # Second attempt, delay doubles
+            frozen_time.tick(timedelta(seconds=30))
+            send_queued_mails()
+            queued = self.db['mail_queue'].find_one()
+            self.assertEqual(queued['attempts'], 2)
+            self.assertEqual(queued['next_attempt'],
+                             start + timedelta(minutes=3))
+
+            # Third and last attempt
+            frozen_time.tick(timedelta(minutes=2))
+            send_queued_mails()
+            self.assertEqual(self.db['mail_queue'].count_documents({}), 0)
+
+        stats = self.db['mail_stats'].find_one({'_id': 'mailer'})
+        self.assertEqual(stats['mails_failed'], 1)
+        self.assertEqual(stats['mail_retries'], 2)
+
+    def test_metrics(self):
+        """Test that queue depth and sent mails are reported."""
+        with self.app.app_context():
+            mail(['pablo@example.com'], 'Hello', 'Hello Pablo!')
+            send_queued_mails()
+            mail(['pablo@example.com'], 'Hello', 'Hello again!')
+
+        basicauth = b64encode(b'test:test').decode('utf-8')
+        response = self.api.get('/metrics', status_code=200, headers={
+            'Authorization': 'Basic %s' % basicauth})
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertIn('# TYPE amivapi_mail_queue_depth gauge', lines)
+        self.assertIn('amivapi_mail_queue_depth 1', lines)
+        self.assertIn('amivapi_mails_sent 1', lines)
+
+
+class SMTPPoolTest(WebTestNoAuth):
+    """Test that SMTP connections are reused."""
+
+    def setUp(self):
+        super().setUp(SMTP_SERVER='localhost')
+        # Do not store mails, use the (fake) SMTP server
+        self.app.config['TESTING'] = False
+
+    def _mails(self, n):
+        return [dict(to=['pablo%i@example.com' % i], subject='Hi', text='Hi')
+                for i in range(n)]
+
+    @patch('smtplib.SMTP')
+    def test_single_connection(self, smtp_class):
+        """Test that many mails are sent over a single connection."""
+        smtp = smtp_class.return_value
+        smtp.starttls.return_value = (220, b'')
+        smtp.noop.return_value = (250, b'')
+
+        with self.app.app_context():
+            mail_many(self._mails(3))
+            mail_many(self._mails(2))
+
+        self.assertEqual(smtp_class.call_count, 1)
+        self.assertEqual(smtp.starttls.call_count, 1)
+        self.assertEqual(smtp.sendmail.call_count, 5)
+        # The idle connection was checked before it was reused
+        smtp.noop.assert_called_once()
+
+    @patch('smtplib.SMTP')
+    def test_reconnect(self, smtp_class):
+        """Test that broken connections are replaced."""
+        broken, working = MagicMock(), MagicMock()
+        smtp_class.side_effect = [broken, working]
+        for smtp in broken, working:
+            smtp.starttls.return_value = (220, b'')
+        broken.noop.side_effect = OSError('Connection reset')
+
+        with self.app.app_context():
+            mail_many(self._mails(1))
+            mail_many(self._mails(1))
+
+        self.assertEqual(smtp_class.call_count, 2)
+        broken.sendmail.assert_called_once()
+        working.sendmail.assert_called_once()
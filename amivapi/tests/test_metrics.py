@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the metrics endpoint."""
+
+from base64 import b64encode
+
+from amivapi.bootstrap import create_app
+from amivapi.tests import utils
+
+
+class MetricsTest(utils.WebTestNoAuth):
+    """Test authorization and output of the metrics endpoint."""
+
+    def setUp(self):
+        """Set username and password to enable the metrics endpoint."""
+        super().setUp(METRICS_USERNAME='test', METRICS_PASSWORD='test')
+        basicauth = b64encode(b'test:test').decode('utf-8')
+        self.auth_header = {'Authorization': 'Basic %s' % basicauth}
+
+    def test_metrics_response(self):
+        """Test that counters are rendered with their labels."""
+        metrics = self.app.config['metrics']
+        metrics.increment('test_requests', resource='users')
+        metrics.increment('test_requests', amount=2, resource='users')
+        metrics.increment('test_requests', resource='events')
+
+        response = self.api.get('/metrics', headers=self.auth_header,
+                                status_code=200)
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertIn('# TYPE amivapi_test_requests counter', lines)
+        self.assertIn('amivapi_test_requests{resource="users"} 3', lines)
+        self.assertIn('amivapi_test_requests{resource="events"} 1', lines)
+
+    def test_metrics_auth(self):
+        """Test that basic auth is required."""
+        wrong = b64encode(b'test:wrong').decode('utf-8')
+        self.api.get('/metrics', status_code=401)
+        self.api.get('/metrics', headers={'Authorization': 'Basic %s' % wrong},
+                     status_code=401)
+
+    def test_incomplete_config(self):
+        """Username and password are both required."""
+        with self.assertRaises(ValueError):
+            create_app(**dict(self.test_config, METRICS_USERNAME='test'))
@@ -105,12 +105,15 @@ class WebTest(unittest.TestCase, FixtureMixin):
         'MONGO_PASSWORD': 'test_pw',
         'API_MAIL': 'api@test.ch',
         'SMTP_SERVER': '',
+        'MAIL_QUEUE': False,  # Send (i.e. store in test_mails) immediately
+        'MAILING_LIST_QUEUE': False,  # Update mailing lists immediately
         'TESTING': True,
         'DEBUG': True,   # This makes eve's error messages more helpful
         'LDAP_USERNAME': None,  # LDAP test require special treatment
         'LDAP_PASSWORD': None,  # LDAP test require special treatment
         'SENTRY_DSN': None,
         'SENTRY_ENVIRONMENT': None,
+        'PASSWORD_WORKERS': 0,  # Hash in the test process
         'PASSWORD_CONTEXT': CryptContext(
             schemes=["pbkdf2_sha256"],
             pbkdf2_sha256__default_rounds=10,
@@ -10,6 +10,7 @@ from bson import ObjectId
 from flask import current_app, g
 
 from amivapi.auth import AmivTokenAuth
+from amivapi.passwords import hash_password
 from amivapi.utils import on_post_hook
 
 
@@ -191,10 +192,8 @@ def _hash_password(user):
     Args:
         user (dict): dict of user data.
     """
-    password_context = current_app.config['PASSWORD_CONTEXT']
-
     if user.get('password', None) is not None:
-        user['password'] = password_context.hash(user['password'])
+        user['password'] = hash_password(user['password'])
 
 
 def hash_on_insert(items):
@@ -6,20 +6,19 @@
 
 from contextlib import contextmanager
 from copy import deepcopy
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from os import urandom
 from binascii import hexlify
-import smtplib
 from functools import wraps
 import json
 import jinja2
 
 from bson import ObjectId
-from eve.utils import config
 from flask import render_template, current_app as app
+from markupsafe import escape
 from flask import g
 
+from amivapi import mailer
+
 
 @contextmanager
 def admin_permissions():
@@ -56,9 +55,34 @@ def get_id(item):
         return ObjectId(item['_id'])
 
 
+def find_users(ids, fields=('email', 'firstname')):
+    """Get multiple users with a single query.
+
+    Args:
+        ids (iterable): User ids (as str or ObjectId) or embedded users,
+            `None` is ignored.
+        fields (iterable): The fields to return for every user.
+
+    Returns:
+        dict: ObjectId -> user. Users which do not exist are missing.
+    """
+    ids = list({get_id(_id) for _id in ids if _id is not None})
+    if not ids:
+        return {}
+
+    users = app.data.driver.db['users'].find({'_id': {'$in': ids}},
+                                             {field: 1 for field in fields})
+    return {user['_id']: user for user in users}
+
+
+def find_user(_id, fields=('email', 'firstname')):
+    """Get a single user (or None), see `find_users`."""
+    return find_users([_id], fields).get(get_id(_id)) if _id else None
+
+
 def mail_from_template(
     to, subject, template_name, template_args, reply_to=None,
-    calendar_invite=None
+    calendar_invite=None, recipient_args=None, cache_key=None
 ):
     """Send a mail to a list of recipients by using the given jinja2 template.
 
@@ -68,6 +92,14 @@ def mail_from_template(
     The mail is sent from the address specified by `API_MAIL` in the config,
     and the subject formatted according to `API_MAIL_SUBJECT`.
 
+    If many similar mails are sent (e.g. to all accepted signups of an
+    event), the template can be rendered only once: Provide a `cache_key`
+    which changes whenever the `template_args` change (e.g. the event id and
+    `_etag`), and put everything which depends on the recipient (e.g. the
+    name) into `recipient_args`. The recipient args are inserted into the
+    cached mail, so they must be used as plain `{{ field }}` in the template
+    (no filters, conditions, etc.).
+
 
     Args:
         to(list of strings): List of recipient addresses
@@ -75,25 +107,97 @@ def mail_from_template(
         template_name(string): Jinja2 template name
         template_args(dict): arguments passed to the templating engine
         reply_to(string): Address of event moderator
+        recipient_args(dict): arguments which depend on the recipient
+        cache_key: identifies the `template_args`, enables the cache
+    """
+    mail(**render_mail(to, subject, template_name, template_args, reply_to,
+                       calendar_invite, recipient_args, cache_key))
+
+
+def render_mail(to, subject, template_name, template_args, reply_to=None,
+                calendar_invite=None, recipient_args=None, cache_key=None):
+    """Render a mail template, see `mail_from_template`.
+
+    Returns:
+        dict: The arguments for `mail`, e.g. to be used with `mail_many`.
     """
+    recipient_args = recipient_args or {}
+
+    if cache_key is None:
+        text, html = _render_mail_templates(
+            template_name, dict(template_args, **recipient_args))
+    else:
+        cache = app.config['mail_render_cache']
+        key = (template_name, cache_key, tuple(sorted(recipient_args)))
+        rendered = cache.get(key)
+        if rendered is None:
+            placeholders = {field: _PLACEHOLDER % field
+                            for field in recipient_args}
+            rendered = _render_mail_templates(
+                template_name, dict(template_args, **placeholders))
+            cache.set(key, rendered)
+
+        text, html = rendered
+        for field, value in recipient_args.items():
+            text = text.replace(_PLACEHOLDER % field, str(value))
+            if html is not None:
+                html = html.replace(_PLACEHOLDER % field,
+                                    str(escape(value)))
+
+    return dict(to=to, subject=subject, text=text, html=html,
+                reply_to=reply_to, calendar_invite=calendar_invite)
+
+
+# Marks the position of recipient args in cached mails. Not changed by
+# HTML escaping and very unlikely to be part of a template or argument.
+_PLACEHOLDER = '\x00%s\x00'
+
+
+def _render_mail_templates(template_name, template_args):
+    """Render the text and HTML (None, if there is no template) version."""
     text = render_template('{}.txt'.format(template_name), **template_args)
 
-    try:
-        html = render_template('{}.html'.format(template_name), **template_args)
-    except jinja2.exceptions.TemplateNotFound:
+    html_template = '{}.html'.format(template_name)
+    if template_exists(html_template):
+        html = render_template(html_template, **template_args)
+    else:
         html = None
 
-    mail(to, subject, text, html, reply_to, calendar_invite)
+    return text, html
+
+
+def template_exists(template_name):
+    """Check if a template exists, without loading it every time."""
+    known = app.config['mail_templates']
+    if template_name not in known:
+        try:
+            app.jinja_env.get_template(template_name)
+            known[template_name] = True
+        except jinja2.exceptions.TemplateNotFound:
+            known[template_name] = False
+    return known[template_name]
 
 
-def get_calendar_invite(template_name, template_args):
+def get_calendar_invite(template_name, template_args, cache_key=None):
     """ Get the calendar invite for an event.
     Also performs escaping of necessary fields.
 
+    The invite is the same for all recipients, so it can be cached, see
+    `mail_from_template`.
+
     Args:
         template_name(string): Jinja2 template name
         template_args(dict): arguments passed to the templating engine
+        cache_key: identifies the `template_args`, enables the cache
     """
+    if cache_key is not None:
+        key = (template_name, cache_key)
+        calendar_invite = app.config['mail_render_cache'].get(key)
+        if calendar_invite is None:
+            calendar_invite = get_calendar_invite(template_name,
+                                                  template_args)
+            app.config['mail_render_cache'].set(key, calendar_invite)
+        return calendar_invite
 
     for key, value in template_args.items():
         if isinstance(value, str):
@@ -103,12 +207,38 @@ def get_calendar_invite(template_name, template_args):
     return calendar_invite
 
 
+@contextmanager
+def deferred_mails():
+    """Send all mails of a block together afterwards (using `mail_many`).
+
+    Use this context for code that might send many mails, but sends them one
+    by one, e.g. by calling a notification function in a loop:
+
+    >> with deferred_mails():
+    >>     for signup in signups:
+    >>         notify_signup_accepted(event, signup)
+    """
+    if g.get('deferred_mails') is not None:
+        # Already deferring, the outer context will send the mails
+        yield
+        return
+
+    g.deferred_mails = []
+    try:
+        yield
+    finally:
+        mail_many(g.pop('deferred_mails'))
+
+
 def mail(to, subject, text, html=None, reply_to=None, calendar_invite=None):
     """Send a mail to a list of recipients.
 
     The mail is sent from the address specified by `API_MAIL` in the config,
     and the subject formatted according to `API_MAIL_SUBJECT`.
 
+    The mail is only added to the queue and sent later by the mailer, see
+    `amivapi.mailer`.
+
 
     Args:
         to(list of strings): List of recipient addresses
@@ -118,76 +248,43 @@ def mail(to, subject, text, html=None, reply_to=None, calendar_invite=None):
         reply_to(string): Address of event moderator
         calendar_invite(string): ICS calendar event
     """
-    sender_address = app.config['API_MAIL_ADDRESS']
-    sender_name = app.config['API_MAIL_NAME']
-    sender = f'{sender_name} <{sender_address}>'
-    subject = app.config['API_MAIL_SUBJECT'].format(subject=subject)
-
-    if app.config.get('TESTING', False):
-        mail = {
-            'subject': subject,
-            'from': sender,
-            'receivers': to,
-            'text': text,
-            'html': html,
-        }
-
-        if reply_to is not None:
-            mail['reply-to'] = reply_to
-        if calendar_invite is not None:
-            mail['calendar_invite'] = calendar_invite
-
-        app.test_mails.append(mail)
-
-    elif config.SMTP_SERVER and config.SMTP_PORT:
-        if html is not None:
-            msg = MIMEMultipart('mixed')
-            msg_body = MIMEMultipart('alternative')
-            msg_body.attach(MIMEText(text, 'plain'))
-            msg_body.attach(MIMEText(html, 'html'))
-            msg.attach(msg_body)
-        else:
-            msg = MIMEMultipart('mixed')
-            msg.attach(MIMEText(text))
+    mail_many([dict(to=to, subject=subject, text=text, html=html,
+                    reply_to=reply_to, calendar_invite=calendar_invite)])
 
-        if calendar_invite is not None:
-            calendar_mime = MIMEText(calendar_invite, 'calendar', "utf-8")
-            calendar_mime['Content-Disposition'] = (
-                'attachment; filename="invite.ics"; ' +
-                'charset="utf-8"; method=PUBLISH')
-            msg.attach(calendar_mime)
 
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ';'.join([to] if isinstance(to, str) else to)
+def mail_many(mails):
+    """Send many mails at once.
 
-        if reply_to is not None:
-            msg['reply-to'] = reply_to
+    All mails are queued with a single database operation, or, without the
+    mail queue (`MAIL_QUEUE = False`), sent over a single SMTP connection.
 
-        try:
-            with smtplib.SMTP(config.SMTP_SERVER,
-                              port=config.SMTP_PORT,
-                              timeout=config.SMTP_TIMEOUT) as smtp:
-                status_code, _ = smtp.starttls()
-                if status_code != 220:
-                    app.logger.error("Failed to create secure "
-                                     "SMTP connection!")
-                    return
-
-                if config.SMTP_USERNAME and config.SMTP_PASSWORD:
-                    smtp.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-                else:
-                    smtp.ehlo()
-
-                try:
-                    smtp.sendmail(sender_address, to, msg.as_string())
-                except smtplib.SMTPRecipientsRefused:
-                    error = ("Failed to send mail:\n"
-                             "From: %s\nTo: %s\n"
-                             "Subject: %s\n\n%s")
-                    app.logger.error(error % (sender, str(to), subject, text))
-        except smtplib.SMTPException as e:
-            app.logger.error("SMTP error trying to send mails: %s" % e)
+    Args:
+        mails (list of dicts): The arguments of `mail` for every mail, e.g.
+            created with `render_mail`
+    """
+    if g.get('deferred_mails') is not None:
+        g.deferred_mails.extend(mails)
+        return
+
+    sender_address = app.config['API_MAIL_ADDRESS']
+    sender_name = app.config['API_MAIL_NAME']
+    messages = [{
+        'sender': f'{sender_name} <{sender_address}>',
+        'to': mail['to'],
+        'subject': app.config['API_MAIL_SUBJECT'].format(
+            subject=mail['subject']),
+        'text': mail['text'],
+        'html': mail.get('html'),
+        'reply_to': mail.get('reply_to'),
+        'calendar_invite': mail.get('calendar_invite'),
+    } for mail in mails]
+
+    if not messages:
+        return
+    if app.config['MAIL_QUEUE']:
+        mailer.enqueue(messages)
+    else:
+        mailer.deliver(messages)
 
 
 def run_embedded_hooks_fetched_item(resource, item):
@@ -245,7 +342,14 @@ def register_domain(app, domain):
         # Capitalize like Eve does with item titles
         settings.setdefault('resource_title', resource.capitalize())
 
-        app.register_resource(resource, settings)
+        if app.config['MONGO_INDEXES_ON_STARTUP']:
+            app.register_resource(resource, settings)
+        else:
+            # Keep the indexes in the domain, but prevent Eve from creating
+            # them. Use `amivapi ensure-indexes` instead (see `indexes.py`)
+            indexes = settings.pop('mongo_indexes', {})
+            app.register_resource(resource, settings)
+            app.config['DOMAIN'][resource]['mongo_indexes'] = indexes
         _better_schema_defaults(app, resource, settings)
 
 
@@ -153,6 +153,9 @@ class ValidatorAMIV(Validator):
     def _validate_data_relation(self, data_relation, field, value):
         """Extend the arguments for data_relation to include cascading delete.
 
+        With `CASCADE_ASYNC`, references with `cascade_sync` are still handled
+        during the request (see `amivapi.cascade`).
+
         The rule's arguments are validated against this schema:
         {'type': 'dict',
             'schema': {
@@ -160,7 +163,8 @@ class ValidatorAMIV(Validator):
                 'field': {'type': 'string', 'required': True},
                 'embeddable': {'type': 'boolean', 'default': False},
                 'version': {'type': 'boolean', 'default': False},
-                'cascade_delete': {'type': 'boolean', 'default': False}
+                'cascade_delete': {'type': 'boolean', 'default': False},
+                'cascade_sync': {'type': 'boolean', 'default': False}
             }
         }
         """
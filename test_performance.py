@@ -6,7 +6,14 @@
 
 """Run a lot of queries against the API to test response times"""
 
-from amivapi.settings import DATE_FORMAT
+from amivapi.settings import (
+    DATE_FORMAT,
+    LDAP_HOST_COOLDOWN,
+    LDAP_POOL_SIZE,
+    LDAP_SEARCH_TIMEOUT,
+    LDAP_TIMEOUT,
+    PASSWORD_CONTEXT,
+)
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import BytesIO
@@ -14,6 +21,7 @@ from itertools import count
 import random
 import requests
 import statistics
+from threading import Timer
 from time import sleep, time
 import traceback
 from sys import argv, stdout
@@ -90,7 +98,7 @@ def get_token(username, password):
     return post(BASE_URL + '/sessions', data=data).json()['token']
 
 
-def create_event():
+def create_event(**kwargs):
     data = {
         'title_en': 'event%i' % next(counter),
         'description_en': 'party%i' % next(counter),
@@ -106,6 +114,7 @@ def create_event():
                               timedelta(days=80)).strftime(DATE_FORMAT),
         'allow_email_signup': True
     }
+    data.update(kwargs)
     return post(BASE_URL + '/events', json=data, auth=(ROOT_PW, '')).json()
 
 
@@ -185,6 +194,153 @@ def do_random_all():
         traceback.print_exc()
 
 
+def signup_storm(n_signups=2000, spots=100):
+    """ Let many users sign up for the same fcfs event at the same time.
+
+    Checks that no more than `spots` signups are accepted.
+
+    Returns:
+        An array of all the request times.
+    """
+    print("Creating %i users..." % n_signups)
+    with ThreadPoolExecutor(max_workers=100) as executor:
+        users = list(executor.map(lambda _: create_user(), range(n_signups)))
+
+    event = create_event(spots=spots, selection_strategy='fcfs')
+
+    def signup(user_id):
+        start = time()
+        post(BASE_URL + '/eventsignups', auth=(ROOT_PW, ''),
+             data={'user': user_id, 'event': event['_id']})
+        stdout.write('.')
+        stdout.flush()
+        return time() - start
+
+    print("Signing up %i users for an event with %i spots..."
+          % (n_signups, spots))
+    with ThreadPoolExecutor(max_workers=min(n_signups, 500)) as executor:
+        times = list(executor.map(signup, users))
+    print("")
+
+    where = '{"event": "%s", "accepted": true}' % event['_id']
+    accepted = get(BASE_URL + '/eventsignups', params={'where': where},
+                   auth=(ROOT_PW, '')).json()['_meta']['total']
+    signup_count = get(BASE_URL + '/events/' + event['_id'],
+                       auth=(ROOT_PW, '')).json()['signup_count']
+
+    print("Accepted signups: %i (signup_count: %i)" % (accepted, signup_count))
+    assert accepted <= spots, "More signups accepted than spots available!"
+    assert accepted == signup_count, "signup_count is out of sync!"
+
+    return times
+
+
+def login_storm(n_users=20, concurrency=20, duration=30):
+    """ Log in as often as possible with several clients at the same time.
+
+    Returns:
+        An array of all the request times.
+    """
+    print("Creating %i users..." % n_users)
+    users = [create_user() for _ in range(n_users)]
+    deadline = time() + duration
+
+    def login(user_id):
+        times = []
+        while time() < deadline:
+            start = time()
+            get_token(user_id, 'pass')
+            times.append(time() - start)
+        stdout.write('.')
+        stdout.flush()
+        return times
+
+    print("Logging in for %i seconds with %i clients..."
+          % (duration, concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(login, [users[i % n_users]
+                                       for i in range(concurrency)])
+        times = [t for result in results for t in result]
+    print("")
+
+    rounds = PASSWORD_CONTEXT.to_dict()['pbkdf2_sha256__default_rounds']
+    print("Logins per second: %.1f (pbkdf2_sha256 with %i rounds, if the "
+          "server uses the default settings)"
+          % (len(times) / duration, rounds))
+    return times
+
+
+def ldap_storm(concurrency=20, duration=30):
+    """ Log in against fake LDAP hosts with the LDAP pool.
+
+    One host is slow, one is down and the fastest one stops responding after
+    half of the time. Runs locally with the default LDAP settings, the API is
+    not used.
+
+    Returns:
+        An array of all the login times.
+    """
+    from flask import Flask
+    from ldap3.core.exceptions import LDAPException
+    from amivapi.ldap import LdapPool
+    from amivapi.metrics import Metrics
+    from amivapi.tests.fake_ldap import FakeLdap
+
+    hosts = ['ldaps://slow', 'ldaps://down', 'ldaps://fast']
+    fake = FakeLdap(hosts)
+    fake.add_user('pablo', 'p4bl0')
+    fake.hosts['ldaps://slow'].latency = 0.5
+    fake.hosts['ldaps://down'].down = True
+    fake.hosts['ldaps://fast'].latency = 0.02
+
+    # The pool reports failures and metrics with the app
+    app = Flask('ldap_storm')
+    app.config['metrics'] = Metrics()
+    pool = LdapPool(fake.connect, hosts,
+                    size=LDAP_POOL_SIZE,
+                    timeout=LDAP_TIMEOUT,
+                    search_timeout=LDAP_SEARCH_TIMEOUT,
+                    cooldown=LDAP_HOST_COOLDOWN)
+    deadline = time() + duration
+
+    def hang():
+        print("\nThe fast host stops responding...")
+        fake.hosts['ldaps://fast'].latency = \
+            2 * LDAP_TIMEOUT.total_seconds()
+    Timer(duration / 2, hang).start()
+
+    failed = []
+
+    def login(_):
+        times = []
+        with app.app_context():
+            while time() < deadline:
+                start = time()
+                try:
+                    pool.authenticate('pablo', 'p4bl0')
+                except LDAPException:
+                    failed.append(start)
+                times.append(time() - start)
+        stdout.write('.')
+        stdout.flush()
+        return times
+
+    print("Logging in with LDAP for %i seconds with %i clients..."
+          % (duration, concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(login, range(concurrency))
+        times = [t for result in results for t in result]
+    print("")
+
+    print("Logins per second: %.1f (%i failed)"
+          % (len(times) / duration, len(failed)))
+    for host in hosts:
+        print("%s: %i requests, %i connections"
+              % (host, fake.hosts[host].requests,
+                 fake.hosts[host].connections))
+    return times
+
+
 def time_func(func):
     """ Run the supplied function and return the time taken in seconds """
     start = time()
@@ -219,7 +375,9 @@ if len(argv) < 3:
     print("Usage: %s <API URL> <root password> [test type] [debug]" % argv[0])
     print("")
     print("Arguments:")
-    print("test type: GET or ALL")
+    print("test type: GET, ALL, SIGNUP (many simultaneous signups for a "
+          "single event), LOGIN (logins per second) or LDAP (logins with "
+          "slow and failing fake LDAP hosts, does not use the API)")
     print("debug: True or False")
     exit(1)
 
@@ -232,6 +390,12 @@ if len(argv) > 3:
         TEST_FUNC = do_random_get
     elif argv[3] == 'ALL':
         TEST_FUNC = do_random_all
+    elif argv[3] == 'SIGNUP':
+        TEST_FUNC = signup_storm
+    elif argv[3] == 'LOGIN':
+        TEST_FUNC = login_storm
+    elif argv[3] == 'LDAP':
+        TEST_FUNC = ldap_storm
     else:
         print("Error: Invalid test type %s" % argv[3])
         exit(1)
@@ -240,6 +404,13 @@ if len(argv) > 4:
     DEBUG = bool(argv[4])
 
 
+if TEST_FUNC in (signup_storm, login_storm, ldap_storm):
+    times = TEST_FUNC()
+    print("Average response time: %.3f s" % statistics.mean(times))
+    print("99th percentile: %.3f s" % statistics.quantiles(times, n=100)[98])
+    exit(0)
+
+
 print("Preparation...")
 print("Creating some users and sessions...")
 with ThreadPoolExecutor(max_workers=100) as executor: